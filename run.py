@@ -1,41 +1,47 @@
-import geopandas as gpd
+import argparse
+import json
+import shutil
+import unicodedata
 from pathlib import Path
-import src.plots as plots
-import src.osm as osm
-import src.preprocessing as preprocessing
-import pandas as pd
-import src.features as features
-from shapely.geometry import Polygon
-import src.modelling as modelling
 
 data_path = Path.cwd() / "DATA"
 results_path = Path.cwd() / "RESULTS" / "PLOTS"
 results_predictions_path = Path.cwd() / "RESULTS" / "PREDICTIONS_PLOTS"
 
+# layers fetched from OpenStreetMap for each city by the fetch command
+osm_layers = ["boundary", "green_areas", "buildings", "recreational_areas", "centrum"]
 
-def city_pipeline(city_name):
+
+def city_pipeline(city_name, layers=None, bike_paths_path=None, checkpoint_path=None, workers=None, restart=False):
     """
         Processes various features related to bike paths in chosen city using H3 hexagons and merges them into a single DataFrame.
 
-        This pipeline performs the following steps:
-        1. Reads data containing bike paths in chosen_city.
-        2. Collects CRS (Coordinate Reference System) for the dataset.
-        3. Creates boundary points and line for chosen_city.
+        The steps are stages of a dependency graph (see src/pipeline.py), which run in parallel threads as soon
+        as the stages they depend on are finished, and whose results are saved as checkpoints:
+        1. Fetches the boundary and the center of chosen city, unless they are in layers.
+        2. Fetches green areas, buildings and recreational areas within the boundary, unless they are in layers.
+        3. Reads geometries of bike paths within the bounding box of chosen_city.
         4. Calculates the count of bike paths in each H3 area.
-        5. Calculates the count of green areas in each H3 area.
-        6. Merges the bike paths DataFrame with the green areas DataFrame.
-        7. Calculates the count of buildings in each H3 area.
-        8. Merges the bike paths DataFrame with the buildings DataFrame.
-        9. Calculates the population count in each H3 area.
-        10. Calculates the count of recreational areas (shops, schools, sport centers) in each H3 area.
-        11. Merges the bike paths DataFrame with the recreational areas DataFrame.
-        12. Calculates the distance from each H3 area to the city center.
+        5. Calculates the count of green areas, buildings and recreational areas in each H3 area.
+        6. Calculates the population count in each H3 area.
+        7. Calculates the distance from each H3 area to the city center.
+        8. Calculates the distances along the bike path network to the city center and nearest recreational areas.
+        9. Merges the bike paths DataFrame with all other features.
+        Plots of the stages are drawn on the main thread. If a stage fails, e.g. an Overpass fetch times out,
+        running the pipeline again resumes from the checkpoints of the finished stages.
 
         Parameters:
-        None
+        - city_name (str): name of the chosen city
+        - layers (dict, optional): OpenStreetMap layers returned by fetch_city_layers. If None, they are fetched.
+        - bike_paths_path (Path, optional): GeoParquet file with bike paths, which may cover a much larger
+          area than the city, e.g. a whole country. By default the file of chosen city in DATA is used.
+        - checkpoint_path (Path, optional): Directory with the checkpoints of the stages, DATA/cache/checkpoints/<city>
+          by default. Checkpoints made with another bike paths file, resolution or layers are discarded.
+        - workers (int, optional): Number of threads running the stages.
+        - restart (bool): If True, existing checkpoints are discarded and every stage is run again.
 
         Returns:
-        pd.DataFrame: A DataFrame containing the following columns:
+        pa.Table: An Arrow table with uint64 H3 indices and GeoArrow geometries, containing the following columns:
             - h3_index: H3 hexagon index.
             - bike_paths_count: Count of bike paths in each H3 area.
             - green_areas_count: Count of green areas in each H3 area.
@@ -43,74 +49,401 @@ def city_pipeline(city_name):
             - population_count: Population count in each H3 area.
             - recreational_areas_count: Count of recreational areas in each H3 area.
             - centrum_distance: Distance from the H3 area to the city center.
+            - network_distance_to_centrum: Distance along bike paths from the H3 area to the city center.
+            - network_distance_to_recreational_areas: Mean distance along bike paths to the nearest recreational areas.
+        """
+    # heavy dependencies are imported here, so the command line starts fast
+    import src.features as features
+    import src.pipeline as pipeline
+
+    if bike_paths_path is None:
+        bike_paths_path = default_bike_paths_path(city_name)
+    if checkpoint_path is None:
+        checkpoint_path = data_path / "cache" / "checkpoints" / table_name(city_name)
+
+    # checkpoints are only reused by a run with the same inputs, so refreshed or fetched again layers
+    # are not mixed with counts of the old ones
+    pipeline.prepare_checkpoints(checkpoint_path, {"city": city_name, "resolution": features.h3_resolution,
+                                                   "bike_paths": str(Path(bike_paths_path).resolve()),
+                                                   "layers": pipeline.layers_digest(layers)}, restart)
+    stages = pipeline.city_stages(city_name, bike_paths_path, layers)
+    return pipeline.run_stages(stages, checkpoint_path, workers)
+
+
+def default_bike_paths_path(city_name):
+    """
+        Returns the path of the GeoParquet file with bike paths of chosen city in DATA.
         """
-    # read data containing bike paths in chosen_city
     if city_name == "Amsterdam":
-        city_bikes = gpd.read_parquet(data_path / "amsterdam_bike_paths_extended.parquet")
+        return data_path / "amsterdam_bike_paths_extended.parquet"
+    return data_path / "krakow_bike_paths_extended.parquet"
+
+
+def fetch_city_layers(city_name):
+    """
+        Fetches the OpenStreetMap layers used by the features of chosen city.
+
+        Parameters:
+        - city_name (str): name of the chosen city
+
+        Returns:
+        - layers (dict): Dictionary containing:
+            - boundary: list of (longitude, latitude) points of the city boundary.
+            - green_areas: list of (latitude, longitude) points of green areas.
+            - buildings: list of (latitude, longitude) points of buildings.
+            - recreational_areas: list of (latitude, longitude) points of recreational areas.
+            - centrum: coordinates of the city center as (longitude, latitude).
+            - sync: time of the OpenStreetMap data of each point layer, used by the refresh command.
+        """
+    import src.features as features
+    import src.osm as osm
+    import src.preprocessing as preprocessing
+
+    boundary = osm.boundaries_download(city_name)
+    city_boundaries = preprocessing.boundary_from_points(boundary, "EPSG:4326")
+    layers = {"boundary": boundary, "centrum": features.centrum_coords(city_name), "sync": {}}
+    for layer in ("green_areas", "buildings", "recreational_areas"):
+        layers[layer], layers["sync"][layer] = osm.fetch_layer(city_boundaries, layer)
+    return layers
+
+
+def table_name(city_name):
+    """
+        Creates an ASCII file name for the tables of chosen city, e.g. "Krakow" for "Kraków".
+
+        Parameters:
+        - city_name (str): name of the chosen city
+
+        Returns:
+        - name (str): ASCII name of the city.
+        """
+    return unicodedata.normalize("NFKD", city_name).encode("ascii", "ignore").decode().replace(" ", "_")
+
+
+def layers_path(args):
+    return data_path / "cache" / f"{table_name(args.city)}_osm.json"
+
+
+def features_path(args):
+    return args.output / f"{table_name(args.city)}_resolution_{args.resolution}.feather"
+
+
+def checkpoints_path(args):
+    return args.output / "CHECKPOINTS" / table_name(args.city)
+
+
+def history_path(args, resolution=None):
+    # runs are recorded at the resolution of their predictions table, which can differ from --resolution
+    resolution = args.resolution if resolution is None else resolution
+    return args.output / "HISTORY" / f"{table_name(args.city)}_resolution_{resolution}"
+
+
+def predictions_path(args):
+    return args.output / f"{table_name(args.city)}_resolution_{args.resolution}_predictions.feather"
+
+
+def tiles_path(args):
+    suffix = ".mbtiles" if args.format == "mbtiles" else ""
+    return args.output / "RESULTS" / "TILES" / f"{table_name(args.city)}{suffix}"
+
+
+def configure_osm(args):
+    import src.osm as osm
+
+    osm.overpass_url = args.overpass_url
+
+
+def configure(args):
+    """
+        Applies the resolution, output and plotting options of the command line to the pipeline modules.
+
+        Parameters:
+        - args (argparse.Namespace): Parsed command line arguments.
+
+        Returns:
+        - None
+        """
+    global results_path, results_predictions_path
+    import src.features as features
+    import src.plots as plots
+
+    configure_osm(args)
+    features.h3_resolution = args.resolution
+    plots.default_backend = args.plot_backend
+    results_path = args.output / "RESULTS" / "PLOTS"
+    results_predictions_path = args.output / "RESULTS" / "PREDICTIONS_PLOTS"
+    features.results_path = results_path
+    for path in (results_path, results_predictions_path):
+        path.mkdir(parents=True, exist_ok=True)
+
+
+def fetch_command(args):
+    configure_osm(args)
+    layers = fetch_city_layers(args.city)
+    layers_path(args).parent.mkdir(parents=True, exist_ok=True)
+    with open(layers_path(args), "w") as file:
+        json.dump(layers, file)
+    print(f"Saved OpenStreetMap layers to {layers_path(args)}")
+
+
+def features_command(args):
+    import src.refresh as refresh
+    import src.tables as tables
+
+    configure(args)
+    layers = None
+    if layers_path(args).exists():
+        with open(layers_path(args)) as file:
+            layers = json.load(file)
+
+    dataset = city_pipeline(args.city, layers, args.bike_paths, checkpoints_path(args), args.stage_workers,
+                            args.restart)
+    if layers is not None and "sync" in layers:
+        # the table records the OpenStreetMap time of its counts, from which the refresh command continues
+        dataset = refresh.with_sync(dataset, layers["sync"])
+    tables.write_table(dataset, features_path(args))
+    # checkpoints are kept only to resume a failed run
+    shutil.rmtree(checkpoints_path(args))
+    print(f"Saved features to {features_path(args)}")
+
+
+def predict_command(args):
+    import src.history as history
+    import src.modelling as modelling
+    import src.tables as tables
+
+    # feature table is memory-mapped and its geometry is passed on without being decoded
+    table = tables.read_table(features_path(args))
+    dataset = tables.to_geodataframe(table, [column for column in table.column_names if column != "geometry"])
+    predictions = modelling.krakow_prediction(dataset, args.model_version, args.threads, args.explain)
+    table = tables.append_columns(table, predictions)
+    tables.write_table(table, predictions_path(args))
+    print(f"Saved predictions to {predictions_path(args)}")
+
+    run_history_path = history_path(args, tables.table_resolution(table))
+    recorded = history.append_snapshot(run_history_path, table,
+                                       {"command": "predict", "model_version": args.model_version})
+    print(f"Recorded run {recorded['run_id']} in {run_history_path}")
+
+
+def plot_command(args):
+    import src.plots as plots
+    import src.tables as tables
+
+    configure(args)
+    predictions = tables.to_geodataframe(tables.read_table(predictions_path(args)))
+
+    plots.results_h3_count_bike_path_plotter(predictions, results_predictions_path, args.city)
+    plots.results_h3_difference_bike_path_plotter(predictions, results_predictions_path, args.city)
+    if "dominant_driver" in predictions:
+        plots.results_dominant_driver_plotter(predictions, results_predictions_path, args.city)
+    print(f"Saved plots to {results_predictions_path}")
+
+
+def refresh_command(args):
+    import src.history as history
+    import src.refresh as refresh
+    import src.tables as tables
+
+    configure_osm(args)
+    with open(layers_path(args)) as file:
+        layers = json.load(file)
+    feature_table = tables.read_table(features_path(args))
+    predictions_table = tables.read_table(predictions_path(args)) if predictions_path(args).exists() else None
+
+    layers, feature_table, predictions_table, touched = refresh.refresh_city(
+        layers, feature_table, predictions_table, args.resolution, args.model_version, args.threads)
+
+    # every output records its own sync timestamps, so if writing fails part way, the next refresh
+    # brings each output up to date without applying any change twice
+    tables.write_table(feature_table, features_path(args))
+    if predictions_table is not None:
+        tables.write_table(predictions_table, predictions_path(args))
+        history.append_snapshot(history_path(args, tables.table_resolution(predictions_table)), predictions_table,
+                                {"command": "refresh", "sync": refresh.read_sync(predictions_table)})
+    temporary_path = layers_path(args).with_name(f"{layers_path(args).name}.tmp")
+    with open(temporary_path, "w") as file:
+        json.dump(layers, file)
+    temporary_path.replace(layers_path(args))
+    print(f"Updated {touched} h3 areas with OpenStreetMap changes until {max(layers['sync'].values())}")
+
+
+def preview_command(args):
+    import src.features as features
+    import src.osm as osm
+    import src.plots as plots
+    import src.preview as preview
+    import src.tables as tables
+
+    configure(args)
+    if layers_path(args).exists():
+        with open(layers_path(args)) as file:
+            layers = json.load(file)
     else:
-        city_bikes = gpd.read_parquet(data_path / "krakow_bike_paths_extended.parquet")
+        # the point layers are fetched by the preview itself, while it shows the first passes
+        layers = {"boundary": osm.boundaries_download(args.city), "centrum": features.centrum_coords(args.city),
+                  "sync": {}}
+    fetched = [layer for layer in preview.layer_columns if layer not in layers]
 
-    # collect crs for this dataset
-    crs = city_bikes.crs
+    bike_paths_path = args.bike_paths if args.bike_paths is not None else default_bike_paths_path(args.city)
+    preview_path = args.output / f"{table_name(args.city)}_resolution_{args.resolution}_preview.feather"
+    passes = preview.preview_city(args.city, layers, bike_paths_path, features.population_raster_path(args.city),
+                                  args.resolution, args.sample_fraction, args.model_version, args.threads)
 
-    # create boundary points of chosen city for plots
-    city_boundary_cords = osm.boundaries_download(city_name)
+    # each pass overwrites the table and the plot of the previous one
+    for h3_df in passes:
+        tables.write_table(tables.to_arrow(h3_df), preview_path)
+        plots.results_preview_plotter(h3_df, results_predictions_path, args.city)
+        width = (h3_df["prediction_high"] - h3_df["prediction_low"]).mean()
+        estimated = h3_df["estimated_features"].iloc[0] or "none"
+        print(f"Preview after {h3_df['elapsed_seconds'].iloc[0]:.1f}s with estimated {estimated}, "
+              f"mean interval width {width:.1f}")
+    print(f"Saved preview to {preview_path}")
 
-    # create boundary line from points
-    city_boundaries = preprocessing.boundary_from_points(city_boundary_cords, crs)
+    if fetched:
+        layers_path(args).parent.mkdir(parents=True, exist_ok=True)
+        with open(layers_path(args), "w") as file:
+            json.dump(layers, file)
+        print(f"Saved OpenStreetMap layers to {layers_path(args)}")
 
-    if city_name == "Amsterdam":
-        city_bikes = city_bikes[city_bikes.within(Polygon(city_boundaries.loc[0, "geometry"]))]
 
-    # create feature containing count of bike paths in each h3 area
-    h3_bike_paths = features.bike_paths_function(city_bikes, city_boundaries, city_name)
+def history_command(args):
+    import src.history as history
+    import src.tables as tables
+
+    if args.compare is None:
+        for run in history.read_runs(history_path(args)):
+            kind = "keyframe" if run["keyframe"] else f"{run['changed_rows']} changed areas"
+            print(f"run {run['run_id']:>4}  {run['created']}  {run['command']:<8} {run['rows']} areas, {kind}")
+        return
+
+    first_run, second_run = args.compare
+    changes = history.changed_cells(history_path(args), first_run, second_run, args.threshold)
+    changes_path = args.output / f"{table_name(args.city)}_changes_{first_run}_{second_run}.feather"
+    tables.write_table(tables.to_arrow(changes), changes_path)
+    print(changes.drop(columns="geometry").head(args.top).to_string(index=False))
+    print(f"{len(changes)} h3 areas changed by more than {args.threshold}, saved to {changes_path}")
+
+
+def tiles_command(args):
+    import src.tables as tables
+    import src.tiles as tiles
+
+    table = tables.read_table(predictions_path(args))
+    predictions = tables.to_geodataframe(table, [column for column in table.column_names if column != "geometry"])
+    tiles_path(args).parent.mkdir(parents=True, exist_ok=True)
+    if args.format == "mbtiles":
+        tiles.export_mbtiles(predictions, tiles_path(args), args.min_zoom, args.max_zoom, args.workers)
+    else:
+        tiles.export_directory(predictions, tiles_path(args), args.min_zoom, args.max_zoom, args.workers,
+                               args.base_url)
+    print(f"Saved vector tiles to {tiles_path(args)}")
+
 
-    # create feature containing count of green areas in each h3 area
-    h3_green_areas = features.green_areas_function(city_boundaries, crs, city_name)
+def serve_command(args):
+    import src.service as service
+
+    service.serve(args.output, args.host, args.port, args.workers, args.overpass_url)
+
+
+def run_command(args):
+    fetch_command(args)
+    features_command(args)
+    predict_command(args)
+    plot_command(args)
+
+
+def parse_args(argv=None):
+    """
+        Parses the command line arguments.
+
+        Parameters:
+        - argv (list, optional): Arguments to parse, sys.argv by default.
+
+        Returns:
+        - args (argparse.Namespace): Parsed arguments with the command function in args.command.
+        """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--city", default="Kraków", help="name of the city (default: %(default)s)")
+    common.add_argument("--resolution", type=int, default=7, help="h3 resolution of the areas (default: %(default)s)")
+    common.add_argument("--output", type=Path, default=Path.cwd(),
+                        help="directory for feature tables, predictions and RESULTS plots (default: current directory)")
+    common.add_argument("--overpass-url", default="http://overpass-api.de/api/interpreter",
+                        help="Overpass API interpreter used to fetch OpenStreetMap layers (default: %(default)s)")
 
-    # merge bike paths dataframe with green areas dataframe
-    h3_bike_paths= pd.merge(h3_bike_paths,
-                                       h3_green_areas[['h3_index', "green_areas_count"]],
-                                       on='h3_index',
-                                       how='left')
+    pipeline = argparse.ArgumentParser(add_help=False)
+    pipeline.add_argument("--bike-paths", type=Path, default=None,
+                          help="GeoParquet file with bike paths, may cover a whole country (default: file of the city in DATA)")
 
-    # create feature containing count of buildings points in each h3 area
-    h3_buildings = features.buildings_function(city_boundaries, crs, city_name)
+    stages = argparse.ArgumentParser(add_help=False)
+    stages.add_argument("--stage-workers", type=int, default=None,
+                        help="threads running independent pipeline stages (default: as many as Python uses)")
+    stages.add_argument("--restart", action="store_true",
+                        help="discard checkpoints of a failed run instead of resuming it")
 
-    # merge bike paths dataframe with buildings dataframe
-    h3_bike_paths = pd.merge(h3_bike_paths,
-                                       h3_buildings[['h3_index', "buildings_count"]],
-                                       on='h3_index',
-                                       how='left')
+    plotting = argparse.ArgumentParser(add_help=False)
+    plotting.add_argument("--plot-backend", choices=["vector", "raster"], default="vector",
+                          help="draw geometries as patches, or aggregate them into images for large layers "
+                               "(default: %(default)s)")
 
-    # create feature containing count of population in each h3 area
-    h3_bike_paths = features.population_function(h3_bike_paths, city_name)
+    model = argparse.ArgumentParser(add_help=False)
+    model.add_argument("--model-version", default=None, help="model version in models_best (default: latest)")
+    model.add_argument("--threads", type=int, default=None, help="prediction threads (default: all cores)")
 
-    # create feature containing count of recreational areas (shops, schools, sport centers) in each h3 area
-    h3_recreational_areas = features.recreational_areas_function(city_boundaries, crs, city_name)
+    explain = argparse.ArgumentParser(add_help=False)
+    explain.add_argument("--explain", action="store_true", help="add per-area feature contributions")
 
-    # merge bike paths dataframe with buildings dataframe
-    h3_bike_paths = pd.merge(h3_bike_paths,
-                                       h3_recreational_areas[['h3_index', "recreational_areas_count"]],
-                                       on='h3_index', how='left')
+    preview = argparse.ArgumentParser(add_help=False)
+    preview.add_argument("--sample-fraction", type=float, default=0.05,
+                         help="fraction of each layer used by the first pass, before the full layers arrive "
+                              "(default: %(default)s)")
 
-    # create feature containing distance from h3 area to city center
-    h3_bike_paths = features.centrum_distance_function(h3_bike_paths, city_name)
+    history = argparse.ArgumentParser(add_help=False)
+    history.add_argument("--compare", type=int, nargs=2, metavar=("FIRST_RUN", "SECOND_RUN"), default=None,
+                         help="list h3 areas whose prediction changed between two runs (default: list the runs)")
+    history.add_argument("--threshold", type=float, default=1.0,
+                         help="minimal absolute change of the prediction (default: %(default)s)")
+    history.add_argument("--top", type=int, default=20, help="number of the largest changes printed (default: %(default)s)")
 
-    return h3_bike_paths
+    tiles = argparse.ArgumentParser(add_help=False)
+    tiles.add_argument("--format", choices=["mbtiles", "directory"], default="mbtiles",
+                       help="single MBTiles file or a directory of {z}/{x}/{y}.pbf tiles (default: %(default)s)")
+    tiles.add_argument("--min-zoom", type=int, default=6, help="lowest zoom level (default: %(default)s)")
+    tiles.add_argument("--max-zoom", type=int, default=14, help="highest zoom level (default: %(default)s)")
+    tiles.add_argument("--workers", type=int, default=None, help="tile worker processes (default: all cores)")
+    tiles.add_argument("--base-url", default="http://localhost:8000",
+                       help="URL serving the tiles directory, written to tiles.json (default: %(default)s)")
 
+    serve = argparse.ArgumentParser(add_help=False)
+    serve.add_argument("--host", default="127.0.0.1", help="address of the HTTP API (default: %(default)s)")
+    serve.add_argument("--port", type=int, default=8080, help="port of the HTTP API (default: %(default)s)")
+    serve.add_argument("--workers", type=int, default=2, help="worker processes running jobs (default: %(default)s)")
 
-def main():
-    #amsterdam_dataset = city_pipeline("Amsterdam")
-    #amsterdam_dataset.to_csv("Amsterdam.csv")
+    parser = argparse.ArgumentParser(description="Predicts the number of bike paths needed in each h3 area of a city.")
+    subparsers = parser.add_subparsers(required=True)
+    commands = [("fetch", fetch_command, [common], "fetch OpenStreetMap layers of the city"),
+                ("features", features_command, [common, pipeline, stages, plotting], "calculate the feature table of the city"),
+                ("predict", predict_command, [common, model, explain], "predict bike paths from the cached feature table"),
+                ("refresh", refresh_command, [common, model],
+                 "update cached layers, features and predictions with OpenStreetMap changes since the last fetch"),
+                ("preview", preview_command, [common, pipeline, plotting, model, preview],
+                 "show an approximate prediction at once and refine it as the full layers arrive"),
+                ("plot", plot_command, [common, plotting], "plot cached predictions"),
+                ("history", history_command, [common, history],
+                 "list recorded prediction runs, or the h3 areas whose prediction changed between two of them"),
+                ("tiles", tiles_command, [common, tiles], "export cached predictions as vector tiles"),
+                ("serve", serve_command, [common, serve], "serve a queue of scoring jobs over HTTP"),
+                ("run", run_command, [common, pipeline, stages, plotting, model, explain], "fetch, calculate features, predict and plot")]
+    for name, command, parents, help_text in commands:
+        subparser = subparsers.add_parser(name, parents=parents, help=help_text)
+        subparser.set_defaults(command=command)
 
-    krakow_dataset = city_pipeline("Kraków")
-    krakow_dataset.to_csv("Krakow.csv")
+    return parser.parse_args(argv)
 
-    krakow_predictions_df = modelling.krakow_prediction(krakow_dataset)
 
-    plots.results_h3_count_bike_path_plotter(krakow_predictions_df, results_predictions_path, "Kraków")
-    plots.results_h3_difference_bike_path_plotter(krakow_predictions_df, results_predictions_path, "Kraków")
+def main(argv=None):
+    args = parse_args(argv)
+    args.command(args)
 
 
 if __name__ == "__main__":
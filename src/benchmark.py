@@ -0,0 +1,238 @@
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import joblib
+import numpy as np
+import pandas as pd
+import src.modelling as modelling
+import src.tables as tables
+
+# maximal cold start import time in seconds of the predict command on a cached feature table
+import_budget_seconds = 3.0
+
+
+def best_time(function, repeats):
+    """
+    Measures the shortest wall-clock time of several calls of a function.
+
+    Parameters:
+    - function (callable): Function called without arguments.
+    - repeats (int): Number of calls.
+
+    Returns:
+    - seconds (float): Shortest time of a single call in seconds.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def model_io_benchmark(n_rows=200_000, nthread=None, repeats=5, pickle_path=modelling.models_path / "model.pkl"):
+    """
+    Compares load time and prediction throughput of the pickled model with the native XGBoost format.
+
+    This function performs the following steps:
+    1. Exports the pickled model into the native format in a temporary models directory.
+    2. Measures the time of loading the pickle and the native model.
+    3. Measures rows per second of the pickle path (scale_data DataFrame and model.predict)
+       and of the native path (float32 array and inplace_predict) on random feature rows.
+
+    Parameters:
+    - n_rows (int): Number of feature rows to predict.
+    - nthread (int, optional): Number of threads for the native prediction, all cores by default.
+    - repeats (int): Number of repetitions, the fastest one is reported.
+    - pickle_path (Path): Path to the pickled model.
+
+    Returns:
+    - results (pd.DataFrame): Load time in seconds and rows per second for both formats.
+    """
+    rng = np.random.default_rng(0)
+    dataset = pd.DataFrame(rng.gamma(2.0, 50.0, size=(n_rows, len(modelling.model_features))),
+                           columns=modelling.model_features)
+
+    models_path = modelling.models_path
+    modelling.models_path = Path(tempfile.mkdtemp())
+    try:
+        version = modelling.export_native_model(pickle_path).name
+
+        pickle_load = best_time(lambda: joblib.load(pickle_path), repeats)
+        native_load = best_time(lambda: modelling.load_model_artifact(version, nthread), repeats)
+
+        model = joblib.load(pickle_path)
+        artifact = modelling.load_model_artifact(version, nthread)
+        pickle_predict = best_time(lambda: model.predict(modelling.scale_data(dataset)), repeats)
+        native_predict = best_time(lambda: modelling.predict(dataset, artifact), repeats)
+    finally:
+        shutil.rmtree(modelling.models_path)
+        modelling.models_path = models_path
+
+    return pd.DataFrame({"format": ["pickle", "native"],
+                         "load_seconds": [pickle_load, native_load],
+                         "rows_per_second": [n_rows / pickle_predict, n_rows / native_predict]})
+
+
+def random_feature_table(rings, resolution):
+    """
+    Creates a feature table of H3 hexagons around Kraków with random feature values.
+
+    Parameters:
+    - rings (int): Number of H3 rings around the center, the table has 3 * rings * (rings + 1) + 1 rows.
+    - resolution (int): H3 resolution of the hexagons.
+
+    Returns:
+    - h3_df (gpd.GeoDataFrame): Feature table with h3_index, bike_paths_count, the model features and geometry.
+    """
+    import geopandas as gpd
+    import h3
+    from shapely.geometry import Polygon
+
+    rng = np.random.default_rng(0)
+    cells = list(h3.k_ring(h3.geo_to_h3(50.0617, 19.9372, resolution), rings))
+    h3_df = gpd.GeoDataFrame({"h3_index": cells, "bike_paths_count": rng.poisson(5, len(cells))},
+                             geometry=[Polygon(h3.h3_to_geo_boundary(x, geo_json=True)) for x in cells],
+                             crs="EPSG:4326")
+    for feature in modelling.model_features:
+        h3_df[feature] = rng.gamma(2.0, 50.0, len(cells))
+    return h3_df
+
+
+def feature_table_benchmark(rings=60, resolution=9, repeats=3):
+    """
+    Compares memory and serialization time of feature tables stored as CSV and as Arrow (Feather) files.
+
+    This function performs the following steps:
+    1. Creates a feature table of H3 hexagons around Kraków with random feature values.
+    2. Measures writing the table as CSV with WKT geometries, and as Feather with GeoArrow geometries.
+    3. Measures reading both files back into a GeoDataFrame.
+    4. Measures reading only the model features, as the predict command does.
+    5. Compares file sizes and in-memory sizes of the feature columns in pandas and in Arrow.
+
+    Parameters:
+    - rings (int): Number of H3 rings around the center, the table has 3 * rings * (rings + 1) + 1 rows.
+    - resolution (int): H3 resolution of the hexagons.
+    - repeats (int): Number of repetitions, the fastest one is reported.
+
+    Returns:
+    - results (pd.DataFrame): Times in seconds and sizes in megabytes for both formats.
+    """
+    import geopandas as gpd
+
+    h3_df = random_feature_table(rings, resolution)
+    directory = Path(tempfile.mkdtemp())
+    csv_path, feather_path = directory / "features.csv", directory / "features.feather"
+    try:
+        def read_csv(columns=None):
+            if columns is not None:
+                return pd.read_csv(csv_path, usecols=columns)
+            df = pd.read_csv(csv_path, index_col=0)
+            return gpd.GeoDataFrame(df, geometry=gpd.GeoSeries.from_wkt(df["geometry"]), crs="EPSG:4326")
+
+        csv_write = best_time(lambda: h3_df.to_csv(csv_path), repeats)
+        feather_write = best_time(lambda: tables.write_table(tables.to_arrow(h3_df), feather_path), repeats)
+        csv_read = best_time(read_csv, repeats)
+        feather_read = best_time(lambda: tables.to_geodataframe(tables.read_table(feather_path)), repeats)
+        csv_features = best_time(lambda: read_csv(modelling.model_features), repeats)
+        feather_features = best_time(lambda: tables.read_table(feather_path, modelling.model_features).to_pandas(),
+                                     repeats)
+        file_sizes = [csv_path.stat().st_size / 1e6, feather_path.stat().st_size / 1e6]
+        # geometries are left out, as memory of shapely objects is not visible to pandas
+        memory_sizes = [h3_df.drop(columns="geometry").memory_usage(deep=True).sum() / 1e6,
+                        tables.to_arrow(h3_df).drop_columns("geometry").nbytes / 1e6]
+    finally:
+        shutil.rmtree(directory)
+
+    return pd.DataFrame({"format": ["csv", "feather"],
+                         "write_seconds": [csv_write, feather_write],
+                         "read_seconds": [csv_read, feather_read],
+                         "read_features_seconds": [csv_features, feather_features],
+                         "file_mb": file_sizes,
+                         "features_memory_mb": memory_sizes})
+
+
+def import_time_report(arguments, top=15):
+    """
+    Measures the cold start import time of a Python command with python -X importtime.
+
+    Imports made while the command runs, e.g. inside a function, are measured as well.
+
+    Parameters:
+    - arguments (list): Arguments of the fresh interpreter, e.g. a script and its arguments.
+    - top (int): Number of the slowest top-level imports reported.
+
+    Returns:
+    - total_seconds (float): Cumulative import time of all top-level imports.
+    - report (pd.DataFrame): Slowest top-level imports with their cumulative time in seconds.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", *arguments],
+                            capture_output=True, text=True, cwd=Path.cwd(), check=True)
+
+    # lines look like "import time:  self [us] | cumulative | <indentation>package",
+    # where modules imported directly by the command have no indentation
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, package = line.split("|", 2)
+        if not package[1:].startswith(" "):
+            imports.append({"module": package.strip(), "seconds": int(cumulative) / 1e6})
+
+    report = pd.DataFrame(imports, columns=["module", "seconds"])
+    return report["seconds"].sum(), report.nlargest(top, "seconds").reset_index(drop=True)
+
+
+def predict_import_time(top=15, rings=3):
+    """
+    Measures the cold start import time of the predict command of run.py on a small cached feature table.
+
+    The whole command runs, so the imports of loading the model (xgboost) and of recording the run
+    (src.history) are measured together with those of starting it. The table and the predictions
+    are written to a temporary directory, the model is the latest one in models_best.
+
+    Parameters:
+    - top (int): Number of the slowest top-level imports reported.
+    - rings (int): Number of H3 rings of the cached feature table.
+
+    Returns:
+    - total_seconds (float): Cumulative import time of all top-level imports.
+    - report (pd.DataFrame): Slowest top-level imports with their cumulative time in seconds.
+    """
+    directory = Path(tempfile.mkdtemp())
+    try:
+        tables.write_table(tables.to_arrow(random_feature_table(rings, 7)), directory / "Krakow_resolution_7.feather")
+        return import_time_report([str(Path.cwd() / "run.py"), "predict", "--city", "Kraków", "--resolution", "7",
+                                   "--output", str(directory)], top)
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_import_budget(budget_seconds=import_budget_seconds):
+    """
+    Checks that the cold start import time of the predict command stays under a fixed budget.
+
+    Parameters:
+    - budget_seconds (float): Maximal allowed import time in seconds.
+
+    Returns:
+    - within_budget (bool): True if the import time is under the budget.
+    """
+    total_seconds, report = predict_import_time()
+    print(report.to_string(index=False))
+    print(f"Total import time: {total_seconds:.3f}s (budget {budget_seconds:.3f}s)")
+    return total_seconds <= budget_seconds
+
+
+def main():
+    print(model_io_benchmark().to_string(index=False))
+    print(feature_table_benchmark().to_string(index=False))
+    if not check_import_budget():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
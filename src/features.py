@@ -1,7 +1,10 @@
+import threading
+import src.geoparquet as geoparquet
 import src.plots as plots
 from pathlib import Path
 import src.preprocessing as preprocessing
 import src.osm as osm
+import src.routing as routing
 
 data_path = Path.cwd() / "DATA"
 results_path = Path.cwd() / "RESULTS" / "PLOTS"
@@ -9,19 +12,43 @@ results_path = Path.cwd() / "RESULTS" / "PLOTS"
 # resolution for h3 function to ensure, that all h3 indexes are created the same
 h3_resolution = 7
 
+# number of nearest recreational areas over which the network distance is averaged
+n_nearest_amenities = 3
+
+# plots of feature functions running in worker threads of src.pipeline are collected here per thread
+# and drawn later on the main thread, as matplotlib is not thread-safe
+deferred_plots = threading.local()
+
+
+def plot(plotter, *args):
+    """
+        Draws a plot, or collects it if plots of the current thread are deferred.
+
+        Parameters:
+        - plotter (callable): Plotting function of src.plots.
+        - args: Arguments of the plotting function.
+
+        Returns:
+        - None
+        """
+    calls = getattr(deferred_plots, "calls", None)
+    if calls is None:
+        plotter(*args)
+    else:
+        calls.append((plotter, args))
+
 
 def bike_paths_function(city_bikes, city_boundaries, city_name):
     """
         Processes bike path data to create a DataFrame of H3 hexagon areas with the count of bike paths in chosen city.
 
         This function performs the following steps:
-        1. Plots bike paths and city boundaries in chose city.
-        2. Creates H3 indices for the bike path geometries.
-        3. Aggregates the data to create a new DataFrame with the count of bike paths for each H3 hexagon.
-        4. Plots the number of bike paths in each H3 area.
+        1. Counts each path once in every H3 hexagon containing one of its vertices.
+        2. Creates a new DataFrame with the count of bike paths for each H3 hexagon.
 
         Parameters:
-        - city_bikes (gpd.GeoDataFrame): GeoDataFrame containing the bike path geometries in chosen city.
+        - city_bikes (gpd.GeoDataFrame): GeoDataFrame containing the bike path geometries in chosen city,
+          read once by the city_bikes stage of src/pipeline.py for the counts, the network and the plots.
         - city_boundaries (gpd.GeoDataFrame): GeoDataFrame containing the boundary of chosen city.
         - city_name (str): name of the chosen city
 
@@ -32,23 +59,35 @@ def bike_paths_function(city_bikes, city_boundaries, city_name):
             - geometry: Polygon geometry of each H3 hexagon.
         """
 
-    # plot bike paths and city boundaries in chosen city
-    plots.paths_plotter(city_bikes, city_boundaries, results_path, city_name)
-
-    # creating h3_indices for dataframe
-    city_bikes['h3_indices'] = (
-        city_bikes['geometry'].apply(lambda x: preprocessing.get_h3_indices(x, h3_resolution)))
+    # counting paths of all vertices at once, instead of indexing every geometry separately
+    h3_counts = geoparquet.path_h3_counts(city_bikes.geometry.to_numpy(), h3_resolution)
 
     # creating new dataframe with number of bike paths as 'count' parameter and new geometry as h3 polygon
-    h3_city_bikes = preprocessing.dataframe_to_h3_dataframe(city_bikes, "bike_paths_count")
+    return preprocessing.counts_to_h3_dataframe(h3_counts, "bike_paths_count", city_boundaries.crs)
 
-    # plotting number of bike paths in each h3 area
-    plots.h3_count_bike_path_plotter(city_bikes, h3_city_bikes, results_path, city_name)
 
-    return h3_city_bikes
+def bike_paths_plots_function(city_bikes, h3_city_bikes, city_boundaries, city_name):
+    """
+        Plots the bike paths of chosen city and their count in each H3 area.
+
+        Parameters:
+        - city_bikes (gpd.GeoDataFrame): GeoDataFrame containing the bike path geometries in chosen city.
+        - h3_city_bikes (pd.DataFrame): H3 areas with bike path counts returned by bike_paths_function.
+        - city_boundaries (gpd.GeoDataFrame): GeoDataFrame containing the boundary of chosen city.
+        - city_name (str): name of the chosen city
 
+        Returns:
+        - None
+        """
+
+    # plot bike paths and city boundaries in chosen city
+    plot(plots.paths_plotter, city_bikes, city_boundaries, results_path, city_name)
 
-def green_areas_function(city_boundaries, crs, city_name):
+    # plotting number of bike paths in each h3 area
+    plot(plots.h3_count_bike_path_plotter, city_bikes, h3_city_bikes, results_path, city_name)
+
+
+def green_areas_function(city_boundaries, crs, city_name, green_areas_coords=None):
     """
         Processes green area data to create a DataFrame of H3 hexagon areas with the count of green areas in chosen city.
 
@@ -64,6 +103,8 @@ def green_areas_function(city_boundaries, crs, city_name):
         - city_boundaries (gpd.GeoDataFrame): GeoDataFrame containing the boundary of chosen city.
         - crs (str): Coordinate reference system for the GeoDataFrame.
         - city_name (str): name of the chosen city
+        - green_areas_coords (list, optional): already fetched (latitude, longitude) coordinates of
+          green areas. If None, they are fetched from the Overpass API.
 
         Returns:
         - h3_green_areas (pd.DataFrame): A DataFrame containing the following columns:
@@ -72,13 +113,14 @@ def green_areas_function(city_boundaries, crs, city_name):
             - geometry: Polygon geometry of each H3 hexagon.
         """
     # fetching number of green_area points inside city_boundaries
-    green_areas_coords = osm.fetch_green_areas(city_boundaries)
+    if green_areas_coords is None:
+        green_areas_coords = osm.fetch_green_areas(city_boundaries)
 
     # creating geodataframe from green_area_coords variable
     green_areas_dataframe = preprocessing.geodataframe_from_points(green_areas_coords, crs)
 
     # plotting points of green areas in city
-    plots.green_areas_plotter(green_areas_dataframe, city_boundaries, results_path, city_name)
+    plot(plots.green_areas_plotter, green_areas_dataframe, city_boundaries, results_path, city_name)
 
     # creating h3_indices for green_areas_dataframe
     green_areas_dataframe['h3_indices'] = (
@@ -88,12 +130,12 @@ def green_areas_function(city_boundaries, crs, city_name):
     h3_green_areas = preprocessing.dataframe_to_h3_dataframe(green_areas_dataframe, "green_areas_count")
 
     # plotting number of green area points in each h3 area
-    plots.h3_count_green_areas_plotter(green_areas_dataframe, h3_green_areas, results_path, city_name)
+    plot(plots.h3_count_green_areas_plotter, green_areas_dataframe, h3_green_areas, results_path, city_name)
 
     return h3_green_areas
 
 
-def buildings_function(city_boundaries, crs, city_name):
+def buildings_function(city_boundaries, crs, city_name, buildings_coords=None):
     """
         Processes building data to create a DataFrame of H3 hexagon areas with the count of buildings in chosen_city.
 
@@ -109,6 +151,8 @@ def buildings_function(city_boundaries, crs, city_name):
         - city_boundaries (gpd.GeoDataFrame): GeoDataFrame containing the boundary of chosen city.
         - crs (str): Coordinate reference system for the GeoDataFrame.
         - city_name (str): name of the chosen city
+        - buildings_coords (list, optional): already fetched (latitude, longitude) coordinates of
+          buildings. If None, they are fetched from the Overpass API.
 
         Returns:
         - h3_buildings (pd.DataFrame): A DataFrame containing the following columns:
@@ -117,13 +161,14 @@ def buildings_function(city_boundaries, crs, city_name):
             - geometry: Polygon geometry of each H3 hexagon.
         """
     # fetching number of building points in area
-    buildings_coords = osm.fetch_buildings(city_boundaries)
+    if buildings_coords is None:
+        buildings_coords = osm.fetch_buildings(city_boundaries)
 
     # creating geodataframe from buildings_coords variable
     buildings_dataframe = preprocessing.geodataframe_from_points(buildings_coords, crs)
 
     # plotting points of green areas in city
-    plots.buildings_plotter(buildings_dataframe, city_boundaries, results_path, city_name)
+    plot(plots.buildings_plotter, buildings_dataframe, city_boundaries, results_path, city_name)
 
     # creating h3_indices for green_areas_dataframe
     buildings_dataframe['h3_indices'] = (
@@ -133,11 +178,20 @@ def buildings_function(city_boundaries, crs, city_name):
     h3_buildings = preprocessing.dataframe_to_h3_dataframe(buildings_dataframe, "buildings_count")
 
     # plotting number of buildings points in each h3 area
-    plots.h3_count_buildings_plotter(buildings_dataframe, h3_buildings, results_path, city_name)
+    plot(plots.h3_count_buildings_plotter, buildings_dataframe, h3_buildings, results_path, city_name)
 
     return h3_buildings
 
 
+def population_raster_path(city_name):
+    """
+        Returns the path of the WorldPop population raster of chosen city.
+        """
+    if city_name == "Amsterdam":
+        return data_path / "amsterdam_population.tif"
+    return data_path / "krakow_population.tif"
+
+
 def population_function(h3_bikes, city_name):
     """
         Adds population data to the H3 hexagon areas DataFrame and plots the population distribution.
@@ -161,20 +215,17 @@ def population_function(h3_bikes, city_name):
             - geometry: Polygon geometry of each H3 hexagon.
         """
     # fetches population data from worldpop api
-    if city_name == "Amsterdam":
-        populations = osm.fetch_population_data_worldpop(h3_bikes, data_path / "amsterdam_population.tif")
-    else:
-        populations = osm.fetch_population_data_worldpop(h3_bikes, data_path / "krakow_population.tif")
+    populations = osm.fetch_population_data_worldpop(h3_bikes, population_raster_path(city_name))
 
     # add population variable to dataset
     h3_bikes["population"] = populations
 
-    plots.h3_count_population_plotter(h3_bikes, results_path, city_name)
+    plot(plots.h3_count_population_plotter, h3_bikes, results_path, city_name)
 
     return h3_bikes
 
 
-def recreational_areas_function(city_boundaries, crs, city_name):
+def recreational_areas_function(city_boundaries, crs, city_name, recreational_areas_coords=None):
     """
         Adds recreational areas data to the H3 hexagon areas DataFrame and plots the recreational areas distribution.
 
@@ -190,6 +241,8 @@ def recreational_areas_function(city_boundaries, crs, city_name):
         - city_boundaries (gpd.GeoDataFrame): GeoDataFrame containing the boundaries of chosen city.
         - crs (str): Coordinate reference system for the GeoDataFrame.
         - city_name (str): name of the chosen city
+        - recreational_areas_coords (list, optional): already fetched (latitude, longitude) coordinates of
+          recreational areas. If None, they are fetched from the Overpass API.
 
         Returns:
         - h3_recreational_areas (pd.DataFrame): DataFrame containing the count of recreational areas within each H3 area:
@@ -198,13 +251,14 @@ def recreational_areas_function(city_boundaries, crs, city_name):
             - geometry: Polygon geometry of each H3 hexagon.
         """
     # fetching number of recreational points in area
-    recreational_areas_coords = osm.fetch_recreational_areas(city_boundaries)
+    if recreational_areas_coords is None:
+        recreational_areas_coords = osm.fetch_recreational_areas(city_boundaries)
 
     # creating geodataframe from recreational_areas_coords variable
     recreational_areas_dataframe = preprocessing.geodataframe_from_points(recreational_areas_coords, crs)
 
     # plotting points of recreational areas in city
-    plots.recreational_areas_plotter(recreational_areas_dataframe, city_boundaries, results_path, city_name)
+    plot(plots.recreational_areas_plotter, recreational_areas_dataframe, city_boundaries, results_path, city_name)
 
     # creating h3_indices for green_areas_dataframe
     recreational_areas_dataframe['h3_indices'] = (
@@ -215,13 +269,28 @@ def recreational_areas_function(city_boundaries, crs, city_name):
                                                                     "recreational_areas_count")
 
     # plotting number of green area points in each h3 area
-    plots.h3_count_recreational_areas_plotter(recreational_areas_dataframe, h3_recreational_areas, results_path,
-                                              city_name)
+    plot(plots.h3_count_recreational_areas_plotter, recreational_areas_dataframe, h3_recreational_areas,
+         results_path, city_name)
 
     return h3_recreational_areas
 
 
-def centrum_distance_function(h3_bikes, city_name):
+def centrum_coords(city_name):
+    """
+        Fetches the coordinates of the chosen city center (centrum).
+
+        Parameters:
+        - city_name (str): name of the chosen city
+
+        Returns:
+        - central_cords (list): Coordinates of the city center as (longitude, latitude).
+        """
+    if city_name == "Amsterdam":
+        return osm.boundaries_download("Amsterdam centrum")
+    return osm.boundaries_download("Kraków rynek")
+
+
+def centrum_distance_function(h3_bikes, city_name, central_cords=None):
     """
         Adds distance to the city center (centrum) for each H3 hexagon area in chosen city.
 
@@ -234,6 +303,7 @@ def centrum_distance_function(h3_bikes, city_name):
         Parameters:
         - h3_city_bikes (pd.DataFrame): DataFrame containing H3 hexagon areas in chosen city and associated data.
         - city_name (str): name of the chosen city
+        - central_cords (list, optional): already fetched coordinates of the city center. If None, they are fetched.
 
         Returns:
         - h3_bikes (pd.DataFrame): Updated DataFrame with the distance to the city center added:
@@ -241,15 +311,61 @@ def centrum_distance_function(h3_bikes, city_name):
             - distance_to_centrum: Distance from the H3 hexagon to the city center.
             - other columns from the original DataFrame.
         """
-    # fetching coordinates of amsterdam centrum point
-    if city_name == "Amsterdam":
-        central_cords = osm.boundaries_download("Amsterdam centrum")
-    else:
-        central_cords = osm.boundaries_download("Kraków rynek")
+    # fetching coordinates of chosen city centrum point
+    if central_cords is None:
+        central_cords = centrum_coords(city_name)
 
     # get distance from each h3 area to centrum
     h3_bikes = preprocessing.get_distance_to_centrum(h3_bikes, central_cords)
 
-    plots.distance_to_centrum_plotter(h3_bikes, central_cords, results_path, city_name)
+    plot(plots.distance_to_centrum_plotter, h3_bikes, central_cords, results_path, city_name)
+
+    return h3_bikes
+
+
+def network_distance_function(h3_bikes, city_bikes, recreational_areas_coords, city_name, central_cords=None):
+    """
+        Adds distances along the bike path network to the city center and to the nearest recreational areas.
+
+        This function performs the following steps:
+        1. Builds a sparse graph from the bike paths, or loads it from the cache if it was built before.
+        2. Snaps the centroid of each H3 hexagon area, the city center and the recreational areas to the graph.
+        3. Calculates the network distance from each H3 hexagon area to the city center.
+        4. Calculates the mean network distance from each H3 hexagon area to its nearest recreational areas.
+        5. Plots the network distances to the city center for visualization.
+
+        Parameters:
+        - h3_bikes (pd.DataFrame): DataFrame containing H3 hexagon areas in chosen city and associated data.
+        - city_bikes (gpd.GeoDataFrame): GeoDataFrame containing the bike path geometries in chosen city.
+        - recreational_areas_coords (list): (latitude, longitude) coordinates of recreational areas.
+        - city_name (str): name of the chosen city
+        - central_cords (list, optional): already fetched coordinates of the city center. If None, they are fetched.
+
+        Returns:
+        - h3_bikes (pd.DataFrame): Updated DataFrame with the network distances added:
+            - network_distance_to_centrum: Distance along bike paths from the H3 hexagon to the city center.
+            - network_distance_to_recreational_areas: Mean distance along bike paths from the H3 hexagon
+              to its nearest recreational areas.
+            - other columns from the original DataFrame.
+        """
+    # fetching coordinates of chosen city centrum point
+    if central_cords is None:
+        central_cords = centrum_coords(city_name)
+
+    # building graph of bike paths, cached under the hash of the paths
+    graph = routing.get_graph(city_bikes.geometry)
+
+    # collecting centroids of h3 areas as (longitude, latitude)
+    centroids = h3_bikes["geometry"].apply(lambda x: x.centroid)
+    centroids = [(point.x, point.y) for point in centroids]
+
+    h3_bikes["network_distance_to_centrum"] = routing.network_distance_to_point(graph, centroids, central_cords)
+
+    # recreational areas are fetched as (latitude, longitude) pairs
+    amenities = [(lon, lat) for lat, lon in recreational_areas_coords]
+    h3_bikes["network_distance_to_recreational_areas"] = routing.network_distance_to_nearest(
+        graph, centroids, amenities, n_nearest_amenities)
+
+    plot(plots.network_distance_to_centrum_plotter, h3_bikes, central_cords, results_path, city_name)
 
     return h3_bikes
@@ -0,0 +1,217 @@
+import json
+from collections import Counter
+import geopandas as gpd
+import h3
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import shapely
+from pyproj import CRS
+
+# number of rows decoded at once when streaming a GeoParquet file
+batch_size = 65536
+
+
+def geo_metadata(parquet_file):
+    """
+    Reads the GeoParquet metadata of the primary geometry column.
+
+    Parameters:
+    - parquet_file (pq.ParquetFile): Opened GeoParquet file.
+
+    Returns:
+    - column_name (str): Name of the primary geometry column.
+    - column_metadata (dict): GeoParquet metadata of that column (encoding, bbox, covering, crs).
+    """
+    metadata = json.loads(parquet_file.schema_arrow.metadata[b"geo"])
+    column_name = metadata["primary_column"]
+    return column_name, metadata["columns"][column_name]
+
+
+def read_crs(path):
+    """
+    Reads the coordinate reference system of a GeoParquet file without reading its data.
+
+    Parameters:
+    - path (Path): Path to the GeoParquet file.
+
+    Returns:
+    - crs (pyproj.CRS): CRS of the primary geometry column, EPSG:4326 if none is stored, as in the specification.
+    """
+    _, column_metadata = geo_metadata(pq.ParquetFile(path))
+    if column_metadata.get("crs") is None:
+        return CRS.from_epsg(4326)
+    return CRS.from_json_dict(column_metadata["crs"])
+
+
+def bboxes_intersect(first, second):
+    """
+    Checks if two (minx, miny, maxx, maxy) bounding boxes intersect.
+    """
+    return first[0] <= second[2] and first[2] >= second[0] and first[1] <= second[3] and first[3] >= second[1]
+
+
+def column_statistics(row_group, column_path):
+    """
+    Returns (min, max) statistics of a column in a row group, or None if they are not stored.
+    """
+    for i in range(row_group.num_columns):
+        column = row_group.column(i)
+        if column.path_in_schema == column_path and column.is_stats_set and column.statistics.has_min_max:
+            return column.statistics.min, column.statistics.max
+    return None
+
+
+def select_row_groups(parquet_file, covering, bbox):
+    """
+    Selects the row groups of a GeoParquet file which may contain geometries intersecting the bbox.
+
+    Row groups are skipped using the min/max statistics of the bbox covering columns
+    (GeoParquet 1.1), without reading any of their data.
+
+    Parameters:
+    - parquet_file (pq.ParquetFile): Opened GeoParquet file.
+    - covering (dict): Covering of the geometry column, e.g. {"xmin": ["bbox", "xmin"], ...}.
+    - bbox (tuple): Bounding box (minx, miny, maxx, maxy).
+
+    Returns:
+    - row_groups (list): Positions of the selected row groups.
+    """
+    row_groups = []
+    for i in range(parquet_file.metadata.num_row_groups):
+        row_group = parquet_file.metadata.row_group(i)
+        statistics = {key: column_statistics(row_group, ".".join(covering[key]))
+                      for key in ("xmin", "ymin", "xmax", "ymax")}
+        if any(value is None for value in statistics.values()):
+            row_groups.append(i)
+            continue
+        # smallest possible minimums and largest possible maximums of geometries in the row group
+        group_bbox = (statistics["xmin"][0], statistics["ymin"][0], statistics["xmax"][1], statistics["ymax"][1])
+        if bboxes_intersect(group_bbox, bbox):
+            row_groups.append(i)
+    return row_groups
+
+
+def iter_geoparquet(path, bbox=None, columns=None):
+    """
+    Streams a GeoParquet file as GeoDataFrame batches, reading only the needed columns and rows.
+
+    This function performs the following steps:
+    1. Skips the whole file if its bbox from the GeoParquet metadata does not intersect the bbox.
+    2. Skips row groups using the statistics of the bbox covering columns, if the file has them.
+    3. Reads the remaining row groups in batches with only the requested columns.
+    4. Keeps the rows whose geometry bounding box intersects the bbox, using the covering columns
+       or, if the file has none, the bounds of the decoded geometries.
+
+    Parameters:
+    - path (Path): Path to the GeoParquet file.
+    - bbox (tuple, optional): Bounding box (minx, miny, maxx, maxy) in the CRS of the file.
+    - columns (list, optional): Attribute columns to read besides the geometry, none by default.
+
+    Returns:
+    - batches (generator): GeoDataFrames with the geometry and requested columns of the matching rows.
+    """
+    parquet_file = pq.ParquetFile(path)
+    geometry_column, column_metadata = geo_metadata(parquet_file)
+    crs = read_crs(path)
+    covering = column_metadata.get("covering", {}).get("bbox")
+    columns = list(columns or [])
+
+    row_groups = list(range(parquet_file.metadata.num_row_groups))
+    if bbox is not None:
+        if "bbox" in column_metadata and not bboxes_intersect(column_metadata["bbox"], bbox):
+            return
+        if covering is not None:
+            row_groups = select_row_groups(parquet_file, covering, bbox)
+    if not row_groups:
+        return
+
+    read_columns = columns + [geometry_column]
+    if bbox is not None and covering is not None:
+        read_columns.append(covering["xmin"][0])
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups,
+                                           columns=list(dict.fromkeys(read_columns))):
+        if bbox is not None and covering is not None:
+            # filtering on the covering columns before any geometry is decoded
+            boxes = batch.column(covering["xmin"][0])
+            mask = pc.and_(pc.and_(pc.less_equal(pc.struct_field(boxes, covering["xmin"][1]), bbox[2]),
+                                   pc.greater_equal(pc.struct_field(boxes, covering["xmax"][1]), bbox[0])),
+                           pc.and_(pc.less_equal(pc.struct_field(boxes, covering["ymin"][1]), bbox[3]),
+                                   pc.greater_equal(pc.struct_field(boxes, covering["ymax"][1]), bbox[1])))
+            batch = batch.filter(mask)
+
+        geometries = shapely.from_wkb(batch.column(geometry_column).to_numpy(zero_copy_only=False))
+        if bbox is not None and covering is None:
+            bounds = shapely.bounds(geometries)
+            mask = ((bounds[:, 0] <= bbox[2]) & (bounds[:, 2] >= bbox[0]) &
+                    (bounds[:, 1] <= bbox[3]) & (bounds[:, 3] >= bbox[1]))
+            geometries = geometries[mask]
+            batch = batch.filter(mask)
+
+        if len(geometries) == 0:
+            continue
+        yield gpd.GeoDataFrame(batch.select(columns).to_pandas(), geometry=geometries, crs=crs)
+
+
+def read_geoparquet(path, bbox=None, columns=None):
+    """
+    Reads the rows of a GeoParquet file intersecting a bounding box into a single GeoDataFrame.
+
+    Parameters:
+    - path (Path): Path to the GeoParquet file.
+    - bbox (tuple, optional): Bounding box (minx, miny, maxx, maxy) in the CRS of the file.
+    - columns (list, optional): Attribute columns to read besides the geometry, none by default.
+
+    Returns:
+    - gdf (gpd.GeoDataFrame): Matching rows with the geometry and the requested columns.
+    """
+    batches = list(iter_geoparquet(path, bbox, columns))
+    if not batches:
+        return gpd.GeoDataFrame({column: [] for column in columns or []}, geometry=[], crs=read_crs(path))
+    return gpd.GeoDataFrame(pd.concat(batches, ignore_index=True), crs=batches[0].crs)
+
+
+def path_h3_counts(geometries, resolution):
+    """
+    Counts paths in each H3 area, once in each H3 area containing at least one of their vertices.
+
+    This is the same as in scenarios.scenario_cells.
+
+    Parameters:
+    - geometries (np.ndarray): Path geometries in EPSG:4326.
+    - resolution (int): H3 resolution.
+
+    Returns:
+    - h3_counts (Counter): Number of paths in each H3 index.
+    """
+    coords, path_ids = shapely.get_coordinates(geometries, return_index=True)
+    cells = np.asarray([h3.geo_to_h3(lat, lon, resolution) for lon, lat in coords])
+    # a path counts once in each h3 area, no matter how many of its vertices lie there
+    unique_pairs = np.unique(np.rec.fromarrays([path_ids, cells]))
+    return Counter(unique_pairs.f1.tolist())
+
+
+def h3_counts_from_geoparquet(path, resolution, bbox=None, within=None):
+    """
+    Counts the paths of a GeoParquet file in each H3 area while streaming it batch by batch.
+
+    A path counts once in each H3 area containing at least one of its vertices, see path_h3_counts.
+    Only one batch of geometries is held in memory, so files much larger than the memory can be counted.
+
+    Parameters:
+    - path (Path): Path to the GeoParquet file with geometries in EPSG:4326.
+    - resolution (int): H3 resolution.
+    - bbox (tuple, optional): Bounding box (minx, miny, maxx, maxy) of the area of interest.
+    - within (Polygon, optional): Only paths lying within this polygon are counted.
+
+    Returns:
+    - h3_counts (Counter): Number of paths in each H3 index.
+    """
+    h3_counts = Counter()
+    for batch in iter_geoparquet(path, bbox):
+        if within is not None:
+            batch = batch[batch.within(within)]
+        h3_counts.update(path_h3_counts(batch.geometry.to_numpy(), resolution))
+    return h3_counts
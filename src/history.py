@@ -0,0 +1,286 @@
+import json
+import time
+import h3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+# number of runs after which a full snapshot is stored again, so a run is rebuilt from at most this many files
+keyframe_interval = 10
+
+# boolean column of delta files marking H3 areas which are no longer in the snapshot
+removed_column = "removed"
+
+# stored text value of a missing one, as nulls in deltas mean that the value did not change
+missing_text = ""
+
+# history files are written once and read column by column, so they are compressed
+compression = "zstd"
+
+
+def read_runs(history_path):
+    """
+    Reads the list of runs stored in a history directory.
+
+    Parameters:
+    - history_path (Path): History directory of a city and resolution.
+
+    Returns:
+    - runs (list): Dicts with run_id, created, keyframe, file, rows and changed_rows of each run, and the
+      metadata given when it was appended, ordered by run_id.
+    """
+    runs_path = history_path / "runs.json"
+    if not runs_path.exists():
+        return []
+    with open(runs_path) as file:
+        return json.load(file)
+
+
+def write_runs(history_path, runs):
+    temporary_path = history_path / "runs.json.tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(runs, file, indent=1)
+    temporary_path.replace(history_path / "runs.json")
+
+
+def find_run(runs, run_id):
+    for position, run in enumerate(runs):
+        if run["run_id"] == run_id:
+            return position
+    raise KeyError(f"Run {run_id} is not in the history")
+
+
+def snapshot_frame(table):
+    """
+    Converts an Arrow predictions table into a snapshot DataFrame indexed by uint64 H3 indices.
+
+    Geometries are left out, as they follow from the H3 indices. Numbers are rounded to float32, the precision
+    of the history files, so a run is compared with the stored previous run and unchanged values are equal.
+    """
+    columns = [column for column in table.column_names if column not in ("h3_index", "geometry")]
+    # integer counts are compared and stored as floats, so areas without a counted element stay missing values
+    frame = pd.DataFrame({column: table[column].to_pandas().to_numpy(dtype=np.float32)
+                          if pa.types.is_floating(table[column].type) or pa.types.is_integer(table[column].type)
+                          else table[column].to_pandas().astype(object) for column in columns})
+    frame.index = pd.Index(table["h3_index"].to_numpy(), name="h3_index")
+    return frame.sort_index()
+
+
+def changed_mask(previous, current):
+    """
+    Compares two aligned columns, where missing values in both are equal.
+    """
+    previous, current = pd.Series(previous), pd.Series(current)
+    return ~((previous == current) | (previous.isna() & current.isna())).to_numpy()
+
+
+def arrow_values(values, valid):
+    """
+    Converts the values of a delta column into an Arrow array, with nulls where the value did not change.
+    Missing numbers are stored as NaN and missing text values as missing_text.
+    """
+    if pd.api.types.is_float_dtype(values.dtype):
+        return pa.array(values.to_numpy(dtype=np.float32), mask=~valid)
+    return pa.array([None if not keep else missing_text if pd.isna(value) else value
+                     for value, keep in zip(values, valid)], type=pa.string())
+
+
+def column_values(array):
+    """
+    Converts a column of a history file into a numpy array, with missing text values as None.
+    """
+    values = array.to_numpy(zero_copy_only=False)
+    if pa.types.is_string(array.type):
+        values[values == missing_text] = None
+    return values
+
+
+def delta_table(previous, current):
+    """
+    Encodes a snapshot as the changes against the previous one.
+
+    Only rows of H3 areas which were added, removed or have any changed value are stored. Each column
+    holds the new value where it changed and null where it did not, so unchanged values take no space
+    after compression, and a query reading one column only sees the changes of that column.
+
+    Parameters:
+    - previous (pd.DataFrame): Previous snapshot indexed by H3 index.
+    - current (pd.DataFrame): Current snapshot with the same columns.
+
+    Returns:
+    - table (pa.Table): Arrow table with h3_index, the removed flag and the changed values.
+    """
+    removed = previous.index.difference(current.index)
+    common = current.index.intersection(previous.index)
+    changed = np.zeros(len(common), dtype=bool)
+    column_changes = {}
+    for column in current.columns:
+        column_changes[column] = changed_mask(previous.loc[common, column].to_numpy(),
+                                              current.loc[common, column].to_numpy())
+        changed |= column_changes[column]
+
+    added = current.index.difference(previous.index)
+    rows = common[changed].append(added)
+    arrays = {"h3_index": pa.array(np.concatenate([rows.to_numpy(dtype=np.uint64), removed.to_numpy(dtype=np.uint64)])),
+              removed_column: pa.array(np.r_[np.zeros(len(rows), dtype=bool), np.ones(len(removed), dtype=bool)])}
+    for column in current.columns:
+        # added areas have all their values stored, removed areas none
+        valid = np.r_[column_changes[column][changed], np.ones(len(added), dtype=bool), np.zeros(len(removed), dtype=bool)]
+        values = pd.concat([current.loc[rows, column], pd.Series([None] * len(removed), dtype=current[column].dtype)])
+        arrays[column] = arrow_values(values, valid)
+    return pa.table(arrays)
+
+
+def keyframe_table(current):
+    """
+    Encodes a full snapshot.
+    """
+    arrays = {"h3_index": pa.array(current.index.to_numpy(dtype=np.uint64))}
+    for column in current.columns:
+        arrays[column] = arrow_values(current[column], np.ones(len(current), dtype=bool))
+    return pa.table(arrays)
+
+
+def read_delta(history_path, run, columns):
+    return feather.read_table(history_path / run["file"], columns=["h3_index", removed_column, *columns])
+
+
+def apply_delta(state, delta):
+    """
+    Applies a delta table to a snapshot, reading only its valid values.
+
+    Parameters:
+    - state (pd.DataFrame): Snapshot indexed by H3 index.
+    - delta (pa.Table): Delta table written by delta_table, with a subset of the snapshot columns.
+
+    Returns:
+    - state (pd.DataFrame): Snapshot of the run of the delta.
+    """
+    cells = pd.Index(delta["h3_index"].to_numpy(), name="h3_index")
+    removed = delta[removed_column].to_numpy(zero_copy_only=False)
+    state = state.reindex(state.index.union(cells[~removed]).difference(cells[removed]))
+    for column in state.columns:
+        valid = delta[column].is_valid().to_numpy(zero_copy_only=False)
+        values = column_values(delta[column])
+        state.loc[cells[valid], column] = values[valid]
+    return state
+
+
+def read_keyframe(history_path, run, columns):
+    table = feather.read_table(history_path / run["file"], columns=["h3_index", *columns])
+    state = pd.DataFrame({column: column_values(table[column]) for column in columns},
+                         index=pd.Index(table["h3_index"].to_numpy(), name="h3_index"))
+    return state
+
+
+def snapshots(history_path, run_ids, columns=None):
+    """
+    Rebuilds the snapshots of several runs, reading only the given columns of the history files.
+
+    The runs are rebuilt in order, each one from the previous when no keyframe lies between them, so
+    rebuilding two runs reads their keyframes and the small deltas up to them, not two full snapshots.
+
+    Parameters:
+    - history_path (Path): History directory of a city and resolution.
+    - run_ids (list): Ids of the runs to rebuild.
+    - columns (list, optional): Columns to rebuild, all columns of the runs by default.
+
+    Returns:
+    - snapshots (dict): Snapshot DataFrame indexed by uint64 H3 index for each run id.
+    """
+    runs = read_runs(history_path)
+    if columns is None:
+        # only the schema of the latest run is read, feather files are Arrow IPC files
+        schema = pa.ipc.open_file(history_path / runs[find_run(runs, max(run_ids))]["file"]).schema
+        columns = [column for column in schema.names if column not in ("h3_index", removed_column)]
+
+    result = {}
+    state, position = None, None
+    for run_id in sorted(set(run_ids)):
+        target = find_run(runs, run_id)
+        keyframe = max(i for i in range(target + 1) if runs[i]["keyframe"])
+        # continue from the previous run unless a keyframe is closer
+        if state is None or keyframe > position:
+            state, position = read_keyframe(history_path, runs[keyframe], columns), keyframe
+        for i in range(position + 1, target + 1):
+            state = apply_delta(state, read_delta(history_path, runs[i], columns))
+        position = target
+        result[run_id] = state.copy()
+    return result
+
+
+def append_snapshot(history_path, table, metadata=None, keyframe=False):
+    """
+    Appends the per-area features and predictions of a run to the history of a city and resolution.
+
+    The first run, every keyframe_interval-th run and runs whose columns changed are stored as full
+    snapshots (keyframes). All other runs are stored as deltas against the previous run, see delta_table.
+
+    Parameters:
+    - history_path (Path): History directory of a city and resolution, created if it does not exist.
+    - table (pa.Table): Arrow predictions table written by the predict command of run.py.
+    - metadata (dict, optional): JSON serialisable information stored with the run, e.g. the command.
+    - keyframe (bool): If True, the run is stored as a full snapshot.
+
+    Returns:
+    - run (dict): Stored run with run_id, created, keyframe, file, rows and changed_rows.
+    """
+    history_path.mkdir(parents=True, exist_ok=True)
+    runs = read_runs(history_path)
+    current = snapshot_frame(table)
+    run_id = runs[-1]["run_id"] + 1 if runs else 1
+
+    last_keyframe = max((run["run_id"] for run in runs if run["keyframe"]), default=None)
+    previous = snapshots(history_path, [runs[-1]["run_id"]])[runs[-1]["run_id"]] if runs else None
+    keyframe = (keyframe or previous is None or list(previous.columns) != list(current.columns)
+                or run_id - last_keyframe >= keyframe_interval)
+
+    if keyframe:
+        stored = keyframe_table(current)
+    else:
+        stored = delta_table(previous.astype(current.dtypes.to_dict()), current)
+
+    run = {"run_id": run_id,
+           "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+           "keyframe": keyframe,
+           "file": f"run_{run_id:06d}.feather",
+           "rows": len(current),
+           "changed_rows": len(current) if keyframe else stored.num_rows,
+           **(metadata or {})}
+    feather.write_feather(stored, history_path / run["file"], compression=compression)
+    write_runs(history_path, runs + [run])
+    return run
+
+
+def changed_cells(history_path, first_run, second_run, threshold, column="prediction"):
+    """
+    Lists the H3 areas whose value of a column moved by more than a threshold between two runs.
+
+    Only the H3 indices and the compared column of the history files are read.
+
+    Parameters:
+    - history_path (Path): History directory of a city and resolution.
+    - first_run (int): Id of the earlier run.
+    - second_run (int): Id of the later run.
+    - threshold (float): Minimal absolute change.
+    - column (str): Compared column, the predicted number of bike paths by default.
+
+    Returns:
+    - changes (gpd.GeoDataFrame): H3 areas in both runs with h3_index, the value in each run, their
+      difference as change and geometry, ordered by the absolute change.
+    """
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+
+    states = snapshots(history_path, [first_run, second_run], [column])
+    values = pd.DataFrame({f"{column}_{first_run}": states[first_run][column],
+                           f"{column}_{second_run}": states[second_run][column]}).dropna()
+    values["change"] = values.iloc[:, 1] - values.iloc[:, 0]
+    values = values[values["change"].abs() > threshold]
+    values = values.iloc[np.argsort(-values["change"].abs().to_numpy(), kind="stable")]
+
+    h3_indices = [h3.h3_to_string(x) for x in values.index]
+    return gpd.GeoDataFrame({"h3_index": h3_indices, **{name: values[name].to_numpy() for name in values.columns}},
+                            geometry=[Polygon(h3.h3_to_geo_boundary(x, geo_json=True)) for x in h3_indices],
+                            crs="EPSG:4326")
@@ -1,7 +1,16 @@
+import itertools
+import json
+from datetime import datetime
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
 from pathlib import Path
 import joblib
+import numpy as np
+
+models_path = Path.cwd() / "models_best"
+
+# features, in order, on which the model was trained
+model_features = ["green_areas_count", "buildings_count", "population", "recreational_areas_count",
+                  "distance_to_centrum"]
 
 
 def scale_data(data):
@@ -20,6 +29,9 @@ def scale_data(data):
         pd.DataFrame: A new DataFrame with the same column names as the input, where
                       each value has been standardized (mean = 0, standard deviation = 1).
         """
+    # imported here, as the scaler is needed only for the original pickled model
+    from sklearn.preprocessing import StandardScaler
+
     scaler = StandardScaler()
     scaler.fit(data)
     col_names = data.columns
@@ -27,25 +39,290 @@ def scale_data(data):
     return data_res
 
 
-def krakow_prediction(krakow_dataset):
+def save_model_artifact(model, scaler, features, metadata, make_latest=True):
+    """
+        Saves a trained model together with its scaling parameters as a new model version.
+
+        Each version is written to its own directory in models_best, named after the time of saving
+        with a counter appended if another version was saved in the same second, and becomes the
+        latest version used by krakow_prediction, unless make_latest is False. XGBoost models are saved
+        in the native UBJSON format, which loads faster than a pickle and does not depend on the exact
+        library versions, other models are pickled. The feature schema with the scaler statistics
+        is written to schema.json next to the model.
+
+        Parameters:
+        model (estimator): Fitted model.
+        scaler (StandardScaler): Scaler fitted on the training features, or None if the data
+                                 should be scaled with its own statistics.
+        features (list): Feature columns, in the order the model expects them.
+        metadata (dict): JSON serializable description of the training run.
+        make_latest (bool): If False, the version is only saved, the latest version stays the same.
+
+        Returns:
+        Path: Directory of the saved version.
+        """
+    import xgboost as xgb
+
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    # creating the directory is atomic, so trainings finishing in the same second never share a version
+    for attempt in itertools.count(1):
+        version = timestamp if attempt == 1 else f"{timestamp}_{attempt}"
+        artifact_path = models_path / version
+        try:
+            artifact_path.mkdir(parents=True)
+            break
+        except FileExistsError:
+            continue
+
+    if isinstance(model, xgb.XGBModel):
+        model.save_model(artifact_path / "model.ubj")
+    else:
+        joblib.dump(model, artifact_path / "model.pkl")
+
+    schema = {"features": list(features),
+              "dtype": "float32",
+              "mean": None if scaler is None else scaler.mean_.tolist(),
+              "scale": None if scaler is None else scaler.scale_.tolist()}
+    with open(artifact_path / "schema.json", "w") as file:
+        json.dump(schema, file, indent=2)
+    with open(artifact_path / "metadata.json", "w") as file:
+        json.dump({**metadata, "version": version, "features": list(features)}, file, indent=2, default=str)
+
+    if make_latest:
+        (models_path / "latest.txt").write_text(version)
+    return artifact_path
+
+
+def export_native_model(pickle_path=models_path / "model.pkl"):
+    """
+        Converts a pickled XGBoost model into a model version in the native XGBoost format.
+
+        The exported version keeps the behaviour of the pickled model, so the data is scaled with
+        its own statistics before the prediction. It does not become the latest version, it is used
+        when it is chosen explicitly, e.g. with --model-version.
+
+        Parameters:
+        pickle_path (Path): Path to the pickled model.
+
+        Returns:
+        Path: Directory of the saved version.
+        """
+    model = joblib.load(pickle_path)
+    return save_model_artifact(model, None, model_features, {"model": "xgb_model", "source": pickle_path.name},
+                               make_latest=False)
+
+
+def load_model_artifact(version=None, nthread=None):
+    """
+        Loads a versioned model artifact saved by save_model_artifact.
+
+        If no version is given, the latest one is loaded. When no versioned artifact exists, the
+        original models_best/model.pkl is returned without scaler statistics, in which case the data is
+        scaled with its own statistics.
+
+        Parameters:
+        version (str, optional): Version to load.
+        nthread (int, optional): Number of threads used by a native XGBoost model, all cores by default.
+
+        Returns:
+        dict: Dictionary containing:
+            - model: xgb.Booster for native models, fitted estimator otherwise.
+            - native: True if the model is a native XGBoost booster.
+            - mean: Array of feature means used for scaling, or None.
+            - scale: Array of feature standard deviations used for scaling, or None.
+            - features: Feature columns expected by the model.
+            - metadata: Description of the training run.
+        """
+    if version is None and (models_path / "latest.txt").exists():
+        version = (models_path / "latest.txt").read_text().strip()
+
+    if version is None:
+        return {"model": joblib.load(models_path / "model.pkl"),
+                "native": False,
+                "mean": None,
+                "scale": None,
+                "features": model_features,
+                "metadata": {"version": "model.pkl"}}
+
+    artifact_path = models_path / version
+    with open(artifact_path / "metadata.json") as file:
+        metadata = json.load(file)
+
+    if (artifact_path / "schema.json").exists():
+        with open(artifact_path / "schema.json") as file:
+            schema = json.load(file)
+        mean, scale = schema["mean"], schema["scale"]
+    else:
+        # versions saved before the schema was introduced keep the fitted scaler as a pickle
+        scaler = joblib.load(artifact_path / "scaler.pkl")
+        mean, scale = scaler.mean_, scaler.scale_
+
+    if (artifact_path / "model.ubj").exists():
+        # imported only when a model is loaded, pickled models import it themselves when unpickled
+        import xgboost as xgb
+
+        model = xgb.Booster()
+        model.load_model(artifact_path / "model.ubj")
+        if nthread is not None:
+            model.set_param({"nthread": nthread})
+        native = True
+    else:
+        model = joblib.load(artifact_path / "model.pkl")
+        native = False
+
+    return {"model": model,
+            "native": native,
+            "mean": None if mean is None else np.asarray(mean, dtype=np.float64),
+            "scale": None if scale is None else np.asarray(scale, dtype=np.float64),
+            "features": metadata["features"],
+            "metadata": metadata}
+
+
+def feature_matrix(dataset, artifact):
+    """
+        Creates a contiguous, scaled float32 feature matrix for the model of the artifact.
+
+        The matrix is scaled with the training statistics of the artifact if it has them, or with the
+        statistics of the dataset itself, the same as scale_data does. Scaling is done in float64 and
+        cast once, so the model receives exactly the values the pickled model got from scale_data.
+
+        Parameters:
+        dataset (pd.DataFrame): A pandas DataFrame containing the model features.
+        artifact (dict): Model artifact returned by load_model_artifact.
+
+        Returns:
+        np.ndarray: C-contiguous float32 array of shape (n_rows, n_features).
+        """
+    x = dataset[artifact["features"]].to_numpy(dtype=np.float64, copy=True)
+    if artifact["mean"] is None:
+        # missing values are ignored by the statistics and passed to the model, as in StandardScaler
+        mean = np.nanmean(x, axis=0)
+        scale = np.nanstd(x, axis=0)
+        scale[scale == 0] = 1
+    else:
+        mean, scale = artifact["mean"], artifact["scale"]
+    x -= mean
+    x /= scale
+    return np.ascontiguousarray(x, dtype=np.float32)
+
+
+def with_dataset_statistics(artifact, dataset):
+    """
+        Returns the artifact with scaling statistics of the dataset, if its model has none of its own.
+
+        The original pickled model is scaled with the statistics of the predicted dataset. When a dataset
+        is predicted in parts, e.g. only its changed rows, or together with perturbed copies of its rows,
+        the statistics are fixed from the whole dataset first, so every part is scaled the same way.
+
+        Parameters:
+        artifact (dict): Model artifact returned by load_model_artifact.
+        dataset (pd.DataFrame): A pandas DataFrame containing the model features of the whole dataset.
+
+        Returns:
+        dict: The artifact, with mean and scale of the dataset if it had none.
+        """
+    if artifact["mean"] is not None:
+        return artifact
+    x = dataset[artifact["features"]].to_numpy(dtype=np.float64)
+    scale = np.nanstd(x, axis=0)
+    scale[scale == 0] = 1
+    return dict(artifact, mean=np.nanmean(x, axis=0), scale=scale)
+
+
+def predict(dataset, artifact):
+    """
+        Predicts the number of bike paths for each row of the dataset.
+
+        Native XGBoost models predict directly from the float32 array with inplace_predict,
+        without creating a DMatrix or a DataFrame.
+
+        Parameters:
+        dataset (pd.DataFrame): A pandas DataFrame containing the model features.
+        artifact (dict): Model artifact returned by load_model_artifact.
+
+        Returns:
+        np.ndarray: Predictions for each row of the dataset.
+        """
+    x = feature_matrix(dataset, artifact)
+    if artifact["native"]:
+        return artifact["model"].inplace_predict(x)
+    if getattr(artifact["model"], "feature_names_in_", None) is not None:
+        # original pickled model was fitted on a DataFrame with named features
+        return artifact["model"].predict(pd.DataFrame(data=x, columns=artifact["features"]))
+    return artifact["model"].predict(x)
+
+
+def explain(dataset, artifact, nthread=None, approximate=False):
+    """
+        Calculates the contribution of each feature to the prediction of each row of the dataset.
+
+        Contributions are SHAP values computed natively by XGBoost with pred_contribs for the
+        whole feature matrix in one batch. For each row they sum up to its prediction. Exact values
+        take time proportional to the depth of the trees, for large maps the approximate attribution
+        of XGBoost, which follows each row along its decision path only, is much faster.
+
+        Parameters:
+        dataset (pd.DataFrame): A pandas DataFrame containing the model features.
+        artifact (dict): Model artifact returned by load_model_artifact, with an XGBoost model.
+        nthread (int, optional): Number of threads used for the calculation, all cores by default.
+        approximate (bool): If True, approximate contributions are calculated instead of exact SHAP values.
+
+        Returns:
+        pd.DataFrame: DataFrame with the same index as the dataset and a 'contribution_<feature>'
+                      column for each model feature, followed by 'contribution_bias'.
+        """
+    import xgboost as xgb
+
+    model = artifact["model"]
+    if not artifact["native"]:
+        if not isinstance(model, xgb.XGBModel):
+            raise ValueError("Explanations are available only for XGBoost models")
+        model = model.get_booster()
+    if nthread is not None:
+        model.set_param({"nthread": nthread})
+
+    x = feature_matrix(dataset, artifact)
+    matrix = xgb.DMatrix(x, feature_names=list(artifact["features"]), nthread=-1 if nthread is None else nthread)
+    contributions = model.predict(matrix, pred_contribs=True, approx_contribs=approximate)
+
+    columns = [f"contribution_{feature}" for feature in artifact["features"]] + ["contribution_bias"]
+    return pd.DataFrame(data=contributions, columns=columns, index=dataset.index)
+
+
+def krakow_prediction(krakow_dataset, version=None, nthread=None, explain_predictions=False,
+                      approximate_explanations=False, artifact=None):
     """
         Makes predictions using a pre-trained model on the provided Krakow dataset.
 
-        This function loads a pre-trained model from a specified file, scales the relevant
+        This function loads a pre-trained model artifact, scales the relevant
         features of the input dataset, and then makes predictions based on these features.
         The predictions are added as a new column to the input DataFrame.
 
         Parameters:
         krakow_dataset (pd.DataFrame): A pandas DataFrame containing the dataset for Krakow.
+        version (str, optional): Model version to use, the latest one by default.
+        nthread (int, optional): Number of threads used for the prediction, all cores by default.
+        explain_predictions (bool): If True, contributions of each feature to the prediction are added
+                                    as 'contribution_<feature>' columns, together with 'dominant_driver'
+                                    naming the feature with the largest absolute contribution.
+        approximate_explanations (bool): If True, approximate contributions are calculated, see explain.
+        artifact (dict, optional): Already loaded model artifact, loaded with version and nthread if None.
 
         Returns:
         pd.DataFrame: The input DataFrame with an additional column 'prediction' containing
                       the predictions made by the model.
         """
-    model = joblib.load(Path.cwd() / "models_best" / "model.pkl")
-    scaled_data = scale_data(krakow_dataset.drop(columns=["h3_index", "bike_paths_count", "geometry"]))
-    predictions = model.predict(scaled_data)
-    krakow_dataset["prediction"] = predictions
+    if artifact is None:
+        artifact = load_model_artifact(version, nthread)
+    krakow_dataset["prediction"] = predict(krakow_dataset, artifact)
+
+    if explain_predictions:
+        contributions = explain(krakow_dataset, artifact, nthread, approximate_explanations)
+        feature_contributions = contributions.drop(columns=["contribution_bias"]).to_numpy()
+        krakow_dataset[contributions.columns] = contributions
+        krakow_dataset["dominant_driver"] = np.asarray(artifact["features"])[
+            np.abs(feature_contributions).argmax(axis=1)]
+
     return krakow_dataset
 
 
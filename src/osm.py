@@ -3,6 +3,19 @@ import rasterio
 from rasterio.mask import mask
 import numpy as np
 
+# Overpass API interpreter, e.g. replaced by a local instance or a stub serving recorded responses
+overpass_url = "http://overpass-api.de/api/interpreter"
+
+# Overpass selectors of the elements whose nodes form each point layer
+layer_selectors = {
+    "green_areas": ['way["leisure"="park"]', 'way["leisure"="garden"]', 'way["leisure"="recreation_ground"]',
+                    'way["landuse"="grass"]', 'way["landuse"="forest"]', 'way["natural"="wood"]'],
+    "buildings": ['way["building"]', 'relation["building"]'],
+    "recreational_areas": ['way["leisure"="sports_centre"]', 'node["leisure"="sports_centre"]',
+                           'way["shop"]', 'node["shop"]',
+                           'way["amenity"="school"]', 'node["amenity"="school"]'],
+}
+
 
 def boundaries_download(place):
     """
@@ -36,86 +49,153 @@ def boundaries_download(place):
     return None
 
 
-def fetch_green_areas(boundary_coords):
+def layer_query(boundary_coords, layer, settings="[out:json]"):
     """
-    Fetches green areas within the specified boundary using the Overpass API.
+    Creates the Overpass query returning the elements of a point layer and all of their nodes.
 
     Parameters:
-    - boundary_coords (dpg.DataFrame): dataframe containing linestring with coordinates representing the boundary of the specified place.
+    - boundary_coords (gpd.GeoDataFrame): GeoDataFrame containing a single linestring with the boundary of the place.
+    - layer (str): Name of the layer in layer_selectors.
+    - settings (str): Overpass settings statement, e.g. with an [adiff:...] date range.
 
     Returns:
-    - green_areas (list): List of green areas with their coordinates.
-      Returns None if no data is found or if there's an error in fetching the data.
+    - overpass_query (str): Overpass QL query.
     """
     coords = boundary_coords.loc[0, "geometry"].coords
     polygon_str = ' '.join(f"{lat} {lon}" for lon, lat in coords)
-
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    overpass_query = f"""
-    [out:json];
+    statements = "\n".join(f'      {selector}(poly:"{polygon_str}");' for selector in layer_selectors[layer])
+    return f"""
+    {settings};
     (
-      way["leisure"="park"](poly:"{polygon_str}");
-      way["leisure"="garden"](poly:"{polygon_str}");
-      way["leisure"="recreation_ground"](poly:"{polygon_str}");
-      way["landuse"="grass"](poly:"{polygon_str}");
-      way["landuse"="forest"](poly:"{polygon_str}");
-      way["natural"="wood"](poly:"{polygon_str}");
+{statements}
     );
     out body;
     >;
     out skel qt;
     """
-    response = requests.post(overpass_url, data={"data": overpass_query})
+
+
+def fetch_layer(boundary_coords, layer):
+    """
+    Fetches the node coordinates of a point layer within the specified boundary using the Overpass API.
+
+    Parameters:
+    - boundary_coords (gpd.GeoDataFrame): GeoDataFrame containing a single linestring with the boundary of the place.
+    - layer (str): Name of the layer in layer_selectors.
+
+    Returns:
+    - points (list): List of (latitude, longitude) coordinates of the nodes.
+    - timestamp (str): Time of the OpenStreetMap data the response is based on, used by incremental refreshes.
+      Both are None if there's an error in fetching the data.
+    """
+    response = requests.post(overpass_url, data={"data": layer_query(boundary_coords, layer)})
     if response.status_code == 200:
         data = response.json()
-        green_areas = []
+        points = []
         for element in data['elements']:
             if element["type"] == "node":
                 coords = (element["lat"], element["lon"])
-                green_areas.append(coords)
-        return green_areas
-    return None
+                points.append(coords)
+        return points, data["osm3s"]["timestamp_osm_base"]
+    return None, None
 
 
-def fetch_buildings(boundary_coords):
+def sample_query(boxes, layer, settings="[out:json][timeout:25]"):
     """
-    Fetches buildings within the specified boundary using the Overpass API.
+    Creates the Overpass query returning the nodes of the elements of a point layer crossing small boxes.
+
+    Only nodes are returned, without the elements they belong to, so the response stays small.
 
     Parameters:
-    - boundary_coords (gpd.GeoDataFrame): GeoDataFrame containing a single polygon with coordinates representing the boundary of the specified place.
+    - boxes (list): (south, west, north, east) bounding boxes.
+    - layer (str): Name of the layer in layer_selectors.
+    - settings (str): Overpass settings statement.
 
     Returns:
-    - buildings (list): List of buildings with their coordinates.
-      Returns None if no data is found or if there's an error in fetching the data.
+    - overpass_query (str): Overpass QL query.
     """
-    # Extract the coordinates of the polygon boundary
-    coords = boundary_coords.loc[0, "geometry"].coords
-    polygon_str = ' '.join(f"{lat} {lon}" for lon, lat in coords)
-
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    overpass_query = f"""
-    [out:json];
+    statements = "\n".join(f'      {selector}({south},{west},{north},{east});'
+                           for south, west, north, east in boxes for selector in layer_selectors[layer])
+    return f"""
+    {settings};
     (
-      way["building"](poly:"{polygon_str}");
-      relation["building"](poly:"{polygon_str}");
+{statements}
     );
-    out body;
-    >;
+    (._; >;);
+    node._;
     out skel qt;
     """
 
+
+def fetch_layer_sample(boxes, layer):
+    """
+    Fetches the nodes of a point layer crossing small boxes, used as a quick sample of the layer.
+
+    Parameters:
+    - boxes (list): (south, west, north, east) bounding boxes.
+    - layer (str): Name of the layer in layer_selectors.
+
+    Returns:
+    - points (list): List of (latitude, longitude) coordinates of the nodes, which may lie outside the boxes.
+      Returns None if there's an error in fetching the data.
+    """
+    response = requests.post(overpass_url, data={"data": sample_query(boxes, layer)})
+    if response.status_code == 200:
+        return [(element["lat"], element["lon"]) for element in response.json()["elements"]
+                if element["type"] == "node"]
+    return None
+
+
+def fetch_augmented_diff(boundary_coords, layer, since):
+    """
+    Fetches the changes of a point layer since a given time as an Overpass augmented diff.
+
+    Parameters:
+    - boundary_coords (gpd.GeoDataFrame): GeoDataFrame containing a single linestring with the boundary of the place.
+    - layer (str): Name of the layer in layer_selectors.
+    - since (str): Time of the last synchronisation, e.g. "2024-05-01T10:00:00Z".
+
+    Returns:
+    - diff (str): Augmented diff XML with the created, modified and deleted elements of the layer.
+      Returns None if there's an error in fetching the data.
+    """
+    overpass_query = layer_query(boundary_coords, layer, f'[out:xml][adiff:"{since}"]')
     response = requests.post(overpass_url, data={"data": overpass_query})
     if response.status_code == 200:
-        data = response.json()
-        buildings = []
-        for element in data['elements']:
-            if element["type"] == "node":
-                coords = (element["lat"], element["lon"])
-                buildings.append(coords)
-        return buildings
+        return response.text
     return None
 
 
+def fetch_green_areas(boundary_coords):
+    """
+    Fetches green areas within the specified boundary using the Overpass API.
+
+    Parameters:
+    - boundary_coords (dpg.DataFrame): dataframe containing linestring with coordinates representing the boundary of the specified place.
+
+    Returns:
+    - green_areas (list): List of green areas with their coordinates.
+      Returns None if no data is found or if there's an error in fetching the data.
+    """
+    green_areas, _ = fetch_layer(boundary_coords, "green_areas")
+    return green_areas
+
+
+def fetch_buildings(boundary_coords):
+    """
+    Fetches buildings within the specified boundary using the Overpass API.
+
+    Parameters:
+    - boundary_coords (gpd.GeoDataFrame): GeoDataFrame containing a single polygon with coordinates representing the boundary of the specified place.
+
+    Returns:
+    - buildings (list): List of buildings with their coordinates.
+      Returns None if no data is found or if there's an error in fetching the data.
+    """
+    buildings, _ = fetch_layer(boundary_coords, "buildings")
+    return buildings
+
+
 def fetch_population_data_worldpop(boundary_coords, worldpop_tiff_path):
     """
     Fetches population data within the specified polygons using WorldPop raster data.
@@ -148,33 +228,5 @@ def fetch_recreational_areas(boundary_coords):
     - amenities (list): List of amenities with their coordinates.
       Returns None if no data is found or if there's an error in fetching the data.
     """
-    # Extract the coordinates of the polygon boundary
-    coords = boundary_coords.loc[0, "geometry"].coords
-    polygon_str = ' '.join(f"{lat} {lon}" for lon, lat in coords)
-
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    overpass_query = f"""
-    [out:json];
-    (
-      way["leisure"="sports_centre"](poly:"{polygon_str}");
-      node["leisure"="sports_centre"](poly:"{polygon_str}");
-      way["shop"](poly:"{polygon_str}");
-      node["shop"](poly:"{polygon_str}");
-      way["amenity"="school"](poly:"{polygon_str}");
-      node["amenity"="school"](poly:"{polygon_str}");
-    );
-    out body;
-    >;
-    out skel qt;
-    """
-
-    response = requests.post(overpass_url, data={"data": overpass_query})
-    if response.status_code == 200:
-        data = response.json()
-        amenities = []
-        for element in data['elements']:
-            if element["type"] == "node":
-                coords = (element["lat"], element["lon"])
-                amenities.append(coords)
-        return amenities
-    return None
+    amenities, _ = fetch_layer(boundary_coords, "recreational_areas")
+    return amenities
@@ -0,0 +1,299 @@
+import hashlib
+import json
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import geopandas as gpd
+import pandas as pd
+from pyarrow import feather
+from shapely.geometry import Polygon
+import src.features as features
+import src.geoparquet as geoparquet
+import src.osm as osm
+import src.preprocessing as preprocessing
+import src.tables as tables
+
+# file suffixes of the checkpoint formats: json for coordinates, Arrow tables for H3 areas and GeoParquet for paths
+checkpoint_suffixes = {"json": ".json", "table": ".feather", "geoparquet": ".parquet"}
+
+# point layers fetched from OpenStreetMap, with the stage counting them in each H3 area
+point_layers = {"green_areas": features.green_areas_function,
+                "buildings": features.buildings_function,
+                "recreational_areas": features.recreational_areas_function}
+
+
+def required(value, description):
+    """
+    Returns a fetched value, raising an error if the fetch failed, so the stage is run again when resumed.
+    """
+    if value is None:
+        raise RuntimeError(f"Fetching {description} failed")
+    return value
+
+
+def city_stages(city_name, bike_paths_path, layers=None):
+    """
+    Creates the stage graph of the feature pipeline of a city.
+
+    The stages are the steps of run.city_pipeline: fetching the boundary, the city center and each
+    point layer, reading the bike paths, counting each layer in the H3 areas, masking the population
+    raster, calculating distances and merging everything into the feature table. Fetches depend only
+    on the boundary, so they run at the same time as each other and as the bike path stages. Bike paths
+    are read once, streaming only the batches within the bounding box of the city, and the same geometries
+    are counted in the H3 areas, indexed for the network distances and plotted.
+
+    Stages of H3 areas exchange Arrow tables with uint64 H3 indices: the bike path areas with their
+    GeoArrow geometries, and every other stage only the h3_index and the columns it adds, which the last
+    stage joins on h3_index. The feature functions work on GeoDataFrames decoded from these tables.
+
+    Parameters:
+    - city_name (str): Name of the chosen city.
+    - bike_paths_path (Path): GeoParquet file with bike paths.
+    - layers (dict, optional): OpenStreetMap layers cached by the fetch command of run.py, which are used
+      instead of fetching them.
+
+    Returns:
+    - stages (dict): For each stage name, a tuple of its function, the names of the stages whose results
+      it takes as arguments and the format of its checkpoint. The last stage returns the feature table
+      as an Arrow table.
+    """
+    layers = layers or {}
+    crs = geoparquet.read_crs(bike_paths_path)
+
+    def boundary():
+        if "boundary" in layers:
+            return layers["boundary"]
+        return required(osm.boundaries_download(city_name), f"the boundary of {city_name}")
+
+    def centrum():
+        if "centrum" in layers:
+            return layers["centrum"]
+        return required(features.centrum_coords(city_name), f"the center of {city_name}")
+
+    def points(layer):
+        def fetch(boundary):
+            if layer in layers:
+                return layers[layer]
+            city_boundaries = preprocessing.boundary_from_points(boundary, "EPSG:4326")
+            return required(osm.fetch_layer(city_boundaries, layer)[0], f"{layer} from {osm.overpass_url}")
+        return fetch
+
+    def added_columns(h3_df, columns):
+        # only the columns a stage adds are passed on, the geometry of the areas comes from bike_paths
+        return tables.to_arrow(h3_df[["h3_index", *columns]])
+
+    def h3_counts(layer):
+        def count(boundary, coords):
+            city_boundaries = preprocessing.boundary_from_points(boundary, crs)
+            h3_df = point_layers[layer](city_boundaries, crs, city_name, coords)
+            return added_columns(h3_df, [f"{layer}_count"])
+        return count
+
+    def city_bikes(boundary):
+        # read only geometries of bike paths within bounding box of chosen city, for the counts, network and plots
+        city_boundaries = preprocessing.boundary_from_points(boundary, crs)
+        city_bikes = geoparquet.read_geoparquet(bike_paths_path, tuple(city_boundaries.total_bounds))
+        # bike paths of Amsterdam are kept only within its boundary, of other cities within its bounding box
+        if city_name == "Amsterdam":
+            city_bikes = city_bikes[city_bikes.within(Polygon(city_boundaries.loc[0, "geometry"]))]
+        return city_bikes
+
+    def bike_paths(boundary, city_bikes):
+        city_boundaries = preprocessing.boundary_from_points(boundary, crs)
+        return tables.to_arrow(features.bike_paths_function(city_bikes, city_boundaries, city_name))
+
+    def bike_paths_plots(boundary, city_bikes, bike_paths):
+        city_boundaries = preprocessing.boundary_from_points(boundary, crs)
+        return features.bike_paths_plots_function(city_bikes, tables.to_geodataframe(bike_paths), city_boundaries,
+                                                  city_name)
+
+    def population(bike_paths):
+        h3_df = features.population_function(tables.to_geodataframe(bike_paths), city_name)
+        return added_columns(h3_df, ["population"])
+
+    def centrum_distance(bike_paths, centrum):
+        h3_df = features.centrum_distance_function(tables.to_geodataframe(bike_paths), city_name, centrum)
+        return added_columns(h3_df, ["distance_to_centrum"])
+
+    def network_distance(bike_paths, city_bikes, recreational_areas_points, centrum):
+        h3_df = features.network_distance_function(tables.to_geodataframe(bike_paths), city_bikes,
+                                                   recreational_areas_points, city_name, centrum)
+        return added_columns(h3_df, ["network_distance_to_centrum", "network_distance_to_recreational_areas"])
+
+    def merge(bike_paths, green_areas, buildings, population, recreational_areas, centrum_distance,
+              network_distance):
+        # columns are joined in the same order as in run.city_pipeline, the bike path areas are not copied
+        table = bike_paths
+        for other in (green_areas, buildings, population, recreational_areas, centrum_distance, network_distance):
+            table = tables.join_columns(table, other)
+        return table
+
+    stages = {"boundary": (boundary, [], "json"),
+              "centrum": (centrum, [], "json")}
+    for layer in point_layers:
+        stages[f"{layer}_points"] = (points(layer), ["boundary"], "json")
+    stages["city_bikes"] = (city_bikes, ["boundary"], "geoparquet")
+    stages["bike_paths"] = (bike_paths, ["boundary", "city_bikes"], "table")
+    stages["bike_paths_plots"] = (bike_paths_plots, ["boundary", "city_bikes", "bike_paths"], "json")
+    for layer in point_layers:
+        stages[layer] = (h3_counts(layer), ["boundary", f"{layer}_points"], "table")
+    stages["population"] = (population, ["bike_paths"], "table")
+    stages["centrum_distance"] = (centrum_distance, ["bike_paths", "centrum"], "table")
+    stages["network_distance"] = (network_distance,
+                                  ["bike_paths", "city_bikes", "recreational_areas_points", "centrum"], "table")
+    stages["features"] = (merge, ["bike_paths", "green_areas", "buildings", "population", "recreational_areas",
+                                  "centrum_distance", "network_distance"], "table")
+    return stages
+
+
+def save_checkpoint(value, path, checkpoint_format):
+    """
+    Saves the result of a stage, writing a temporary file first, so an interrupted write leaves no checkpoint.
+    """
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    if checkpoint_format == "json":
+        with open(temporary_path, "w") as file:
+            json.dump(value, file)
+    elif checkpoint_format == "geoparquet":
+        value.to_parquet(temporary_path)
+    else:
+        tables.write_table(value, temporary_path)
+    temporary_path.replace(path)
+
+
+def load_checkpoint(path, checkpoint_format):
+    """
+    Loads the result of a stage saved by save_checkpoint.
+    """
+    if checkpoint_format == "json":
+        with open(path) as file:
+            return json.load(file)
+    if checkpoint_format == "geoparquet":
+        return gpd.read_parquet(path)
+    # the table is read into memory instead of being memory-mapped, so the checkpoints can be removed after the run
+    return feather.read_table(path, memory_map=False)
+
+
+def layers_digest(layers):
+    """
+    Returns a SHA-256 digest of OpenStreetMap layers, which changes whenever they are fetched or refreshed.
+
+    Parameters:
+    - layers (dict, optional): Layers returned by fetch_city_layers, None if the stages fetch them.
+
+    Returns:
+    - digest (str): Hex digest of the layers, None if layers is None.
+    """
+    if layers is None:
+        return None
+    return hashlib.sha256(json.dumps(layers, sort_keys=True).encode()).hexdigest()
+
+
+def prepare_checkpoints(checkpoint_path, parameters, restart=False):
+    """
+    Creates the checkpoint directory of a run, removing checkpoints made with other parameters.
+
+    Parameters:
+    - checkpoint_path (Path): Directory with the checkpoints of the stages.
+    - parameters (dict): JSON serialisable parameters of the run, e.g. the bike paths file, resolution
+      and digest of the layers.
+    - restart (bool): If True, all checkpoints are removed and every stage is run again.
+
+    Returns:
+    - None
+    """
+    manifest_path = checkpoint_path / "parameters.json"
+    if checkpoint_path.exists():
+        stale = restart or not manifest_path.exists()
+        if not stale:
+            with open(manifest_path) as file:
+                stale = json.load(file) != parameters
+        if stale:
+            shutil.rmtree(checkpoint_path)
+
+    checkpoint_path.mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, "w") as file:
+        json.dump(parameters, file)
+
+
+def run_stage(function, arguments):
+    """
+    Runs a stage in a worker thread, collecting its plots instead of drawing them.
+
+    Returns:
+    - result: Result of the stage.
+    - plot_calls (list): Collected plotter calls as (plotter, args) tuples.
+    """
+    features.deferred_plots.calls = []
+    try:
+        return function(*arguments), features.deferred_plots.calls
+    finally:
+        features.deferred_plots.calls = None
+
+
+def run_stages(stages, checkpoint_path, workers=None):
+    """
+    Runs a stage graph in parallel threads, saving the result of each stage as a checkpoint.
+
+    This function performs the following steps:
+    1. Finds the stages whose checkpoints exist and loads those needed by the remaining stages.
+    2. Starts every remaining stage in a thread pool as soon as all stages it depends on are finished,
+       so e.g. OpenStreetMap fetches run while the bike paths are indexed and the population is masked.
+    3. Draws the plots of each finished stage on the main thread and saves its checkpoint.
+    4. If a stage fails, still runs all stages which do not depend on it, then raises the error.
+       Running the graph again resumes from the finished stages.
+
+    Stages get copies of the DataFrames they take, so stages running at the same time never share them.
+    Arrow tables are immutable, so they are passed on without copies.
+
+    Parameters:
+    - stages (dict): Stage graph as returned by city_stages, with the final stage last.
+    - checkpoint_path (Path): Directory with the checkpoints of the stages.
+    - workers (int, optional): Number of threads, as many as ThreadPoolExecutor uses by default.
+
+    Returns:
+    - result: Result of the final stage.
+    """
+    def path(name):
+        return checkpoint_path / f"{name}{checkpoint_suffixes[stages[name][2]]}"
+
+    final_stage = list(stages)[-1]
+    pending = [name for name in stages if not path(name).exists()]
+    needed = {dependency for name in pending for dependency in stages[name][1]} | {final_stage}
+    results = {name: load_checkpoint(path(name), stages[name][2])
+               for name in stages if name not in pending and name in needed}
+
+    errors, failed = [], set()
+    with ThreadPoolExecutor(workers) as executor:
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                function, dependencies, _ = stages[name]
+                if any(dep in failed for dep in dependencies):
+                    # stages depending on a failed stage fail too, all others are still run
+                    failed.add(name)
+                    pending.remove(name)
+                elif all(dep in results for dep in dependencies):
+                    arguments = [results[dep].copy() if isinstance(results[dep], pd.DataFrame) else results[dep]
+                                 for dep in dependencies]
+                    running[executor.submit(run_stage, function, arguments)] = name
+                    pending.remove(name)
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    result, plot_calls = future.result()
+                except Exception as error:
+                    errors.append(error)
+                    failed.add(name)
+                    continue
+                for plotter, args in plot_calls:
+                    plotter(*args)
+                save_checkpoint(result, path(name), stages[name][2])
+                results[name] = result
+
+    if errors:
+        raise errors[0]
+    return results[final_stage]
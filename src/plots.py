@@ -1,7 +1,201 @@
 import matplotlib.pyplot as plt
+import numpy as np
 
+# backend used by plotters called without one: "vector" draws every geometry as a matplotlib patch,
+# "raster" aggregates geometries into an image, so time and memory do not grow with the number of geometries
+default_backend = "vector"
 
-def paths_plotter(bike_paths_gdf, city_bounds_gdf, results_path, city_name):
+# number of pixels along the longer side of rasterised layers
+raster_size = 1200
+
+
+def raster_grid(bounds, crs):
+    """
+    Creates a pixel grid covering the bounds, with square pixels on the plot.
+
+    Parameters:
+    - bounds (array-like): Bounds (minx, miny, maxx, maxy) of the plotted layer.
+    - crs (pyproj.CRS): CRS of the layer, geographic coordinates are stretched as in GeoDataFrame.plot.
+
+    Returns:
+    - grid (dict): Shape, affine transform, matplotlib extent and aspect of the grid.
+    """
+    from rasterio.transform import from_bounds
+
+    minx, miny, maxx, maxy = bounds
+    aspect = 1 / np.cos(np.radians((miny + maxy) / 2)) if crs is not None and crs.is_geographic else 1
+    width, height = max(maxx - minx, 1e-9), max((maxy - miny) * aspect, 1e-9)
+    cols = max(int(raster_size * min(1, width / height)), 1)
+    rows = max(int(raster_size * min(1, height / width)), 1)
+    return {"shape": (rows, cols),
+            "transform": from_bounds(minx, miny, maxx, maxy, cols, rows),
+            "extent": (minx, maxx, miny, maxy),
+            "aspect": aspect}
+
+
+def figure_grid(backend, *gdfs):
+    """
+    Creates one pixel grid for all layers drawn on a figure, so their images line up pixel for pixel.
+
+    Parameters:
+    - backend (str, optional): "vector" or "raster", default_backend by default.
+    - gdfs (GeoDataFrame): Layers drawn on the figure, in the same CRS.
+
+    Returns:
+    - grid (dict): Grid created by raster_grid from the union of the bounds of the layers, None with the
+      vector backend or if all layers are empty.
+    """
+    bounds = np.array([gdf.total_bounds for gdf in gdfs if not gdf.empty])
+    if (backend or default_backend) == "vector" or len(bounds) == 0:
+        return None
+    return raster_grid((*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0)), gdfs[0].crs)
+
+
+def rasterize_values(gdf, values, grid, categorical=False):
+    """
+    Burns polygon values into an image, pixels outside of the polygons are NaN.
+
+    Every polygon touching a pixel is aggregated into it, so areas smaller than a pixel, e.g. h3 areas
+    of a high resolution over a whole city, are not lost between the pixel centers.
+
+    Parameters:
+    - gdf (GeoDataFrame): GeoDataFrame with polygon geometries, e.g. h3 areas.
+    - values (np.ndarray): Value of each polygon, polygons with NaN values are left out.
+    - grid (dict): Pixel grid created by raster_grid.
+    - categorical (bool): If True, values are category codes and a pixel gets the code of one of its
+      polygons, otherwise the mean of their values.
+
+    Returns:
+    - image (np.ndarray): float32 image of the grid shape.
+    """
+    from rasterio.enums import MergeAlg
+    from rasterio.features import rasterize
+
+    values = np.asarray(values, dtype=np.float64)
+    known = ~np.isnan(values)
+    geometries, values = gdf.geometry.to_numpy()[known], values[known]
+    image = np.full(grid["shape"], np.nan, dtype=np.float32)
+    if len(geometries) == 0:
+        return image
+    if categorical:
+        return rasterize(zip(geometries, values.astype(np.float32)), out_shape=grid["shape"],
+                         transform=grid["transform"], fill=np.nan, all_touched=True, dtype="float32")
+    sums = rasterize(zip(geometries, values), out_shape=grid["shape"], transform=grid["transform"],
+                     merge_alg=MergeAlg.add, all_touched=True, dtype="float64")
+    counts = rasterize(((geometry, 1) for geometry in geometries), out_shape=grid["shape"],
+                       transform=grid["transform"], merge_alg=MergeAlg.add, all_touched=True, dtype="uint32")
+    np.divide(sums, counts, out=image, where=counts > 0, casting="unsafe")
+    return image
+
+
+def rasterize_counts(gdf, grid):
+    """
+    Counts geometries in each pixel, points with a 2D histogram and lines or polygons by burning them in.
+
+    Parameters:
+    - gdf (GeoDataFrame): GeoDataFrame with any geometries, e.g. building points or bike paths.
+    - grid (dict): Pixel grid created by raster_grid.
+
+    Returns:
+    - counts (np.ndarray): Number of geometries in each pixel of the grid.
+    """
+    import shapely
+    from rasterio.enums import MergeAlg
+    from rasterio.features import rasterize
+
+    geometries = gdf.geometry.to_numpy()
+    rows, cols = grid["shape"]
+    minx, maxx, miny, maxy = grid["extent"]
+    if np.all(shapely.get_type_id(geometries) == shapely.GeometryType.POINT):
+        coords = shapely.get_coordinates(geometries)
+        counts, _, _ = np.histogram2d(coords[:, 1], coords[:, 0], bins=(rows, cols),
+                                      range=((miny, maxy), (minx, maxx)))
+        # image rows go from north to south
+        return counts[::-1]
+    return rasterize(((geometry, 1) for geometry in geometries), out_shape=grid["shape"],
+                     transform=grid["transform"], merge_alg=MergeAlg.add, all_touched=True, dtype="uint32")
+
+
+def draw_column(h3_df, column, ax, backend=None, cmap="OrRd", vmin=None, vmax=None, categorical=False, grid=None):
+    """
+    Draws a choropleth of a column of h3 areas with the chosen backend.
+
+    Parameters:
+    - h3_df (GeoDataFrame): GeoDataFrame containing H3 hexagons and the column.
+    - column (str): Name of the plotted column.
+    - ax (matplotlib.axes.Axes): Axes to draw on.
+    - backend (str, optional): "vector" or "raster", default_backend by default.
+    - cmap (str): Name of the colormap.
+    - vmin (float, optional): Lower limit of the colormap.
+    - vmax (float, optional): Upper limit of the colormap.
+    - categorical (bool): If True, the column is drawn as categories with a legend.
+    - grid (dict, optional): Pixel grid of the raster backend shared by the layers of the figure, see figure_grid.
+      By default a grid covering h3_df is used.
+
+    Returns:
+    - None
+    """
+    backend = backend or default_backend
+    if backend == "vector":
+        h3_df.plot(column=column, cmap=cmap, legend=True, ax=ax, vmin=vmin, vmax=vmax, categorical=categorical)
+        return
+
+    from matplotlib.patches import Patch
+
+    grid = grid or raster_grid(h3_df.total_bounds, h3_df.crs)
+    if categorical:
+        categories = h3_df[column].astype("category")
+        n_categories = len(categories.cat.categories)
+        image = rasterize_values(h3_df, np.where(categories.cat.codes < 0, np.nan, categories.cat.codes), grid,
+                                 categorical=True)
+        colormap = plt.get_cmap(cmap, n_categories)
+        ax.imshow(image, extent=grid["extent"], cmap=colormap, vmin=-0.5, vmax=n_categories - 0.5,
+                  interpolation="nearest")
+        ax.legend(handles=[Patch(color=colormap(i), label=str(category))
+                           for i, category in enumerate(categories.cat.categories)])
+    else:
+        image = rasterize_values(h3_df, h3_df[column], grid)
+        mappable = ax.imshow(image, extent=grid["extent"], cmap=cmap, vmin=vmin, vmax=vmax, interpolation="nearest")
+        ax.figure.colorbar(mappable, ax=ax)
+    ax.set_aspect(grid["aspect"])
+
+
+def draw_geometries(gdf, ax, backend=None, color="black", alpha=1, grid=None, **vector_kwargs):
+    """
+    Draws a layer of points, lines or polygons in a single color with the chosen backend.
+
+    With the raster backend every pixel containing at least one geometry is colored.
+
+    Parameters:
+    - gdf (GeoDataFrame): GeoDataFrame with the geometries.
+    - ax (matplotlib.axes.Axes): Axes to draw on.
+    - backend (str, optional): "vector" or "raster", default_backend by default.
+    - color (str): Color of the geometries.
+    - alpha (float): Opacity of the geometries.
+    - grid (dict, optional): Pixel grid of the raster backend shared by the layers of the figure, see figure_grid.
+      By default a grid covering gdf is used.
+    - vector_kwargs: Other arguments of GeoDataFrame.plot, e.g. markersize, used by the vector backend.
+
+    Returns:
+    - None
+    """
+    backend = backend or default_backend
+    if backend == "vector":
+        gdf.plot(ax=ax, color=color, alpha=alpha, **vector_kwargs)
+        return
+    if gdf.empty:
+        return
+
+    from matplotlib.colors import ListedColormap
+
+    grid = grid or raster_grid(gdf.total_bounds, gdf.crs)
+    counts = rasterize_counts(gdf, grid)
+    ax.imshow(np.ma.masked_equal(counts > 0, False), extent=grid["extent"], cmap=ListedColormap([color]),
+              alpha=alpha, interpolation="nearest")
+    ax.set_aspect(grid["aspect"])
+
+
+def paths_plotter(bike_paths_gdf, city_bounds_gdf, results_path, city_name, backend=None):
     """
       Plots bike paths over city boundaries and saves the plot as an image.
 
@@ -10,18 +204,20 @@ def paths_plotter(bike_paths_gdf, city_bounds_gdf, results_path, city_name):
       - city_bounds_gdf (GeoDataFrame): GeoDataFrame containing city boundaries.
       - results_path (str or Path): Path where the resulting plot image will be saved.
       - city_name (str): Name of the city for which the plot is generated.
+      - backend (str, optional): "vector" or "raster", plots.default_backend by default.
       """
 
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"{city_name} bike paths", fontsize=25)
-    bike_paths_gdf.plot(ax=ax)
+    grid = figure_grid(backend, bike_paths_gdf, city_bounds_gdf)
+    draw_geometries(bike_paths_gdf, ax, backend, color="C0", grid=grid)
     city_bounds_gdf.plot(ax=ax, color="black")
     ax.set_xlabel("Longitude")
     ax.set_ylabel("Latitude")
     fig.savefig(results_path / f"{city_name}_bike_paths.png")
 
 
-def h3_count_bike_path_plotter(bike_path_gdf, h3_df, results_path, city_name):
+def h3_count_bike_path_plotter(bike_path_gdf, h3_df, results_path, city_name, backend=None):
     """
     Plots bike path count by H3 area and saves the plot as an image.
 
@@ -30,19 +226,21 @@ def h3_count_bike_path_plotter(bike_path_gdf, h3_df, results_path, city_name):
     - h3_df (GeoDataFrame): GeoDataFrame containing aggregated H3 hexagons with counts and geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
     """
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"{city_name} bike paths count by h3 area", fontsize=20)
-    bike_path_gdf.plot(ax=ax, linewidth=0.5)
-    h3_df.plot(column="bike_paths_count", cmap='OrRd', legend=True, ax=ax)
+    grid = figure_grid(backend, bike_path_gdf, h3_df)
+    draw_geometries(bike_path_gdf, ax, backend, color="C0", linewidth=0.5, grid=grid)
+    draw_column(h3_df, "bike_paths_count", ax, backend, cmap='OrRd', grid=grid)
 
     fig.savefig(results_path / f"{city_name}_h3_bike_paths.png")
 
 
-def h3_count_green_areas_plotter(green_area_gdf, h3_df, results_path, city_name):
+def h3_count_green_areas_plotter(green_area_gdf, h3_df, results_path, city_name, backend=None):
     """
     Plots green areas points count by H3 area and saves the plot as an image.
 
@@ -51,19 +249,21 @@ def h3_count_green_areas_plotter(green_area_gdf, h3_df, results_path, city_name)
     - h3_df (GeoDataFrame): GeoDataFrame containing aggregated H3 hexagons with counts and geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
     """
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"{city_name} green areas points count by h3 area", fontsize=20)
-    h3_df.plot(column="green_areas_count", cmap='Blues',  legend=True, ax=ax)
-    green_area_gdf.plot(ax=ax, markersize=0.05, alpha=0.1, color="green")
+    grid = figure_grid(backend, h3_df, green_area_gdf)
+    draw_column(h3_df, "green_areas_count", ax, backend, cmap='Blues', grid=grid)
+    draw_geometries(green_area_gdf, ax, backend, color="green", alpha=0.1, markersize=0.05, grid=grid)
 
     fig.savefig(results_path / f"{city_name}_h3_green_areas.png")
 
 
-def h3_count_buildings_plotter(buildings_gdf, h3_df, results_path, city_name):
+def h3_count_buildings_plotter(buildings_gdf, h3_df, results_path, city_name, backend=None):
     """
     Plots building points count by H3 area and saves the plot as an image.
 
@@ -72,19 +272,21 @@ def h3_count_buildings_plotter(buildings_gdf, h3_df, results_path, city_name):
     - h3_df (GeoDataFrame): GeoDataFrame containing aggregated H3 hexagons with counts and geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
     """
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"{city_name} buildings points count by h3 area", fontsize=20)
-    h3_df.plot(column="buildings_count", cmap='OrRd',  legend=True, ax=ax)
-    buildings_gdf.plot(ax=ax, markersize=0.05, alpha=0.1, color="grey")
+    grid = figure_grid(backend, h3_df, buildings_gdf)
+    draw_column(h3_df, "buildings_count", ax, backend, cmap='OrRd', grid=grid)
+    draw_geometries(buildings_gdf, ax, backend, color="grey", alpha=0.1, markersize=0.05, grid=grid)
 
     fig.savefig(results_path / f"{city_name}_h3_buildings.png")
 
 
-def green_areas_plotter(points_gdf, city_bounds_gdf, results_path, city_name):
+def green_areas_plotter(points_gdf, city_bounds_gdf, results_path, city_name, backend=None):
     """
     Plots green area points in green and city boundaries, and saves the plot as an image.
 
@@ -93,6 +295,7 @@ def green_areas_plotter(points_gdf, city_bounds_gdf, results_path, city_name):
     - city_boundary_gdf (GeoDataFrame): GeoDataFrame containing city boundary geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
@@ -100,14 +303,15 @@ def green_areas_plotter(points_gdf, city_bounds_gdf, results_path, city_name):
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"{city_name} green areas", fontsize=20)
 
-    points_gdf.plot(ax=ax, color='green', markersize=5)
+    draw_geometries(points_gdf, ax, backend, color='green', markersize=5,
+                    grid=figure_grid(backend, points_gdf, city_bounds_gdf))
 
     city_bounds_gdf.plot(ax=ax, edgecolor='black', facecolor='none')
 
     fig.savefig(results_path / f"{city_name}_green_areas.png")
 
 
-def buildings_plotter(points_gdf, city_bounds_gdf, results_path, city_name):
+def buildings_plotter(points_gdf, city_bounds_gdf, results_path, city_name, backend=None):
     """
     Plots buidlings points and city boundaries, and saves the plot as an image.
 
@@ -116,6 +320,7 @@ def buildings_plotter(points_gdf, city_bounds_gdf, results_path, city_name):
     - city_boundary_gdf (GeoDataFrame): GeoDataFrame containing city boundary geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
@@ -123,14 +328,15 @@ def buildings_plotter(points_gdf, city_bounds_gdf, results_path, city_name):
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"{city_name} buildings", fontsize=20)
 
-    points_gdf.plot(ax=ax, color='grey', markersize=5)
+    draw_geometries(points_gdf, ax, backend, color='grey', markersize=5,
+                    grid=figure_grid(backend, points_gdf, city_bounds_gdf))
 
     city_bounds_gdf.plot(ax=ax, edgecolor='black', facecolor='none')
 
     fig.savefig(results_path / f"{city_name}_buildings.png")
 
 
-def h3_count_population_plotter(h3_population_gdf, results_path, city_name):
+def h3_count_population_plotter(h3_population_gdf, results_path, city_name, backend=None):
     """
     Plots population by H3 area and saves the plot as an image.
 
@@ -138,18 +344,19 @@ def h3_count_population_plotter(h3_population_gdf, results_path, city_name):
     - h3_population_gdf (GeoDataFrame): GeoDataFrame containing aggregated H3 hexagons with counts and geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
     """
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"{city_name} population by h3 area", fontsize=20)
-    h3_population_gdf.plot(column="population", cmap='OrRd', legend=True, ax=ax)
+    draw_column(h3_population_gdf, "population", ax, backend, cmap='OrRd')
 
     fig.savefig(results_path / f"{city_name}_h3_population.png")
 
 
-def recreational_areas_plotter(points_gdf, city_bounds_gdf, results_path, city_name):
+def recreational_areas_plotter(points_gdf, city_bounds_gdf, results_path, city_name, backend=None):
     """
     Plots recreational_areas points and city boundaries, and saves the plot as an image.
 
@@ -158,6 +365,7 @@ def recreational_areas_plotter(points_gdf, city_bounds_gdf, results_path, city_n
     - city_boundary_gdf (GeoDataFrame): GeoDataFrame containing city boundary geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
@@ -165,14 +373,15 @@ def recreational_areas_plotter(points_gdf, city_bounds_gdf, results_path, city_n
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"{city_name} recreational areas", fontsize=20)
 
-    points_gdf.plot(ax=ax, color='black', markersize=5)
+    draw_geometries(points_gdf, ax, backend, color='black', markersize=5,
+                    grid=figure_grid(backend, points_gdf, city_bounds_gdf))
 
     city_bounds_gdf.plot(ax=ax, edgecolor='black', facecolor='none')
 
     fig.savefig(results_path / f"{city_name}_reacreational_areas.png")
 
 
-def h3_count_recreational_areas_plotter(recreational_areas_gdf, h3_df, results_path, city_name):
+def h3_count_recreational_areas_plotter(recreational_areas_gdf, h3_df, results_path, city_name, backend=None):
     """
     Plots recreational areas points count by H3 area and saves the plot as an image.
 
@@ -181,19 +390,21 @@ def h3_count_recreational_areas_plotter(recreational_areas_gdf, h3_df, results_p
     - h3_df (GeoDataFrame): GeoDataFrame containing aggregated H3 hexagons with counts and geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
     """
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"{city_name} recreational areas points count by h3 area", fontsize=20)
-    h3_df.plot(column="recreational_areas_count", cmap='OrRd',  legend=True, ax=ax)
-    recreational_areas_gdf.plot(ax=ax, markersize=0.4, alpha=1, color="black")
+    grid = figure_grid(backend, h3_df, recreational_areas_gdf)
+    draw_column(h3_df, "recreational_areas_count", ax, backend, cmap='OrRd', grid=grid)
+    draw_geometries(recreational_areas_gdf, ax, backend, color="black", alpha=1, markersize=0.4, grid=grid)
 
     fig.savefig(results_path / f"{city_name}_h3_recreational_areas.png")
 
 
-def distance_to_centrum_plotter(h3_df, central_point, results_path, city_name):
+def distance_to_centrum_plotter(h3_df, central_point, results_path, city_name, backend=None):
     """
     Plots distance from each h3 area to centrum and city boundaries, and saves the plot as an image.
 
@@ -202,6 +413,7 @@ def distance_to_centrum_plotter(h3_df, central_point, results_path, city_name):
     - city_boundary_gdf (GeoDataFrame): GeoDataFrame containing city boundary geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
@@ -209,13 +421,36 @@ def distance_to_centrum_plotter(h3_df, central_point, results_path, city_name):
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"Distance from each h3 area to centrum in {city_name}", fontsize=20)
 
-    h3_df.plot(column="distance_to_centrum", cmap='OrRd', legend=True, ax=ax)
+    draw_column(h3_df, "distance_to_centrum", ax, backend, cmap='OrRd')
     plt.scatter(central_point[0], central_point[1], color="black", s=30, label="Central point")
     ax.legend()
     fig.savefig(results_path / f"{city_name}_distance_to_centrum.png")
 
 
-def results_h3_count_bike_path_plotter(h3_df, results_path, city_name):
+def network_distance_to_centrum_plotter(h3_df, central_point, results_path, city_name, backend=None):
+    """
+    Plots distance along bike paths from each h3 area to centrum, and saves the plot as an image.
+
+    Parameters:
+    - h3_df (GeoDataFrame): GeoDataFrame containing h3 areas and its network distances to centrum.
+    - central_point (tuple): Coordinates of the city center as (longitude, latitude).
+    - results_path (str): Path to the directory where the plot image will be saved.
+    - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
+
+    Returns:
+    - None
+    """
+    fig, ax = plt.subplots(figsize=(12, 10))
+    fig.suptitle(f"Bike path network distance from each h3 area to centrum in {city_name}", fontsize=20)
+
+    draw_column(h3_df, "network_distance_to_centrum", ax, backend, cmap='OrRd')
+    plt.scatter(central_point[0], central_point[1], color="black", s=30, label="Central point")
+    ax.legend()
+    fig.savefig(results_path / f"{city_name}_network_distance_to_centrum.png")
+
+
+def results_h3_count_bike_path_plotter(h3_df, results_path, city_name, backend=None):
     """
     Plots bike path count prediction by H3 area and saves the plot as an image.
 
@@ -223,6 +458,7 @@ def results_h3_count_bike_path_plotter(h3_df, results_path, city_name):
     - h3_df (GeoDataFrame): GeoDataFrame containing aggregated H3 hexagons with predicted counts of bike_paths and geometries.
     - results_path (str): Path to the directory where the plot image will be saved.
     - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
 
     Returns:
     - None
@@ -232,20 +468,79 @@ def results_h3_count_bike_path_plotter(h3_df, results_path, city_name):
 
     max_value = max(h3_df['bike_paths_count'].max(), h3_df['prediction'].max())
 
-    h3_df.plot(column="bike_paths_count", cmap='OrRd', legend=True, ax=ax[0], vmin=0, vmax=max_value)
+    grid = figure_grid(backend, h3_df)
+    draw_column(h3_df, "bike_paths_count", ax[0], backend, cmap='OrRd', vmin=0, vmax=max_value, grid=grid)
     ax[0].set_title(f"Real {city_name} data")
 
-    h3_df.plot(column="prediction", cmap='OrRd', legend=True, ax=ax[1], vmin=0, vmax=max_value)
+    draw_column(h3_df, "prediction", ax[1], backend, cmap='OrRd', vmin=0, vmax=max_value, grid=grid)
     ax[1].set_title(f"Predicted {city_name} data")
 
     fig.savefig(results_path / f"{city_name}_predicted_bike_paths.png")
 
 
-def results_h3_difference_bike_path_plotter(h3_df, results_path, city_name):
+def results_h3_difference_bike_path_plotter(h3_df, results_path, city_name, backend=None):
     fig, ax = plt.subplots(figsize=(12, 10))
     fig.suptitle(f"Difference between predicted and actual bike paths in {city_name}  by h3 area", fontsize=20)
 
     h3_df["difference"] = h3_df["prediction"] - h3_df["bike_paths_count"]
-    h3_df.plot(column="difference", cmap='OrRd', legend=True, ax=ax)
+    draw_column(h3_df, "difference", ax, backend, cmap='OrRd')
+
+    fig.savefig(results_path / f"{city_name}_predicted_difference_bike_paths.png")
+
+
+def results_dominant_driver_plotter(h3_df, results_path, city_name, backend=None):
+    """
+    Plots the feature with the largest contribution to the prediction in each H3 area and saves the plot as an image.
 
-    fig.savefig(results_path / f"{city_name}_predicted_difference_bike_paths.png")
\ No newline at end of file
+    Parameters:
+    - h3_df (GeoDataFrame): GeoDataFrame containing H3 hexagons with predictions explained by
+      modelling.krakow_prediction, including the dominant_driver column.
+    - results_path (str): Path to the directory where the plot image will be saved.
+    - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
+
+    Returns:
+    - None
+    """
+    fig, ax = plt.subplots(figsize=(12, 10))
+    fig.suptitle(f"Dominant driver of predicted bike paths in {city_name} by h3 area", fontsize=20)
+
+    draw_column(h3_df, "dominant_driver", ax, backend, cmap='tab10', categorical=True)
+
+    fig.savefig(results_path / f"{city_name}_predicted_dominant_driver.png")
+
+
+def results_preview_plotter(h3_df, results_path, city_name, backend=None):
+    """
+    Plots a preview pass of bike path count predictions with the width of their confidence intervals and saves
+    the plot as an image.
+
+    Each pass overwrites the image of the previous one, so the map is refined in place.
+
+    Parameters:
+    - h3_df (GeoDataFrame): GeoDataFrame containing H3 hexagons returned by a pass of preview.preview_city.
+    - results_path (str): Path to the directory where the plot image will be saved.
+    - city_name (str): Name of the city for which the plot is generated.
+    - backend (str, optional): "vector" or "raster", plots.default_backend by default.
+
+    Returns:
+    - None
+    """
+    fig, ax = plt.subplots(1, 2, figsize=(12, 10))
+    estimated = h3_df["estimated_features"].iloc[0]
+    fig.suptitle(f"{city_name} bike paths count preview" + (f", estimated {estimated}" if estimated else ""),
+                 fontsize=20)
+
+    h3_df["interval_width"] = h3_df["prediction_high"] - h3_df["prediction_low"]
+    grid = figure_grid(backend, h3_df)
+    draw_column(h3_df, "prediction", ax[0], backend, cmap='OrRd', vmin=0, vmax=h3_df['prediction_high'].max(),
+                grid=grid)
+    ax[0].set_title(f"Predicted {city_name} data")
+
+    # the last pass is exact, its intervals have zero width and are drawn white
+    draw_column(h3_df, "interval_width", ax[1], backend, cmap='Greys', vmin=0,
+                vmax=max(h3_df["interval_width"].max(), 1), grid=grid)
+    ax[1].set_title("Width of the confidence interval")
+
+    fig.savefig(results_path / f"{city_name}_preview_bike_paths.png")
+    plt.close(fig)
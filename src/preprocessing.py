@@ -91,14 +91,28 @@ def dataframe_to_h3_dataframe(df, count_name):
     """
 
     all_h3_indices = [h3_index for indices in df['h3_indices'] for h3_index in indices]
-    h3_counts = Counter(all_h3_indices)
+    return counts_to_h3_dataframe(Counter(all_h3_indices), count_name, df.crs)
+
+
+def counts_to_h3_dataframe(h3_counts, count_name, crs):
+    """
+    Converts counts of H3 indices into a GeoDataFrame containing H3 hexagons.
+
+    Parameters:
+    - h3_counts (Counter): Count of each H3 index.
+    - count_name (str): Name of the count column.
+    - crs: Coordinate reference system of the hexagons.
+
+    Returns:
+    - h3_df (GeoDataFrame): GeoDataFrame containing H3 hexagons with counts and geometries.
+    """
     h3_df = gpd.GeoDataFrame({
         'h3_index': list(h3_counts.keys()),
         count_name: list(h3_counts.values())
     })
 
     h3_df['geometry'] = h3_df['h3_index'].apply(lambda x: h3_to_polygon(x).iloc[0])
-    h3_df.crs = df.crs
+    h3_df.crs = crs
     return h3_df
 
 
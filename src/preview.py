@@ -0,0 +1,452 @@
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import geopandas as gpd
+import h3
+import numpy as np
+import rasterio
+import shapely
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import Polygon
+import src.geoparquet as geoparquet
+import src.modelling as modelling
+import src.osm as osm
+import src.preprocessing as preprocessing
+from src.refresh import layer_columns
+
+# fraction of each point layer counted by the first pass, before the full layers arrive
+sample_fraction = 0.05
+
+# largest fraction of an area covered by the box fetched at its center, so the box lies inside the hexagon
+max_box_fraction = 0.5
+
+# finest H3 resolution of the fetched boxes, finer areas share the box of their parent to keep the query short
+box_resolution = 7
+
+# concurrent Overpass requests, the public instance serves two at a time to each client
+overpass_slots = 2
+
+# number of Monte Carlo draws of the sampled features used for the confidence intervals
+n_draws = 200
+
+# percentiles of the Monte Carlo predictions bounding the confidence interval of each area
+interval_percentiles = (5, 95)
+
+
+def sample_mask(points, fraction):
+    """
+    Selects a deterministic subsample of points by hashing their coordinates.
+
+    The same points are always selected, and every point of a smaller sample is also in each larger
+    one, so successive passes refine the previous ones instead of drawing new samples.
+
+    Parameters:
+    - points (np.ndarray): Array of shape (n, 2) with (latitude, longitude) coordinates.
+    - fraction (float): Expected fraction of selected points.
+
+    Returns:
+    - mask (np.ndarray): Boolean mask of the selected points.
+    """
+    bits = np.ascontiguousarray(points, dtype=np.float64).view(np.uint64)
+    with np.errstate(over="ignore"):
+        hashes = bits[:, 0] * np.uint64(0x9E3779B97F4A7C15) ^ bits[:, 1] * np.uint64(0xC2B2AE3D27D4EB4F)
+        hashes ^= hashes >> np.uint64(31)
+        hashes *= np.uint64(0xBF58476D1CE4E5B9)
+        hashes ^= hashes >> np.uint64(29)
+    return hashes < np.uint64(min(fraction, 1.0) * 2.0 ** 64 - 1)
+
+
+def sampled_counts(points, fraction, h3_indices, resolution):
+    """
+    Counts a deterministic subsample of layer nodes in each H3 area.
+
+    Areas without any sampled node get NaN, as areas without nodes get in city_pipeline.
+
+    Parameters:
+    - points (list): (latitude, longitude) coordinates of the layer nodes.
+    - fraction (float): Fraction of the nodes used.
+    - h3_indices (pd.Series): H3 indices of the areas.
+    - resolution (int): H3 resolution of the areas.
+
+    Returns:
+    - counts (np.ndarray): Number of sampled nodes in each area, NaN if there are none.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if fraction < 1:
+        points = points[sample_mask(points, fraction)]
+    h3_counts = Counter(h3.geo_to_h3(lat, lon, resolution) for lat, lon in points)
+    return h3_indices.map(dict(h3_counts)).to_numpy(dtype=np.float64)
+
+
+def sample_boxes(h3_indices, resolution, fraction):
+    """
+    Creates the boxes fetched from Overpass for the first pass, one at the center of each area.
+
+    Each box covers the given fraction of its area, so the nodes inside it are a spatial sample of the
+    area, like the subsample of cached nodes. Areas finer than box_resolution share the box of their parent.
+
+    Parameters:
+    - h3_indices (pd.Series): H3 indices of the areas.
+    - resolution (int): H3 resolution of the areas.
+    - fraction (float): Fraction of each area covered by its box, at most max_box_fraction.
+
+    Returns:
+    - boxes (dict): (south, west, north, east) box of each H3 index at the resolution of the boxes.
+    """
+    cells = set(h3.h3_to_parent(x, min(resolution, box_resolution)) for x in h3_indices)
+    boxes = {}
+    for cell in sorted(cells):
+        lat, lon = h3.h3_to_geo(cell)
+        # sides of a square box in degrees, a degree of longitude is shorter by cos(latitude)
+        area = Polygon(h3.h3_to_geo_boundary(cell, geo_json=True)).area
+        side = np.sqrt(fraction * area * np.cos(np.radians(lat)))
+        boxes[cell] = (lat - side / 2, lon - side / np.cos(np.radians(lat)) / 2,
+                       lat + side / 2, lon + side / np.cos(np.radians(lat)) / 2)
+    return boxes
+
+
+def boxed_counts(points, boxes, polygon, h3_indices, resolution):
+    """
+    Counts the layer nodes fetched for the boxes of the areas, which lie in the box of their area.
+
+    Overpass returns every node of an element crossing a box, so nodes outside of it are left out,
+    as are nodes outside of the city, which the full layers do not contain either. Areas finer than
+    the boxes get an equal part of the nodes in the box of their parent.
+
+    Parameters:
+    - points (list): (latitude, longitude) coordinates of the fetched nodes.
+    - boxes (dict): Boxes returned by sample_boxes.
+    - polygon (Polygon): Boundary of the city with (longitude, latitude) coordinates.
+    - h3_indices (pd.Series): H3 indices of the areas.
+    - resolution (int): H3 resolution of the areas.
+
+    Returns:
+    - counts (np.ndarray): Number of sampled nodes in each area, NaN if there are none.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    points = points[shapely.contains_xy(polygon, points[:, 1], points[:, 0])]
+    parent_resolution = min(resolution, box_resolution)
+    box_counts = Counter()
+    for lat, lon in points:
+        cell = h3.geo_to_h3(lat, lon, parent_resolution)
+        box = boxes.get(cell)
+        if box is not None and box[0] <= lat <= box[2] and box[1] <= lon <= box[3]:
+            box_counts[cell] += 1
+
+    parents = h3_indices.map(lambda x: h3.h3_to_parent(x, parent_resolution))
+    counts = parents.map(box_counts).fillna(0).to_numpy(dtype=np.float64) / 7 ** (resolution - parent_resolution)
+    return np.where(counts > 0, counts, np.nan)
+
+
+def layer_sample(points, fraction, h3_indices, resolution):
+    """
+    Estimates the counts of a cached layer in each area from a subsample of its nodes.
+
+    Parameters:
+    - points (list): (latitude, longitude) coordinates of the layer nodes.
+    - fraction (float): Fraction of the nodes used, 1 counts all of them.
+    - h3_indices (pd.Series): H3 indices of the areas.
+    - resolution (int): H3 resolution of the areas.
+
+    Returns:
+    - counts (np.ndarray): Estimated count of each area.
+    - sample (tuple): Sampled counts and the fraction, used for the confidence intervals, None if exact.
+    """
+    counts = sampled_counts(points, fraction, h3_indices, resolution)
+    if fraction >= 1:
+        return counts, None
+    return counts / fraction, (counts, fraction)
+
+
+def fetched_sample(layer, boxes, fraction, polygon, h3_indices, resolution):
+    """
+    Estimates the counts of a layer in each area from the nodes in the boxes of the areas, fetched with one
+    short Overpass query, which returns much less data than the query of the full layer.
+
+    Parameters:
+    - layer (str): Name of the layer in osm.layer_selectors.
+    - boxes (dict): Boxes returned by sample_boxes.
+    - fraction (float): Fraction of each area covered by its box.
+    - polygon (Polygon): Boundary of the city with (longitude, latitude) coordinates.
+    - h3_indices (pd.Series): H3 indices of the areas.
+    - resolution (int): H3 resolution of the areas.
+
+    Returns:
+    - counts (np.ndarray): Estimated count of each area.
+    - sample (tuple): Sampled counts and the fraction, used for the confidence intervals.
+    """
+    points = osm.fetch_layer_sample(list(boxes.values()), layer)
+    if points is None:
+        raise RuntimeError(f"Fetching a sample of {layer} from {osm.overpass_url} failed")
+    counts = boxed_counts(points, boxes, polygon, h3_indices, resolution)
+    return counts / fraction, (counts, fraction)
+
+
+def fetched_layer(city_boundaries, layer):
+    """
+    Fetches all nodes of a layer, failing instead of returning None as osm.fetch_layer does.
+    """
+    points, timestamp = osm.fetch_layer(city_boundaries, layer)
+    if points is None:
+        raise RuntimeError(f"Fetching {layer} from {osm.overpass_url} failed")
+    return points, timestamp
+
+
+def decimated_population(h3_df, raster_path, factor):
+    """
+    Estimates the population of each H3 area from a population raster read with fewer, larger pixels.
+
+    Blocks of factor x factor pixels are read as their mean and root mean square, so the whole
+    raster is never read at its full resolution. Blocks are never larger than an area. The population
+    density of an area is sampled at its centroid and halfway to each of its vertices, and multiplied
+    by its area. The standard deviation of the estimate follows from the variation between these
+    samples and of the original pixels within the sampled blocks.
+
+    Parameters:
+    - h3_df (gpd.GeoDataFrame): H3 areas with polygon geometries in the CRS of the raster.
+    - raster_path (Path): Path to the WorldPop raster.
+    - factor (int): Number of original pixels along the side of a read pixel.
+
+    Returns:
+    - population (np.ndarray): Estimated population of each area.
+    - population_sd (np.ndarray): Standard deviation of the estimate.
+    """
+    geometries = h3_df.geometry.to_numpy()
+    areas = shapely.area(geometries)
+    with rasterio.open(raster_path) as src:
+        pixel_area = abs(src.transform.a * src.transform.e)
+        factor = max(min(factor, int(np.sqrt(np.median(areas) / pixel_area))), 1)
+
+        # window of whole pixels covering all areas, clipped to the raster
+        bounds = from_bounds(*h3_df.total_bounds, src.transform)
+        col_off, row_off = int(np.floor(bounds.col_off)), int(np.floor(bounds.row_off))
+        window = Window(col_off, row_off, int(np.ceil(bounds.col_off + bounds.width)) - col_off,
+                        int(np.ceil(bounds.row_off + bounds.height)) - row_off)
+        window = window.intersection(Window(0, 0, src.width, src.height))
+        out_shape = (max(int(np.ceil(window.height / factor)), 1), max(int(np.ceil(window.width / factor)), 1))
+        mean = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.average, masked=True)
+        rms = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.rms, masked=True)
+        transform = src.window_transform(window) * Affine.scale(window.width / out_shape[1],
+                                                                window.height / out_shape[0])
+
+    mean, rms = mean.filled(0).astype(np.float64), rms.filled(0).astype(np.float64)
+    std = np.sqrt(np.maximum(rms ** 2 - mean ** 2, 0))
+
+    # sample points: centroids and points halfway between the centroids and the vertices
+    centroids = shapely.get_coordinates(shapely.centroid(geometries))
+    vertices, owners = shapely.get_coordinates(shapely.get_exterior_ring(geometries), return_index=True)
+    # rings are closed, so their first vertex is repeated at the end and left out
+    first = np.r_[True, owners[1:] != owners[:-1]]
+    vertices, owners = vertices[~first], owners[~first]
+    points = np.concatenate([centroids, (vertices + centroids[owners]) / 2])
+    owners = np.concatenate([np.arange(len(geometries)), owners])
+
+    cols, rows = ~transform * (points[:, 0], points[:, 1])
+    rows = np.clip(np.floor(rows).astype(int), 0, out_shape[0] - 1)
+    cols = np.clip(np.floor(cols).astype(int), 0, out_shape[1] - 1)
+
+    n_samples = np.bincount(owners, minlength=len(geometries))
+    density = np.bincount(owners, mean[rows, cols], len(geometries)) / n_samples
+    between = np.bincount(owners, (mean[rows, cols] - density[owners]) ** 2, len(geometries)) / (n_samples - 1)
+    within = np.bincount(owners, std[rows, cols] ** 2, len(geometries)) / n_samples
+
+    # number of original pixels covered by each area
+    pixels = areas / pixel_area
+    return density * pixels, np.sqrt((between + within) / n_samples) * pixels
+
+
+def base_areas(bike_paths_path, city_boundaries, centrum, resolution):
+    """
+    Creates the H3 areas of a city with their bike path counts and distances to the city center.
+
+    These do not depend on the sampled layers, so they are calculated once for all passes.
+
+    Parameters:
+    - bike_paths_path (Path): GeoParquet file with bike paths.
+    - city_boundaries (gpd.GeoDataFrame): GeoDataFrame containing the boundary of the city.
+    - centrum (tuple): Coordinates of the city center as (longitude, latitude).
+    - resolution (int): H3 resolution of the areas.
+
+    Returns:
+    - h3_df (gpd.GeoDataFrame): H3 areas with h3_index, bike_paths_count, distance_to_centrum and geometry.
+    """
+    h3_counts = geoparquet.h3_counts_from_geoparquet(bike_paths_path, resolution, tuple(city_boundaries.total_bounds))
+    h3_df = gpd.GeoDataFrame({"h3_index": list(h3_counts.keys()), "bike_paths_count": list(h3_counts.values())},
+                             geometry=[Polygon(h3.h3_to_geo_boundary(x, geo_json=True)) for x in h3_counts],
+                             crs="EPSG:4326")
+    return preprocessing.get_distance_to_centrum(h3_df, centrum)
+
+
+def prediction_intervals(h3_df, samples, population_sd, artifact, rng):
+    """
+    Calculates confidence intervals of the predictions with a Monte Carlo batch of perturbed features.
+
+    Each draw perturbs the scaled counts of the sampled layers by their sampling error and the
+    population by the error of the decimated raster. All draws of all areas are predicted in one batch.
+
+    Parameters:
+    - h3_df (gpd.GeoDataFrame): H3 areas with the estimated model features.
+    - samples (dict): Number of sampled nodes in each area and the fraction of the nodes used,
+      for each count column which is still estimated.
+    - population_sd (np.ndarray): Standard deviation of the estimated population of each area.
+    - artifact (dict): Model artifact with fixed scaling statistics.
+    - rng (np.random.Generator): Random number generator.
+
+    Returns:
+    - low (np.ndarray): Lower bound of the prediction of each area.
+    - high (np.ndarray): Upper bound of the prediction of each area.
+    """
+    n_areas = len(h3_df)
+    draws = h3_df[artifact["features"]].iloc[np.tile(np.arange(n_areas), n_draws)].reset_index(drop=True)
+    for column, (counts, fraction) in samples.items():
+        # error of counts scaled up from a Bernoulli sample, with one node added so empty areas vary too
+        counts = np.nan_to_num(counts)
+        sd = np.sqrt((counts + 1) * (1 - fraction)) / fraction
+        values = np.tile(counts / fraction, n_draws) + rng.normal(size=len(draws)) * np.tile(sd, n_draws)
+        # draws without a single node are missing values, as areas without nodes are in city_pipeline
+        draws[column] = np.where(values < 0.5, np.nan, values)
+    draws["population"] = np.maximum(
+        draws["population"].to_numpy() + rng.normal(size=len(draws)) * np.tile(population_sd, n_draws), 0)
+
+    predictions = modelling.predict(draws, artifact).reshape(n_draws, n_areas)
+    low, high = np.percentile(predictions, interval_percentiles, axis=0)
+    return low, high
+
+
+def exact_population(h3_df, population_path):
+    """
+    Sums the full population raster within each area, as city_pipeline does.
+    """
+    return np.asarray(osm.fetch_population_data_worldpop(h3_df, population_path), dtype=np.float64), None
+
+
+def preview_pass(base, estimates, artifact, rng):
+    """
+    Predicts the areas from the current estimates of the features, with confidence intervals.
+
+    Parameters:
+    - base (gpd.GeoDataFrame): Areas returned by base_areas.
+    - estimates (dict): Values of each estimated feature column and their sampling error, which is
+      None once the column is exact, a (counts, fraction) tuple for layers and a standard deviation
+      for the population.
+    - artifact (dict): Model artifact returned by modelling.load_model_artifact.
+    - rng (np.random.Generator): Random number generator.
+
+    Returns:
+    - h3_df (gpd.GeoDataFrame): Areas with the features, prediction, prediction_low, prediction_high
+      and estimated_features columns.
+    """
+    h3_df = base.copy()
+    samples, population_sd = {}, np.zeros(len(h3_df))
+    # columns are added in a fixed order, not in the order in which they arrived
+    for column in [*layer_columns.values(), "population"]:
+        h3_df[column], error = estimates[column]
+        if column == "population" and error is not None:
+            population_sd = error
+        elif error is not None:
+            samples[column] = error
+    estimated = [column for column in [*layer_columns.values(), "population"] if estimates[column][1] is not None]
+
+    # statistics of the estimated features are used for all draws of this pass
+    pass_artifact = modelling.with_dataset_statistics(artifact, h3_df)
+    h3_df["prediction"] = modelling.predict(h3_df, pass_artifact)
+    if estimated:
+        h3_df["prediction_low"], h3_df["prediction_high"] = prediction_intervals(
+            h3_df, samples, population_sd, pass_artifact, rng)
+    else:
+        h3_df["prediction_low"] = h3_df["prediction_high"] = h3_df["prediction"]
+    h3_df["estimated_features"] = ", ".join(estimated)
+    return h3_df
+
+
+def preview_city(city_name, layers, bike_paths_path, population_path, resolution=7, fraction=sample_fraction,
+                 version=None, nthread=None, seed=0):
+    """
+    Predicts bike paths of a city at once from samples of the data and refines the prediction as the full data arrives.
+
+    This generator performs the following steps:
+    1. Creates the H3 areas of the city with their bike path counts and distances to the city center.
+    2. Starts the cheap samples: a subsample of each cached layer, one short Overpass query for a small box
+       at the center of every area for each layer which is not cached, and the population raster decimated
+       by about 1 / sqrt(fraction). The full layers are fetched or counted and the full raster is read
+       at the same time, with the samples queued first.
+    3. Yields the first pass as soon as every feature has an estimate, with confidence intervals
+       from a Monte Carlo batch of perturbed features.
+    4. Yields another pass each time a full layer or the full population lands, with that feature exact.
+    The last pass has no estimated features, the same as city_pipeline, so its intervals have zero width.
+    Bike paths are counted within the bounding box of the city, so for Amsterdam, whose bike paths
+    city_pipeline clips to the boundary, border areas may differ.
+
+    Parameters:
+    - city_name (str): Name of the chosen city.
+    - layers (dict): Boundary and center of the city and the point layers cached by the fetch command of
+      run.py. Point layers missing from it are fetched, and added to it with their sync timestamps,
+      so the caller can cache them.
+    - bike_paths_path (Path): GeoParquet file with bike paths.
+    - population_path (Path): Path to the WorldPop raster of the city.
+    - resolution (int): H3 resolution of the areas.
+    - fraction (float): Fraction of each layer used by the first pass.
+    - version (str, optional): Model version to use, the latest one by default.
+    - nthread (int, optional): Number of threads used for the prediction, all cores by default.
+    - seed (int): Seed of the Monte Carlo draws.
+
+    Returns:
+    - passes (generator): GeoDataFrames of the H3 areas with the estimated features, prediction,
+      prediction_low, prediction_high, estimated_features and elapsed_seconds columns.
+    """
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    city_boundaries = preprocessing.boundary_from_points(layers["boundary"], "EPSG:4326")
+    polygon = Polygon(city_boundaries.loc[0, "geometry"].coords)
+    base = base_areas(bike_paths_path, city_boundaries, layers["centrum"], resolution)
+    artifact = modelling.load_model_artifact(version, nthread)
+    h3_indices = base["h3_index"]
+    box_fraction = min(fraction, max_box_fraction)
+    boxes = sample_boxes(h3_indices, resolution, box_fraction)
+    layers.setdefault("sync", {})
+
+    local = ThreadPoolExecutor()
+    overpass = ThreadPoolExecutor(max_workers=overpass_slots)
+    # each future is a sample or the full data of a feature column, or a full layer to be counted
+    tasks = {}
+    for layer, column in layer_columns.items():
+        if layer in layers:
+            tasks[local.submit(layer_sample, layers[layer], fraction, h3_indices, resolution)] = ("sample", column)
+        else:
+            tasks[overpass.submit(fetched_sample, layer, boxes, box_fraction, polygon, h3_indices,
+                                  resolution)] = ("sample", column)
+    factor = max(int(round(fraction ** -0.5)), 1)
+    tasks[local.submit(decimated_population, base, population_path, factor)] = ("sample", "population")
+    for layer, column in layer_columns.items():
+        if layer in layers:
+            tasks[local.submit(layer_sample, layers[layer], 1.0, h3_indices, resolution)] = ("full", column)
+        else:
+            tasks[overpass.submit(fetched_layer, city_boundaries, layer)] = ("fetch", layer)
+    tasks[local.submit(exact_population, base, population_path)] = ("full", "population")
+
+    estimates = {}
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            changed = False
+            for future in done:
+                kind, name = tasks[future]
+                if kind == "fetch":
+                    # a fetched layer is counted like a cached one, and kept for the caller
+                    layers[name], layers["sync"][name] = future.result()
+                    count = local.submit(layer_sample, layers[name], 1.0, h3_indices, resolution)
+                    tasks[count] = ("full", layer_columns[name])
+                    pending.add(count)
+                elif name not in estimates or estimates[name][1] is not None:
+                    estimates[name] = future.result()
+                    changed = True
+            if changed and len(estimates) == len(layer_columns) + 1:
+                h3_df = preview_pass(base, estimates, artifact, rng)
+                h3_df["elapsed_seconds"] = time.perf_counter() - start
+                yield h3_df
+    finally:
+        for executor in (local, overpass):
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,272 @@
+import json
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
+import h3
+import numpy as np
+import pandas as pd
+import src.modelling as modelling
+import src.osm as osm
+import src.preprocessing as preprocessing
+import src.tables as tables
+
+# point layers refreshed incrementally, with the feature table columns counting their nodes
+layer_columns = {"green_areas": "green_areas_count",
+                 "buildings": "buildings_count",
+                 "recreational_areas": "recreational_areas_count"}
+
+# schema metadata key of the OpenStreetMap time each layer of a feature or predictions table is synchronised to
+sync_metadata_key = b"osm_sync"
+
+
+def parse_augmented_diff(diff):
+    """
+    Reads the node changes of a layer from an Overpass augmented diff.
+
+    Layers count the nodes of their elements, so only node actions are used: nodes leaving the layer
+    (deleted, moved or no longer part of a matching element) are returned with their old coordinates,
+    and nodes entering it (created or moved) with their new ones. A node whose tags changed without
+    moving is both removed and added in the same place, so its count does not change.
+
+    Parameters:
+    - diff (str): Augmented diff XML returned by osm.fetch_augmented_diff.
+
+    Returns:
+    - removed (list): (latitude, longitude) coordinates of nodes leaving the layer.
+    - added (list): (latitude, longitude) coordinates of nodes entering the layer.
+    - timestamp (str): Time of the OpenStreetMap data the diff ends at.
+    """
+    root = ElementTree.fromstring(diff)
+    removed, added = [], []
+    for action in root.iter("action"):
+        if action.get("type") == "create":
+            old, new = None, action.find("node")
+        else:
+            old, new = action.find("old/node"), action.find("new/node")
+
+        if old is not None:
+            removed.append((float(old.get("lat")), float(old.get("lon"))))
+        if new is not None and action.get("type") != "delete":
+            added.append((float(new.get("lat")), float(new.get("lon"))))
+
+    return removed, added, root.find("meta").get("osm_base")
+
+
+def cell_deltas(removed, added, resolution):
+    """
+    Calculates the change of the node count in each H3 area.
+
+    Parameters:
+    - removed (list): (latitude, longitude) coordinates of removed nodes.
+    - added (list): (latitude, longitude) coordinates of added nodes.
+    - resolution (int): H3 resolution of the feature table.
+
+    Returns:
+    - deltas (Counter): Change of the count in each H3 index, areas without a change are left out.
+    """
+    deltas = Counter(h3.geo_to_h3(lat, lon, resolution) for lat, lon in added)
+    deltas.subtract(Counter(h3.geo_to_h3(lat, lon, resolution) for lat, lon in removed))
+    return Counter({h3_index: delta for h3_index, delta in deltas.items() if delta != 0})
+
+
+def update_points(points, removed, added):
+    """
+    Applies removed and added nodes to the cached coordinates of a layer.
+
+    Parameters:
+    - points (list): Cached (latitude, longitude) coordinates of the layer.
+    - removed (list): Coordinates of removed nodes.
+    - added (list): Coordinates of added nodes.
+
+    Returns:
+    - points (list): Updated coordinates of the layer.
+    """
+    remaining = Counter(tuple(point) for point in points) - Counter(removed)
+    return list(remaining.elements()) + added
+
+
+def set_rows(table, column, positions, values):
+    """
+    Replaces the values of a column of an Arrow table in the given rows.
+
+    Parameters:
+    - table (pa.Table): Arrow feature table.
+    - column (str): Name of the column.
+    - positions (np.ndarray): Positions of the replaced rows.
+    - values (array-like): New values of those rows.
+
+    Returns:
+    - table (pa.Table): Arrow table with the replaced column.
+    """
+    # columns of memory-mapped tables are read-only, so they are copied before the rows are replaced
+    series = table[column].to_pandas().copy()
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype(object)
+    series.iloc[positions] = values
+    return table.set_column(table.schema.get_field_index(column), column, tables.arrow_column(series))
+
+
+def apply_deltas(table, column, deltas):
+    """
+    Adds count deltas to a count column of an Arrow feature table.
+
+    Deltas of H3 areas which are not in the table, e.g. areas without bike paths, are skipped.
+
+    Parameters:
+    - table (pa.Table): Arrow feature table with uint64 h3_index.
+    - column (str): Name of the count column.
+    - deltas (Counter): Change of the count in each H3 index.
+
+    Returns:
+    - table (pa.Table): Arrow table with the updated counts.
+    - positions (np.ndarray): Positions of the rows whose count changed.
+    """
+    cells = np.fromiter((h3.string_to_h3(h3_index) for h3_index in deltas), dtype=np.uint64, count=len(deltas))
+    positions = pd.Index(table["h3_index"].to_numpy()).get_indexer(cells)
+    found = positions >= 0
+    positions = positions[found]
+
+    counts = table[column].to_numpy()[positions]
+    changes = np.fromiter(deltas.values(), dtype=np.float64, count=len(deltas))[found]
+    return set_rows(table, column, positions, np.nan_to_num(counts) + changes), positions
+
+
+def read_sync(table):
+    """
+    Reads the sync timestamps of the layers stored in the schema metadata of a table.
+
+    Parameters:
+    - table (pa.Table): Arrow feature or predictions table.
+
+    Returns:
+    - sync (dict): Sync timestamp of each layer, None if the table has none, e.g. when it was written
+      before the timestamps were stored.
+    """
+    metadata = table.schema.metadata or {}
+    if sync_metadata_key not in metadata:
+        return None
+    return json.loads(metadata[sync_metadata_key])
+
+
+def with_sync(table, sync):
+    """
+    Stores the sync timestamps of the layers in the schema metadata of a table, which are kept by write_table.
+    """
+    metadata = {**(table.schema.metadata or {}), sync_metadata_key: json.dumps(sync).encode()}
+    return table.replace_schema_metadata(metadata)
+
+
+def rescore(table, positions, version=None, nthread=None, explain_predictions=False):
+    """
+    Predicts the areas of a predictions table again, in the given rows only.
+
+    Models saved with their training statistics give the same predictions as a full run. The original
+    pickled model is scaled with the statistics of the predicted table, which are calculated from the
+    refreshed table, while the untouched rows keep the predictions made with the previous statistics.
+
+    Parameters:
+    - table (pa.Table): Arrow predictions table written by the predict command of run.py.
+    - positions (np.ndarray): Positions of the rows to predict.
+    - version (str, optional): Model version to use, the latest one by default.
+    - nthread (int, optional): Number of threads used for the prediction, all cores by default.
+    - explain_predictions (bool): If True, contributions and the dominant driver are calculated again.
+
+    Returns:
+    - table (pa.Table): Arrow table with new predictions in the given rows.
+    """
+    if len(positions) == 0:
+        return table
+
+    artifact = modelling.load_model_artifact(version, nthread)
+    artifact = modelling.with_dataset_statistics(artifact, table.select(artifact["features"]).to_pandas())
+
+    rows = table.take(positions)
+    dataset = tables.to_geodataframe(rows, [column for column in rows.column_names if column != "geometry"])
+    predictions = modelling.krakow_prediction(dataset, explain_predictions=explain_predictions, artifact=artifact)
+    for column in predictions.columns:
+        if column == "prediction" or column.startswith("contribution_") or column == "dominant_driver":
+            table = set_rows(table, column, positions, predictions[column].to_numpy())
+    return table
+
+
+def refresh_city(layers, feature_table, predictions_table=None, resolution=None, version=None, nthread=None):
+    """
+    Updates the point layer counts of a city with the OpenStreetMap changes since its last synchronisation.
+
+    This function performs the following steps:
+    1. Reads the sync timestamps of the cached layers and of each table, stored in its schema metadata.
+    2. Fetches an Overpass augmented diff of each layer since each of these timestamps, usually a single one.
+    3. Applies removed and added nodes to the cached coordinates of the layer.
+    4. Adds the count deltas to the touched H3 areas of the feature and predictions tables.
+    5. Predicts the touched areas again, leaving all other predictions as they are.
+    6. Stores the timestamp of each diff as the new sync timestamp of the layers and tables it was applied to.
+
+    Every output carries its own sync timestamps, so they can be saved in any order. When saving fails
+    after some of them, the next refresh applies to each output only the changes it does not have yet,
+    instead of applying the same diff twice to the outputs which were saved.
+    Network distances to recreational areas are not updated, they are recalculated by the features command.
+
+    Parameters:
+    - layers (dict): OpenStreetMap layers cached by the fetch command of run.py, with sync timestamps.
+    - feature_table (pa.Table): Arrow feature table of the city. Tables without sync timestamps, e.g. written
+      before they were stored, are taken to be synchronised with the layers.
+    - predictions_table (pa.Table, optional): Arrow predictions table of the city.
+    - resolution (int, optional): Expected H3 resolution of the tables, e.g. from the command line. The
+      resolution is read from the feature table and an error is raised if it is a different one.
+    - version (str, optional): Model version used for the touched areas, the latest one by default.
+    - nthread (int, optional): Number of threads used for the prediction, all cores by default.
+
+    Returns:
+    - layers (dict): Layers with updated coordinates and sync timestamps.
+    - feature_table (pa.Table): Feature table with updated counts and sync timestamps.
+    - predictions_table (pa.Table): Predictions table with updated counts, predictions and sync timestamps,
+      None if not given.
+    - touched (int): Number of H3 areas whose counts changed.
+    """
+    if "sync" not in layers:
+        raise ValueError("Cached layers have no sync timestamps, run the fetch command again")
+
+    # deltas must be counted at the resolution of the stored tables, or they would match none of their areas
+    table_resolution = tables.table_resolution(feature_table)
+    if resolution is not None and table_resolution is not None and resolution != table_resolution:
+        raise ValueError(f"Feature table has h3 resolution {table_resolution}, not {resolution}")
+    resolution = table_resolution if table_resolution is not None else resolution
+
+    layers = dict(layers, sync=dict(layers["sync"]))
+    outputs = {"layers": layers["sync"], "features": dict(read_sync(feature_table) or layers["sync"])}
+    if predictions_table is not None:
+        outputs["predictions"] = dict(read_sync(predictions_table) or layers["sync"])
+
+    city_boundaries = preprocessing.boundary_from_points(layers["boundary"], "EPSG:4326")
+    touched, rescored = set(), set()
+    for layer, column in layer_columns.items():
+        synced = {name: sync[layer] for name, sync in outputs.items()}
+        for since in sorted(set(synced.values())):
+            diff = osm.fetch_augmented_diff(city_boundaries, layer, since)
+            if diff is None:
+                raise RuntimeError(f"Fetching changes of {layer} from {osm.overpass_url} failed")
+
+            removed, added, timestamp = parse_augmented_diff(diff)
+            deltas = cell_deltas(removed, added, resolution)
+            targets = [name for name, value in synced.items() if value == since]
+            if "layers" in targets:
+                layers[layer] = update_points(layers[layer], removed, added)
+            if "features" in targets:
+                feature_table, positions = apply_deltas(feature_table, column, deltas)
+                touched.update(feature_table["h3_index"].to_numpy()[positions].tolist())
+            if "predictions" in targets:
+                predictions_table, positions = apply_deltas(predictions_table, column, deltas)
+                rescored.update(predictions_table["h3_index"].to_numpy()[positions].tolist())
+                touched.update(predictions_table["h3_index"].to_numpy()[positions].tolist())
+            for name in targets:
+                outputs[name][layer] = timestamp
+
+    feature_table = with_sync(feature_table, outputs["features"])
+    if predictions_table is not None:
+        if rescored:
+            cells = np.fromiter(rescored, dtype=np.uint64, count=len(rescored))
+            positions = pd.Index(predictions_table["h3_index"].to_numpy()).get_indexer(cells)
+            predictions_table = rescore(predictions_table, positions, version, nthread,
+                                        "dominant_driver" in predictions_table.column_names)
+        predictions_table = with_sync(predictions_table, outputs["predictions"])
+
+    return layers, feature_table, predictions_table, len(touched)
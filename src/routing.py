@@ -0,0 +1,345 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial import cKDTree
+
+cache_path = Path.cwd() / "DATA" / "cache" / "graphs"
+
+# mean radius of the earth in meters used for the local metric projection
+earth_radius = 6371008.8
+
+# path vertices closer than this distance in meters are snapped to the same graph node
+snap_tolerance = 1.0
+
+# number of sources solved at once when distances to several amenities are needed
+sources_chunk_size = 64
+
+# ratio of network to straight-line distances assumed by the first bounded search to the nearest targets
+search_detour_factor = 1.5
+
+# shortest distance limit in meters of a bounded search, so searches from nodes next to a target still grow
+min_search_limit = 500.0
+
+
+def project_coords(lon, lat, origin_lat):
+    """
+    Projects longitude and latitude arrays to a local equirectangular plane in meters.
+
+    At city scale the error of this projection is well below one percent, which is precise enough
+    for routing distances and lets every distance be computed with plain vectorized numpy.
+
+    Parameters:
+    - lon (np.ndarray): Longitudes in degrees.
+    - lat (np.ndarray): Latitudes in degrees.
+    - origin_lat (float): Latitude in degrees at which the projection is true to scale.
+
+    Returns:
+    - xy (np.ndarray): Array of shape (n, 2) with projected x and y coordinates in meters.
+    """
+    x = earth_radius * np.radians(lon) * np.cos(np.radians(origin_lat))
+    y = earth_radius * np.radians(lat)
+    return np.column_stack([x, y])
+
+
+def graph_hash(geometries, tolerance=snap_tolerance):
+    """
+    Calculates a hash identifying the graph built from the given line geometries.
+
+    Parameters:
+    - geometries (GeoSeries or array of LineString): Bike path geometries.
+    - tolerance (float): Snapping tolerance in meters used to build the graph.
+
+    Returns:
+    - hash (str): Hex digest which changes whenever the geometries or the tolerance change.
+    """
+    coords, line_ids = shapely.get_coordinates(shapely.get_parts(np.asarray(geometries)), return_index=True)
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(line_ids, dtype=np.int64).tobytes())
+    digest.update(str(tolerance).encode())
+    return digest.hexdigest()
+
+
+def build_graph(geometries, tolerance=snap_tolerance):
+    """
+    Builds a sparse, undirected graph of the bike path network from line geometries.
+
+    This function performs the following steps:
+    1. Splits multi-part geometries and collects all path vertices.
+    2. Projects the vertices to meters and snaps vertices closer than the tolerance into one node.
+    3. Creates an edge between each pair of consecutive vertices of a path, weighted by its length.
+    4. Removes duplicated edges, keeping the shortest one.
+    5. Marks the nodes belonging to the largest connected component.
+
+    Parameters:
+    - geometries (GeoSeries or array of LineString): Bike path geometries in EPSG:4326.
+    - tolerance (float): Snapping tolerance in meters.
+
+    Returns:
+    - graph (dict): Dictionary containing:
+        - matrix: scipy.sparse.csr_matrix with edge lengths in meters.
+        - nodes: Array of shape (n, 2) with node coordinates as (longitude, latitude).
+        - nodes_xy: Array of shape (n, 2) with projected node coordinates in meters.
+        - origin_lat: Latitude used for the projection.
+        - main_component: Boolean mask of nodes in the largest connected component.
+    """
+    # collecting vertices together with the id of the path they belong to
+    coords, line_ids = shapely.get_coordinates(shapely.get_parts(np.asarray(geometries)), return_index=True)
+    origin_lat = float(coords[:, 1].mean())
+    xy = project_coords(coords[:, 0], coords[:, 1], origin_lat)
+
+    # snapping vertices to a grid of the tolerance size, so touching paths share their nodes
+    keys = np.round(xy / tolerance).astype(np.int64)
+    _, first_vertex, vertex_node = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    vertex_node = vertex_node.ravel()
+    nodes = coords[first_vertex]
+    nodes_xy = xy[first_vertex]
+
+    # consecutive vertices of the same path form an edge
+    same_line = line_ids[:-1] == line_ids[1:]
+    u = vertex_node[:-1][same_line]
+    v = vertex_node[1:][same_line]
+    not_loop = u != v
+    u, v = np.minimum(u[not_loop], v[not_loop]), np.maximum(u[not_loop], v[not_loop])
+    weights = np.linalg.norm(nodes_xy[u] - nodes_xy[v], axis=1)
+
+    # keeping only the shortest of duplicated edges, as a sparse matrix would sum them
+    order = np.lexsort((weights, v, u))
+    u, v, weights = u[order], v[order], weights[order]
+    first_edge = np.ones(len(u), dtype=bool)
+    first_edge[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    n_nodes = len(nodes)
+    matrix = coo_matrix((weights[first_edge], (u[first_edge], v[first_edge])), shape=(n_nodes, n_nodes)).tocsr()
+
+    # h3 areas are snapped only to the largest component, so every one of them is reachable
+    _, labels = connected_components(matrix, directed=False)
+    main_component = labels == np.bincount(labels).argmax()
+
+    return {"matrix": matrix,
+            "nodes": nodes,
+            "nodes_xy": nodes_xy,
+            "origin_lat": origin_lat,
+            "main_component": main_component}
+
+
+def save_graph(graph, path):
+    """
+    Saves a graph created by build_graph to a compressed numpy file.
+
+    The graph is written to a temporary file in the same directory, which then replaces the target,
+    so processes sharing the cache never load a partially written graph.
+
+    Parameters:
+    - graph (dict): Graph returned by build_graph.
+    - path (Path): Path of the .npz file to write.
+
+    Returns:
+    - None
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    matrix = graph["matrix"]
+    # unique temporary name, as several workers may build the same graph at the same time
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=path.parent, prefix=f"{path.stem}.", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            np.savez_compressed(file,
+                                data=matrix.data,
+                                indices=matrix.indices,
+                                indptr=matrix.indptr,
+                                shape=np.asarray(matrix.shape),
+                                nodes=graph["nodes"],
+                                nodes_xy=graph["nodes_xy"],
+                                origin_lat=graph["origin_lat"],
+                                main_component=graph["main_component"])
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def load_graph(path):
+    """
+    Loads a graph saved by save_graph.
+
+    Parameters:
+    - path (Path): Path of the .npz file.
+
+    Returns:
+    - graph (dict): Graph in the same form as returned by build_graph.
+    """
+    with np.load(path) as data:
+        matrix = csr_matrix((data["data"], data["indices"], data["indptr"]), shape=tuple(data["shape"]))
+        return {"matrix": matrix,
+                "nodes": data["nodes"],
+                "nodes_xy": data["nodes_xy"],
+                "origin_lat": float(data["origin_lat"]),
+                "main_component": data["main_component"]}
+
+
+def get_graph(geometries, tolerance=snap_tolerance):
+    """
+    Returns the graph of the bike path network, building it only if it is not cached yet.
+
+    Graphs are cached on disk under the hash of their input geometries, so the same bike path
+    dataset is converted into a graph only once.
+
+    Parameters:
+    - geometries (GeoSeries or array of LineString): Bike path geometries in EPSG:4326.
+    - tolerance (float): Snapping tolerance in meters.
+
+    Returns:
+    - graph (dict): Graph in the same form as returned by build_graph.
+    """
+    graph_path = cache_path / f"{graph_hash(geometries, tolerance)}.npz"
+    # cached graphs are only ever replaced as a whole, so loading needs no check before it
+    try:
+        return load_graph(graph_path)
+    except FileNotFoundError:
+        pass
+
+    graph = build_graph(geometries, tolerance)
+    save_graph(graph, graph_path)
+    return graph
+
+
+def snap_points(graph, points):
+    """
+    Snaps points to their nearest node in the largest connected component of the graph.
+
+    Parameters:
+    - graph (dict): Graph returned by get_graph.
+    - points (np.ndarray): Array of shape (n, 2) with (longitude, latitude) coordinates.
+
+    Returns:
+    - nodes (np.ndarray): Index of the nearest graph node for each point.
+    - access_distances (np.ndarray): Straight-line distance in meters from each point to its node.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    component_nodes = np.flatnonzero(graph["main_component"])
+    tree = cKDTree(graph["nodes_xy"][component_nodes])
+    access_distances, nearest = tree.query(project_coords(points[:, 0], points[:, 1], graph["origin_lat"]))
+    return component_nodes[nearest], access_distances
+
+
+def network_distance_to_point(graph, points, target):
+    """
+    Calculates the distance along the bike path network from each point to a single target.
+
+    The distance consists of the straight-line access from the point to the network, the shortest
+    path along the network and the straight-line egress from the network to the target.
+
+    Parameters:
+    - graph (dict): Graph returned by get_graph.
+    - points (np.ndarray): Array of shape (n, 2) with (longitude, latitude) coordinates.
+    - target (tuple): Target coordinates as (longitude, latitude).
+
+    Returns:
+    - distances (np.ndarray): Network distance in meters from each point to the target.
+    """
+    point_nodes, access_distances = snap_points(graph, points)
+    target_nodes, egress_distances = snap_points(graph, target)
+
+    # graph is undirected, so one search from the target reaches every point
+    target_distances = dijkstra(graph["matrix"], directed=False, indices=target_nodes[0])
+    return access_distances + target_distances[point_nodes] + egress_distances[0]
+
+
+def nearest_target_distances(graph, source_nodes, target_nodes, egress_distances, n_nearest):
+    """
+    Calculates the mean network distance from each source node to its n nearest targets with bounded searches.
+
+    Each Dijkstra search stops at a distance limit, which starts at the straight-line distance to the n-th
+    nearest target node times search_detour_factor. A source is solved when the distances to its n nearest
+    targets, including their egress, are within the limit, as every target beyond the limit is farther.
+    Sources which are not solved are searched again with a doubled limit. Searches are run in chunks of
+    sources with similar limits, so a search only explores the network around its source.
+
+    Parameters:
+    - graph (dict): Graph returned by get_graph.
+    - source_nodes (np.ndarray): Graph nodes to calculate the distances from.
+    - target_nodes (np.ndarray): Graph nodes of the targets.
+    - egress_distances (np.ndarray): Straight-line distance in meters from each target node to its target.
+    - n_nearest (int): Number of nearest targets to average the distance over, at most the number of targets.
+
+    Returns:
+    - distances (np.ndarray): Mean network distance in meters from each source node to its n nearest targets.
+    """
+    nodes_xy = graph["nodes_xy"]
+    # the straight line is never longer than the path along the network
+    straight_distances, _ = cKDTree(nodes_xy[target_nodes]).query(nodes_xy[source_nodes], k=n_nearest)
+    straight_distances = np.asarray(straight_distances).reshape(len(source_nodes), -1)[:, -1]
+    limits = np.maximum(search_detour_factor * straight_distances, min_search_limit)
+
+    distances = np.empty(len(source_nodes))
+    remaining = np.arange(len(source_nodes))
+    while len(remaining):
+        order = remaining[np.argsort(limits[remaining], kind="stable")]
+        unsolved = []
+        for start in range(0, len(order), sources_chunk_size):
+            chunk = order[start:start + sources_chunk_size]
+            limit = limits[chunk].max()
+            chunk_distances = dijkstra(graph["matrix"], directed=False, indices=source_nodes[chunk],
+                                       limit=limit)[:, target_nodes]
+            chunk_distances += egress_distances
+            chunk_distances = np.partition(chunk_distances, n_nearest - 1, axis=1)[:, :n_nearest]
+            solved = chunk_distances.max(axis=1) <= limit
+            distances[chunk[solved]] = chunk_distances[solved].mean(axis=1)
+            limits[chunk] = limit
+            unsolved.append(chunk[~solved])
+        remaining = np.concatenate(unsolved)
+        limits[remaining] *= 2
+
+    return distances
+
+
+def network_distance_to_nearest(graph, points, targets, n_nearest=1):
+    """
+    Calculates the mean distance along the bike path network from each point to its n nearest targets.
+
+    For a single nearest target a multi-source Dijkstra search is run from a virtual node connected
+    to every target node, which solves all points in one pass. For more targets bounded searches are
+    run from the nodes of the points, see nearest_target_distances.
+
+    Parameters:
+    - graph (dict): Graph returned by get_graph.
+    - points (np.ndarray): Array of shape (n, 2) with (longitude, latitude) coordinates.
+    - targets (np.ndarray): Array of shape (m, 2) with (longitude, latitude) target coordinates.
+    - n_nearest (int): Number of nearest targets to average the distance over.
+
+    Returns:
+    - distances (np.ndarray): Mean network distance in meters from each point to its n nearest targets,
+      NaN for every point if there are no targets.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    targets = np.asarray(targets, dtype=np.float64).reshape(-1, 2)
+    if len(targets) == 0:
+        # missing distances, the same as areas without a count of a layer
+        return np.full(len(points), np.nan)
+
+    point_nodes, access_distances = snap_points(graph, points)
+    target_nodes, egress_distances = snap_points(graph, targets)
+    n_nearest = min(n_nearest, len(target_nodes))
+
+    if n_nearest == 1:
+        # virtual source node linked to each target node with its shortest egress distance,
+        # which must stay non-zero as zeros are not stored in a sparse graph
+        n_nodes = graph["matrix"].shape[0]
+        link_weights = np.full(n_nodes, np.inf)
+        np.minimum.at(link_weights, target_nodes, egress_distances)
+        linked_nodes = np.flatnonzero(np.isfinite(link_weights))
+        links = coo_matrix((np.maximum(link_weights[linked_nodes], np.finfo(np.float64).tiny),
+                            (np.full(len(linked_nodes), n_nodes), linked_nodes)),
+                           shape=(n_nodes + 1, n_nodes + 1))
+        matrix = graph["matrix"].copy()
+        matrix.resize((n_nodes + 1, n_nodes + 1))
+        source_distances = dijkstra((matrix + links).tocsr(), directed=False, indices=n_nodes)
+        return access_distances + source_distances[point_nodes]
+
+    unique_nodes, point_positions = np.unique(point_nodes, return_inverse=True)
+    nearest_distances = nearest_target_distances(graph, unique_nodes, target_nodes, egress_distances, n_nearest)
+    return access_distances + nearest_distances[point_positions.ravel()]
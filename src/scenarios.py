@@ -0,0 +1,125 @@
+import h3
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.sparse import coo_matrix
+import src.features as features
+import src.modelling as modelling
+
+
+def scenario_cells(scenarios, resolution=None):
+    """
+    Finds the H3 areas touched by every added and removed bike path of all scenarios at once.
+
+    Paths are indexed the same way as in features.bike_paths_function: a path counts once in each
+    H3 area containing at least one of its vertices.
+
+    Parameters:
+    - scenarios (list of dict): Scenarios, each with optional "added" and "removed" lists of
+      LineString geometries in EPSG:4326.
+    - resolution (int, optional): H3 resolution, features.h3_resolution by default.
+
+    Returns:
+    - cells (pd.DataFrame): One row per touched (scenario, H3 area, path) with columns:
+        - scenario: Position of the scenario in the list.
+        - h3_index: H3 index touched by the path.
+        - change: 1 for an added path, -1 for a removed one.
+    """
+    if resolution is None:
+        resolution = features.h3_resolution
+
+    # flattening paths of all scenarios into one array to index them in a single pass
+    geometries, scenario_ids, changes = [], [], []
+    for scenario_id, scenario in enumerate(scenarios):
+        for key, change in (("added", 1), ("removed", -1)):
+            paths = list(scenario.get(key, []))
+            geometries.extend(paths)
+            scenario_ids.extend([scenario_id] * len(paths))
+            changes.extend([change] * len(paths))
+
+    coords, path_ids = shapely.get_coordinates(np.asarray(geometries, dtype=object), return_index=True)
+    cells = pd.DataFrame({"path": path_ids,
+                          "h3_index": [h3.geo_to_h3(lat, lon, resolution) for lon, lat in coords]})
+
+    # a path counts once in each h3 area, no matter how many of its vertices lie there
+    cells = cells.drop_duplicates()
+    cells["scenario"] = np.asarray(scenario_ids, dtype=np.int64)[cells["path"].to_numpy()]
+    cells["change"] = np.asarray(changes, dtype=np.int64)[cells["path"].to_numpy()]
+    return cells[["scenario", "h3_index", "change"]].reset_index(drop=True)
+
+
+def evaluate_scenarios(base_table, scenarios, artifact=None, resolution=None):
+    """
+    Evaluates a batch of bike path scenarios against a scored feature table.
+
+    This function performs the following steps:
+    1. Predicts the base table once, unless it already has a prediction column.
+    2. Finds the H3 areas touched by the added and removed paths of all scenarios.
+    3. Builds a sparse (scenario x H3 area) matrix of bike path count changes.
+    4. Recalculates bike_paths_count and the difference to the prediction only in the touched areas.
+    5. Summarizes the remaining need for bike paths of each scenario.
+    Bike paths are what the model predicts, not one of its features, so the touched areas keep the
+    prediction of the base table and no area is scored again.
+
+    Parameters:
+    - base_table (pd.DataFrame): Feature table of a city, e.g. the table of run.city_pipeline converted with tables.to_geodataframe.
+    - scenarios (list of dict): Scenarios, each with optional "added" and "removed" lists of
+      LineString geometries in EPSG:4326.
+    - artifact (dict, optional): Model artifact returned by modelling.load_model_artifact, the latest by default.
+    - resolution (int, optional): H3 resolution of the base table, features.h3_resolution by default.
+
+    Returns:
+    - changed_cells (pd.DataFrame): One row per scenario and touched H3 area with columns:
+        - scenario: Position of the scenario in the list.
+        - h3_index: H3 hexagon index.
+        - bike_paths_count: Count of bike paths in the scenario.
+        - prediction: Predicted count of bike paths, NaN for areas missing in the base table.
+        - difference: Difference between the predicted and the scenario count of bike paths.
+    - summary (pd.DataFrame): One row per scenario with columns:
+        - scenario: Position of the scenario in the list.
+        - changed_cells: Number of H3 areas with a changed count of bike paths.
+        - missing_bike_paths: Sum of positive differences over all areas of the city.
+    """
+    if artifact is None:
+        artifact = modelling.load_model_artifact()
+
+    base_counts = base_table["bike_paths_count"].fillna(0).to_numpy(dtype=np.float64)
+    if "prediction" in base_table:
+        base_predictions = base_table["prediction"].to_numpy(dtype=np.float64)
+    else:
+        base_predictions = np.asarray(modelling.predict(base_table.fillna(0), artifact), dtype=np.float64)
+    base_need = np.clip(base_predictions - base_counts, 0, None).sum()
+
+    # areas touched only by new paths are appended after the areas of the base table
+    cells = scenario_cells(scenarios, resolution)
+    base_index = pd.Index(base_table["h3_index"])
+    new_cells = pd.Index(cells["h3_index"].unique()).difference(base_index)
+    all_cells = base_index.append(new_cells)
+    base_counts = np.concatenate([base_counts, np.zeros(len(new_cells))])
+    base_predictions = np.concatenate([base_predictions, np.full(len(new_cells), np.nan)])
+
+    # summing changes of all paths of a scenario in each area
+    changes = coo_matrix((cells["change"].to_numpy(dtype=np.float64),
+                          (cells["scenario"].to_numpy(), all_cells.get_indexer(cells["h3_index"]))),
+                         shape=(len(scenarios), len(all_cells))).tocsr()
+    changes.eliminate_zeros()
+    changes = changes.tocoo()
+    scenario_ids, positions = changes.row, changes.col
+
+    counts = np.clip(base_counts[positions] + changes.data, 0, None)
+    predictions = base_predictions[positions]
+    differences = predictions - counts
+    changed_cells = pd.DataFrame({"scenario": scenario_ids,
+                                  "h3_index": all_cells[positions],
+                                  "bike_paths_count": counts,
+                                  "prediction": predictions,
+                                  "difference": differences})
+
+    # remaining need changes only in the touched areas
+    old_need = np.clip(base_predictions[positions] - base_counts[positions], 0, None)
+    need_change = np.nan_to_num(np.clip(differences, 0, None) - old_need)
+    summary = pd.DataFrame({"scenario": np.arange(len(scenarios)),
+                            "changed_cells": np.bincount(scenario_ids, minlength=len(scenarios)),
+                            "missing_bike_paths": base_need + np.bincount(scenario_ids, weights=need_change,
+                                                                          minlength=len(scenarios))})
+    return changed_cells, summary
@@ -0,0 +1,402 @@
+import json
+import mimetypes
+import multiprocessing
+import os
+import sqlite3
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# stages of a scoring job, in the order they are run
+job_stages = ["fetch", "features", "predict", "plot"]
+
+# seconds an idle worker waits before looking for a queued job again
+poll_interval = 1.0
+
+# number of finished jobs listed by GET /jobs
+listed_jobs = 100
+
+
+def connect(db_path):
+    """
+    Opens a connection to the job queue database, creating its tables if they do not exist.
+
+    Each thread and worker process uses its own connection. Transactions which change the queue are
+    started with BEGIN IMMEDIATE, so they are serialised between all of them.
+
+    Parameters:
+    - db_path (Path): Path of the SQLite database.
+
+    Returns:
+    - connection (sqlite3.Connection): Connection in autocommit mode, returning rows as sqlite3.Row.
+    """
+    connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            city TEXT NOT NULL,
+            resolution INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            stage TEXT,
+            progress REAL NOT NULL DEFAULT 0,
+            force INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+    """)
+    # locks are only held while a job runs, so a table of an older version without the holder's pid is recreated
+    columns = [row["name"] for row in connection.execute("PRAGMA table_info(locks)")]
+    if columns and "pid" not in columns:
+        connection.execute("DROP TABLE locks")
+    connection.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, job_id INTEGER, pid INTEGER)")
+    return connection
+
+
+def job_dict(row, results_root=None):
+    """
+    Converts a job row into a JSON serialisable dict, listing result files of finished jobs.
+    """
+    job = dict(row)
+    if results_root is not None and job["status"] == "done":
+        directory = job_directory(results_root, job["city"], job["resolution"])
+        job["results"] = [f"/results/{path.relative_to(results_root).as_posix()}"
+                          for path in sorted(directory.rglob("*")) if path.is_file()]
+    return job
+
+
+def job_directory(results_root, city, resolution):
+    """
+    Returns the directory with the feature table, predictions and plots of a city at a resolution.
+    """
+    import run
+
+    return results_root / run.table_name(city) / f"resolution_{resolution}"
+
+
+def directory_resolution(name):
+    """
+    Returns the resolution of a job directory name, e.g. 7 for "resolution_7", None for other names.
+    """
+    prefix, _, resolution = name.partition("_")
+    return int(resolution) if prefix == "resolution" and resolution.isdigit() else None
+
+
+def submit_job(connection, city, resolution, force=False):
+    """
+    Queues a scoring job, unless the same city and resolution is already queued, running or done.
+
+    Identical jobs in flight are de-duplicated: all submissions get the id of the same job. A finished
+    job is returned as it is, with its results served from disk, unless force is set.
+
+    Parameters:
+    - connection (sqlite3.Connection): Connection to the job queue database.
+    - city (str): Name of the city.
+    - resolution (int): H3 resolution of the areas.
+    - force (bool): If True, a finished job is run again, e.g. after the model was retrained.
+
+    Returns:
+    - job (sqlite3.Row): Queued, running or finished job.
+    - created (bool): True if a new job was queued.
+    """
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        statuses = ("queued", "running") if force else ("queued", "running", "done")
+        job = connection.execute(
+            f"SELECT * FROM jobs WHERE city = ? AND resolution = ? AND status IN ({', '.join('?' * len(statuses))}) "
+            "ORDER BY id DESC LIMIT 1", (city, resolution, *statuses)).fetchone()
+        created = job is None
+        if created:
+            job_id = connection.execute(
+                "INSERT INTO jobs (city, resolution, status, force, created) VALUES (?, ?, 'queued', ?, ?)",
+                (city, resolution, int(force), time.time())).lastrowid
+            job = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return job, created
+
+
+def claim_job(connection):
+    """
+    Takes the oldest queued job and marks it as running.
+
+    Parameters:
+    - connection (sqlite3.Connection): Connection to the job queue database.
+
+    Returns:
+    - job (sqlite3.Row): Claimed job, None if the queue is empty.
+    """
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        job = connection.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+        if job is not None:
+            connection.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                               (time.time(), job["id"]))
+        connection.execute("COMMIT")
+    except BaseException:
+        # a failed claim must not keep the write lock, or every other worker would wait for it
+        connection.execute("ROLLBACK")
+        raise
+    return job
+
+
+def update_job(connection, job_id, **values):
+    """
+    Sets columns of a job, e.g. its stage and progress.
+    """
+    assignments = ", ".join(f"{column} = ?" for column in values)
+    connection.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*values.values(), job_id))
+
+
+def process_alive(pid):
+    """
+    Tells whether a process with the given pid is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists, but belongs to another user
+        return True
+    return True
+
+
+def acquire_lock(connection, name, job_id):
+    """
+    Waits until a named lock is free and takes it, e.g. so the layers of a city are fetched only once
+    when jobs of several resolutions of the city run at the same time.
+
+    The lock records the pid of the worker holding it. A lock whose worker died, e.g. was killed during
+    a fetch, is broken, instead of blocking the jobs of the city until the service is restarted.
+    """
+    while True:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            holder = connection.execute("SELECT pid FROM locks WHERE name = ?", (name,)).fetchone()
+            if holder is not None and not process_alive(holder["pid"]):
+                connection.execute("DELETE FROM locks WHERE name = ?", (name,))
+                holder = None
+            if holder is None:
+                connection.execute("INSERT INTO locks (name, job_id, pid) VALUES (?, ?, ?)",
+                                   (name, job_id, os.getpid()))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if holder is None:
+            return
+        time.sleep(poll_interval)
+
+
+def release_lock(connection, name):
+    connection.execute("DELETE FROM locks WHERE name = ?", (name,))
+
+
+def run_job(connection, job, results_root, overpass_url):
+    """
+    Runs the fetch, features, predict and plot stages of a job, reporting the progress after each stage.
+
+    Stages reuse the results other jobs left on disk: layers of a city are fetched once for all
+    resolutions, and a feature table which already exists is not calculated again, unless the job
+    is forced.
+
+    Parameters:
+    - connection (sqlite3.Connection): Connection to the job queue database.
+    - job (sqlite3.Row): Running job.
+    - results_root (Path): Directory with the results of all jobs.
+    - overpass_url (str): Overpass API interpreter used to fetch the layers.
+
+    Returns:
+    - None
+    """
+    import run
+
+    directory = job_directory(results_root, job["city"], job["resolution"])
+    directory.mkdir(parents=True, exist_ok=True)
+    args = run.parse_args(["run", "--city", job["city"], "--resolution", str(job["resolution"]),
+                           "--output", str(directory), "--overpass-url", overpass_url])
+
+    for i, stage in enumerate(job_stages):
+        update_job(connection, job["id"], stage=stage, progress=i / len(job_stages))
+        if stage == "fetch":
+            lock_name = f"layers:{run.table_name(job['city'])}"
+            acquire_lock(connection, lock_name, job["id"])
+            try:
+                if job["force"] or not run.layers_path(args).exists():
+                    run.fetch_command(args)
+            finally:
+                release_lock(connection, lock_name)
+        elif stage == "features":
+            if job["force"] or not run.features_path(args).exists():
+                run.features_command(args)
+        elif stage == "predict":
+            run.predict_command(args)
+        elif stage == "plot":
+            run.plot_command(args)
+
+    update_job(connection, job["id"], status="done", stage=None, progress=1.0, finished=time.time())
+
+
+def worker(db_path, results_root, overpass_url):
+    """
+    Runs queued jobs one after another in a worker process, until the process is terminated.
+    """
+    import matplotlib
+
+    # plots are only saved to files, no window is opened
+    matplotlib.use("Agg")
+    connection = connect(db_path)
+    while True:
+        job = claim_job(connection)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        try:
+            run_job(connection, job, results_root, overpass_url)
+        except Exception:
+            update_job(connection, job["id"], status="failed", error=traceback.format_exc(), finished=time.time())
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP API of the service:
+    - POST /jobs with {"city": ..., "resolution": ..., "force": false} queues a job.
+    - GET /jobs lists queued, running and recent jobs.
+    - GET /jobs/<id> returns the status, stage, progress and result files of a job.
+    - GET /results/<path> serves a result file of a job from disk.
+    """
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            city, resolution = str(request["city"]), int(request.get("resolution", 7))
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": "expected JSON with city and optional resolution and force"})
+            return
+
+        connection = connect(self.server.db_path)
+        try:
+            job, created = submit_job(connection, city, resolution, bool(request.get("force", False)))
+            self.send_json(202 if created else 200, job_dict(job, self.server.results_root))
+        finally:
+            connection.close()
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if parts[:1] == ["results"]:
+            self.send_result("/".join(parts[1:]))
+            return
+
+        connection = connect(self.server.db_path)
+        try:
+            if parts == ["jobs"]:
+                rows = connection.execute(
+                    "SELECT * FROM jobs WHERE status IN ('queued', 'running') OR id IN "
+                    "(SELECT id FROM jobs ORDER BY id DESC LIMIT ?) ORDER BY id", (listed_jobs,)).fetchall()
+                self.send_json(200, [job_dict(row) for row in rows])
+            elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+                row = connection.execute("SELECT * FROM jobs WHERE id = ?", (int(parts[1]),)).fetchone()
+                if row is None:
+                    self.send_json(404, {"error": "job not found"})
+                else:
+                    self.send_json(200, job_dict(row, self.server.results_root))
+            else:
+                self.send_json(404, {"error": "not found"})
+        finally:
+            connection.close()
+
+    def send_result(self, relative_path):
+        from urllib.parse import unquote
+
+        results_root = self.server.results_root.resolve()
+        path = (results_root / unquote(relative_path)).resolve()
+        # only files in the directories of jobs are served, never e.g. the queue database next to them
+        parts = path.relative_to(results_root).parts if path.is_relative_to(results_root) else ()
+        if not path.is_file() or len(parts) < 3 or directory_resolution(parts[1]) is None:
+            self.send_json(404, {"error": "result not found"})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(path.name)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(path.stat().st_size))
+        self.end_headers()
+        with open(path, "rb") as file:
+            while chunk := file.read(1 << 20):
+                self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JobServer(ThreadingHTTPServer):
+    """
+    HTTP server handling each request in a thread, with a connection backlog for bursts of submissions.
+    """
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(results_root, host="127.0.0.1", port=8080, workers=2, overpass_url="http://overpass-api.de/api/interpreter"):
+    """
+    Starts the scoring service: an HTTP API queuing jobs in SQLite and a pool of worker processes running them.
+
+    This function performs the following steps:
+    1. Opens the job queue in results_root/jobs.sqlite and queues again the jobs interrupted by a previous stop.
+    2. Starts the worker processes, each running one job at a time.
+    3. Serves the HTTP API until it is interrupted, then terminates the workers.
+
+    Parameters:
+    - results_root (Path): Directory with the queue database and the results of all jobs.
+    - host (str): Address the HTTP API listens on.
+    - port (int): Port of the HTTP API.
+    - workers (int): Number of worker processes.
+    - overpass_url (str): Overpass API interpreter used by the workers to fetch the layers.
+
+    Returns:
+    - None
+    """
+    results_root = Path(results_root)
+    results_root.mkdir(parents=True, exist_ok=True)
+    db_path = results_root / "jobs.sqlite"
+
+    connection = connect(db_path)
+    connection.execute("UPDATE jobs SET status = 'queued', stage = NULL, progress = 0 WHERE status = 'running'")
+    connection.execute("DELETE FROM locks")
+    connection.close()
+
+    processes = [multiprocessing.Process(target=worker, args=(db_path, results_root, overpass_url), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    server = JobServer((host, port), JobHandler)
+    server.db_path = db_path
+    server.results_root = results_root
+    print(f"Serving scoring jobs on http://{host}:{server.server_port} with {workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for process in processes:
+            process.terminate()
+            process.join()
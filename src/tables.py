@@ -0,0 +1,254 @@
+import json
+import h3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# feature columns stored as float32, the precision the model predicts with, which halves their size
+float32_columns = ["population", "distance_to_centrum", "network_distance_to_centrum",
+                   "network_distance_to_recreational_areas"]
+
+# count columns stored as integers, with nulls in areas without any counted element
+count_columns = ["bike_paths_count", "green_areas_count", "buildings_count", "recreational_areas_count"]
+
+
+def geoarrow_polygons(geometries):
+    """
+    Encodes polygon geometries as a GeoArrow polygon array with interleaved coordinates.
+
+    The coordinates, ring offsets and polygon offsets produced by shapely are wrapped into Arrow
+    arrays without copying them.
+
+    Parameters:
+    - geometries (gpd.GeoSeries): Polygon geometries.
+
+    Returns:
+    - polygons (pa.ListArray): Array of type list<list<fixed_size_list<double, 2>>>.
+    - field_metadata (dict): GeoArrow extension metadata of the geometry field.
+    """
+    import shapely
+
+    _, coords, (ring_offsets, polygon_offsets) = shapely.to_ragged_array(np.asarray(geometries))
+    points = pa.FixedSizeListArray.from_arrays(pa.array(np.ascontiguousarray(coords).ravel()), 2)
+    rings = pa.ListArray.from_arrays(pa.array(ring_offsets.astype(np.int32)), points)
+    polygons = pa.ListArray.from_arrays(pa.array(polygon_offsets.astype(np.int32)), rings)
+
+    crs = None if geometries.crs is None else json.loads(geometries.crs.to_json())
+    field_metadata = {"ARROW:extension:name": "geoarrow.polygon",
+                      "ARROW:extension:metadata": json.dumps({"crs": crs})}
+    return polygons, field_metadata
+
+
+def with_geo_metadata(table):
+    """
+    Adds the GeoParquet "geo" schema metadata describing the GeoArrow polygon columns of a table.
+
+    The column metadata of GeoArrow is enough for to_geodataframe, other readers, e.g. gpd.read_feather,
+    find the geometry columns, their encoding and CRS in the file-level "geo" metadata.
+
+    Parameters:
+    - table (pa.Table): Arrow table.
+
+    Returns:
+    - table (pa.Table): The same table with "geo" metadata, unchanged if it has no geometry column.
+    """
+    columns = {}
+    for field in table.schema:
+        if field.metadata and field.metadata.get(b"ARROW:extension:name") == b"geoarrow.polygon":
+            crs = json.loads(field.metadata[b"ARROW:extension:metadata"]).get("crs")
+            columns[field.name] = {"encoding": "polygon", "geometry_types": ["Polygon"], "crs": crs}
+    if not columns:
+        return table
+
+    geo = {"version": "1.1.0", "primary_column": next(iter(columns)), "columns": columns}
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), b"geo": json.dumps(geo).encode()})
+
+
+def arrow_column(values):
+    """
+    Converts a column into an Arrow array, choosing the type by the name of the column.
+
+    Feature columns in float32_columns become float32 and counts in count_columns int32, unless they are
+    fractional estimates, e.g. of a preview. Other numeric columns, e.g. predictions and contributions,
+    keep their type, and text columns, e.g. dominant_driver, become dictionaries.
+
+    Parameters:
+    - values (pd.Series): Named column.
+
+    Returns:
+    - array (pa.Array): Converted column.
+    """
+    if not pd.api.types.is_numeric_dtype(values):
+        return pa.array(values.astype(str)).dictionary_encode()
+    if values.name in float32_columns:
+        return pa.array(values.to_numpy(dtype=np.float32, na_value=np.nan))
+    if values.name in count_columns:
+        counts = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        missing = np.isnan(counts)
+        if np.array_equal(counts[~missing], np.round(counts[~missing])):
+            return pa.array(np.where(missing, 0, counts).astype(np.int32), mask=missing)
+    return pa.array(values.to_numpy())
+
+
+def to_arrow(h3_df):
+    """
+    Converts an H3 feature table into a columnar Arrow table.
+
+    This function performs the following steps:
+    1. Converts H3 indices from text to uint64 integers.
+    2. Converts feature columns to float32 and counts to integers, see arrow_column.
+    3. Encodes text columns, e.g. dominant_driver, as dictionaries.
+    4. Encodes hexagon geometries as a GeoArrow polygon column, described by "geo" schema metadata.
+
+    Parameters:
+    - h3_df (gpd.GeoDataFrame or pd.DataFrame): Feature table with h3_index and, optionally, geometry columns.
+
+    Returns:
+    - table (pa.Table): Arrow table with the same columns.
+    """
+    # columns of a stage selected without the geometry are a DataFrame, which has no geometry attribute
+    geometry = getattr(h3_df, "geometry", None)
+    fields, arrays = [], []
+    for column in h3_df.columns:
+        if column == "h3_index":
+            values = h3_df[column]
+            array = pa.array(np.fromiter((h3.string_to_h3(x) for x in values), dtype=np.uint64, count=len(values)))
+            field = pa.field(column, pa.uint64())
+        elif geometry is not None and column == geometry.name:
+            array, field_metadata = geoarrow_polygons(geometry)
+            field = pa.field(column, array.type, metadata=field_metadata)
+        else:
+            array = arrow_column(h3_df[column])
+            field = pa.field(column, array.type)
+        fields.append(field)
+        arrays.append(array)
+    return with_geo_metadata(pa.Table.from_arrays(arrays, schema=pa.schema(fields)))
+
+
+def append_columns(table, df):
+    """
+    Appends the columns of a DataFrame which are missing in an Arrow table, without copying the existing ones.
+
+    Parameters:
+    - table (pa.Table): Arrow feature table.
+    - df (pd.DataFrame): DataFrame with the same rows as the table, e.g. with predictions.
+
+    Returns:
+    - table (pa.Table): Arrow table with the new columns appended.
+    """
+    for column in df.columns:
+        if column not in table.column_names:
+            table = table.append_column(column, arrow_column(df[column]))
+    return table
+
+
+def join_columns(table, other):
+    """
+    Left-joins the columns of another Arrow table on their uint64 h3_index, keeping the rows of the table in order.
+
+    The columns of the table are kept without copies, and areas missing in the other table get nulls.
+
+    Parameters:
+    - table (pa.Table): Arrow feature table.
+    - other (pa.Table): Arrow table with h3_index and the joined columns, at most one row per H3 index.
+
+    Returns:
+    - table (pa.Table): Arrow table with the columns of other appended.
+    """
+    positions = pd.Index(other["h3_index"].to_numpy()).get_indexer(table["h3_index"].to_numpy())
+    indices = pa.array(positions, mask=positions < 0)
+    for field in other.schema:
+        if field.name != "h3_index":
+            table = table.append_column(field, other[field.name].take(indices))
+    return table
+
+
+def to_geodataframe(table, columns=None):
+    """
+    Converts an Arrow feature table created by to_arrow back into a GeoDataFrame.
+
+    Parameters:
+    - table (pa.Table): Arrow feature table.
+    - columns (list, optional): Columns to convert, all by default.
+
+    Returns:
+    - h3_df (gpd.GeoDataFrame or pd.DataFrame): Feature table with text H3 indices and shapely
+      geometries, a DataFrame if the geometry column is not converted.
+    """
+    if columns is not None:
+        table = table.select(columns)
+
+    data = {}
+    geometry = None
+    for field, column in zip(table.schema, table.columns):
+        if field.metadata and field.metadata.get(b"ARROW:extension:name") == b"geoarrow.polygon":
+            # geometry libraries are imported only when geometries are decoded, e.g. not for predictions
+            import geopandas as gpd
+            import shapely
+
+            polygons = column.combine_chunks()
+            rings = polygons.values
+            coords = rings.values.values.to_numpy().reshape(-1, 2)
+            offsets = (rings.offsets.to_numpy(), polygons.offsets.to_numpy())
+            geometry_metadata = json.loads(field.metadata[b"ARROW:extension:metadata"])
+            geometry = gpd.GeoSeries(shapely.from_ragged_array(shapely.GeometryType.POLYGON, coords, offsets),
+                                     crs=geometry_metadata.get("crs"), name=field.name)
+            data[field.name] = geometry
+        elif field.name == "h3_index":
+            data[field.name] = [h3.h3_to_string(x) for x in column.to_numpy()]
+        else:
+            data[field.name] = column.to_pandas()
+
+    if geometry is None:
+        return pd.DataFrame(data)
+    return gpd.GeoDataFrame(data, geometry=geometry.name, crs=geometry.crs)
+
+
+def table_resolution(table):
+    """
+    Reads the H3 resolution of an Arrow feature table from its first H3 index.
+
+    Parameters:
+    - table (pa.Table): Arrow feature table with uint64 h3_index.
+
+    Returns:
+    - resolution (int): H3 resolution of the table, None if the table is empty.
+    """
+    if table.num_rows == 0:
+        return None
+    return h3.h3_get_resolution(h3.h3_to_string(table["h3_index"][0].as_py()))
+
+
+def write_table(table, path):
+    """
+    Writes an Arrow table to an uncompressed Feather (Arrow IPC) file, which can be memory-mapped.
+
+    The table is written to a temporary file which then replaces the old one, so a table memory-mapped
+    from the same path, e.g. a feature table being refreshed, stays valid while it is written. Tables
+    with geometries get "geo" metadata, so the file can also be read with gpd.read_feather.
+
+    Parameters:
+    - table (pa.Table): Arrow table.
+    - path (Path): Path of the .feather file.
+
+    Returns:
+    - None
+    """
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    feather.write_feather(with_geo_metadata(table), temporary_path, compression="uncompressed")
+    temporary_path.replace(path)
+
+
+def read_table(path, columns=None):
+    """
+    Memory-maps a Feather file written by write_table, so its columns are read without copies.
+
+    Parameters:
+    - path (Path): Path of the .feather file.
+    - columns (list, optional): Columns to read, all by default.
+
+    Returns:
+    - table (pa.Table): Arrow table backed by the memory-mapped file.
+    """
+    return feather.read_table(path, columns=columns, memory_map=True)
@@ -0,0 +1,325 @@
+import gzip
+import json
+import math
+import sqlite3
+import struct
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import h3
+import numpy as np
+import pandas as pd
+
+# name of the vector tile layer with h3 areas
+layer_name = "h3_areas"
+
+# number of integer coordinates along the side of a vector tile
+tile_extent = 4096
+
+# smallest size of a hexagon edge in tile pixels (of a 256 pixel tile) at which it is still drawn
+min_edge_pixels = 4
+
+# length of the equator in kilometers, the width of the whole map at zoom 0
+equator_km = 40075.016686
+
+# columns summed when h3 areas are rolled up to their parents, other numeric columns are averaged
+summed_columns = ["bike_paths_count", "prediction", "difference", "green_areas_count", "buildings_count",
+                  "population", "recreational_areas_count"]
+
+
+def resolution_for_zoom(zoom, latitude, max_resolution):
+    """
+    Chooses the H3 resolution drawn at a zoom level, the finest one whose hexagons are still visible.
+
+    Parameters:
+    - zoom (int): Zoom level of the tiles.
+    - latitude (float): Latitude of the area, as tiles get smaller towards the poles.
+    - max_resolution (int): Resolution of the exported h3 areas.
+
+    Returns:
+    - resolution (int): H3 resolution for the zoom level, at most max_resolution.
+    """
+    pixel_km = equator_km * math.cos(math.radians(latitude)) / (256 * 2 ** zoom)
+    for resolution in range(max_resolution, 0, -1):
+        if h3.edge_length(resolution, unit="km") >= min_edge_pixels * pixel_km:
+            return resolution
+    return 0
+
+
+def roll_up(h3_df, resolution):
+    """
+    Aggregates h3 areas to their parent cells at a coarser resolution.
+
+    Columns from summed_columns are summed, the other numeric columns are averaged.
+
+    Parameters:
+    - h3_df (pd.DataFrame): DataFrame with h3_index and numeric columns.
+    - resolution (int): Resolution of the parent cells.
+
+    Returns:
+    - parents_df (pd.DataFrame): DataFrame with one row per parent cell.
+    """
+    numeric = h3_df.select_dtypes("number")
+    parents = h3_df["h3_index"].apply(lambda x: h3.h3_to_parent(x, resolution))
+    aggregations = {column: "sum" if column in summed_columns else "mean" for column in numeric.columns}
+    return numeric.groupby(parents.rename("h3_index")).agg(aggregations).reset_index()
+
+
+def lonlat_to_world(lon, lat, zoom):
+    """
+    Converts longitudes and latitudes to Web Mercator tile coordinates at a zoom level.
+
+    Parameters:
+    - lon (np.ndarray): Longitudes in degrees.
+    - lat (np.ndarray): Latitudes in degrees.
+    - zoom (int): Zoom level.
+
+    Returns:
+    - x (np.ndarray), y (np.ndarray): Coordinates in tile units, the integer part being the tile number.
+    """
+    n = 2 ** zoom
+    lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+    x = (np.asarray(lon) + 180) / 360 * n
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2 * n
+    return x, y
+
+
+def varint(value):
+    """
+    Encodes a non-negative integer as a protobuf varint.
+    """
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def zigzag(value):
+    """
+    Maps a signed integer to the unsigned zigzag encoding used by vector tile geometries.
+    """
+    return (value << 1) ^ (value >> 31)
+
+
+def field(number, wire_type, payload):
+    """
+    Encodes a protobuf field: varint payloads are given as int, length-delimited ones as bytes.
+    """
+    key = varint((number << 3) | wire_type)
+    if wire_type == 0:
+        return key + varint(payload)
+    if wire_type == 1:
+        return key + struct.pack("<d", payload)
+    return key + varint(len(payload)) + payload
+
+
+def polygon_geometry(ring):
+    """
+    Encodes a polygon ring in tile coordinates as vector tile geometry commands.
+
+    The exterior ring is oriented clockwise on screen, as required by the vector tile specification.
+
+    Parameters:
+    - ring (np.ndarray): Array of shape (n, 2) with integer tile coordinates, without the closing point.
+
+    Returns:
+    - commands (list): Geometry command integers.
+    """
+    x, y = ring[:, 0], ring[:, 1]
+    if np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y) < 0:
+        ring = ring[::-1]
+
+    deltas = np.diff(ring, axis=0, prepend=[[0, 0]])
+    commands = [(1 << 3) | 1, zigzag(int(deltas[0, 0])), zigzag(int(deltas[0, 1])),
+                ((len(ring) - 1) << 3) | 2]
+    for dx, dy in deltas[1:]:
+        commands.extend((zigzag(int(dx)), zigzag(int(dy))))
+    commands.append((1 << 3) | 7)
+    return commands
+
+
+def encode_tile(features, columns):
+    """
+    Encodes the features of one tile as a Mapbox Vector Tile with a single layer.
+
+    Parameters:
+    - features (list): List of (feature_id, ring, values) tuples, where ring holds tile coordinates
+      and values holds one number per column.
+    - columns (list): Names of the feature properties.
+
+    Returns:
+    - tile (bytes): Encoded vector tile.
+    """
+    layer = field(15, 0, 2) + field(1, 2, layer_name.encode())
+    layer_values = {}
+    for feature_id, ring, values in features:
+        tags = []
+        for key, value in enumerate(values):
+            if not np.isnan(value):
+                tags.extend((key, layer_values.setdefault(float(value), len(layer_values))))
+        feature = field(1, 0, feature_id)
+        feature += field(2, 2, b"".join(varint(tag) for tag in tags))
+        feature += field(3, 0, 3)
+        feature += field(4, 2, b"".join(varint(command) for command in polygon_geometry(ring)))
+        layer += field(2, 2, feature)
+    layer += b"".join(field(3, 2, column.encode()) for column in columns)
+    layer += b"".join(field(4, 2, field(3, 1, value)) for value in layer_values)
+    layer += field(5, 0, tile_extent)
+    return field(3, 2, layer)
+
+
+def zoom_tiles(h3_df, zoom):
+    """
+    Creates all vector tiles of one zoom level.
+
+    Parameters:
+    - h3_df (pd.DataFrame): h3 areas at the resolution drawn at this zoom level.
+    - zoom (int): Zoom level.
+
+    Returns:
+    - tiles (list): List of (zoom, x, y, tile bytes) tuples.
+    """
+    columns = [column for column in h3_df.columns if column != "h3_index"]
+    values = h3_df[columns].to_numpy(dtype=np.float64)
+    tiles = {}
+    for position, h3_index in enumerate(h3_df["h3_index"]):
+        boundary = np.asarray(h3.h3_to_geo_boundary(h3_index, geo_json=True)[:-1])
+        x, y = lonlat_to_world(boundary[:, 0], boundary[:, 1], zoom)
+
+        # a hexagon is added to every tile its bounding box overlaps
+        for tile_x in range(int(x.min()), int(x.max()) + 1):
+            for tile_y in range(int(y.min()), int(y.max()) + 1):
+                ring = np.column_stack([np.round((x - tile_x) * tile_extent),
+                                        np.round((y - tile_y) * tile_extent)]).astype(np.int64)
+                tiles.setdefault((tile_x, tile_y), []).append(
+                    (h3.string_to_h3(h3_index), ring, values[position]))
+
+    return [(zoom, tile_x, tile_y, encode_tile(features, columns)) for (tile_x, tile_y), features in tiles.items()]
+
+
+def tile_pyramid(h3_df, min_zoom, max_zoom, workers=None):
+    """
+    Creates vector tiles of h3 areas for all zoom levels, rolling coarser zoom levels up to parent cells.
+
+    Each resolution is aggregated once from the exported areas, and the zoom levels are encoded in
+    parallel worker processes. The tiles of each zoom level are yielded as soon as its worker finishes,
+    so only the zoom levels not written yet are held in memory.
+
+    Parameters:
+    - h3_df (pd.DataFrame): DataFrame with h3_index and numeric columns, e.g. predictions.
+    - min_zoom (int): Lowest zoom level.
+    - max_zoom (int): Highest zoom level.
+    - workers (int, optional): Number of worker processes, all cores by default.
+
+    Returns:
+    - tiles (generator): (zoom, x, y, tile bytes) tuples, none if h3_df is empty.
+    """
+    if len(h3_df) == 0:
+        return
+    h3_df = pd.DataFrame({"h3_index": h3_df["h3_index"], **h3_df.select_dtypes("number")})
+    max_resolution = h3.h3_get_resolution(h3_df["h3_index"].iloc[0])
+    latitude = h3.h3_to_geo(h3_df["h3_index"].iloc[0])[0]
+
+    resolutions = {zoom: resolution_for_zoom(zoom, latitude, max_resolution)
+                   for zoom in range(min_zoom, max_zoom + 1)}
+    rolled_up = {resolution: h3_df if resolution == max_resolution else roll_up(h3_df, resolution)
+                 for resolution in set(resolutions.values())}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(zoom_tiles, rolled_up[resolution], zoom)
+                   for zoom, resolution in resolutions.items()}
+        for future in as_completed(futures):
+            # the tiles of a written zoom level are released, not kept until the last one is done
+            futures.remove(future)
+            yield from future.result()
+
+
+def tilejson(h3_df, min_zoom, max_zoom, tiles_url):
+    """
+    Creates TileJSON metadata describing the exported tiles.
+
+    An empty h3_df gets the bounds of the whole Web Mercator map, the default of TileJSON.
+    """
+    if len(h3_df) == 0:
+        bounds = [-180, -85.0511, 180, 85.0511]
+    else:
+        latitudes, longitudes = zip(*(h3.h3_to_geo(x) for x in h3_df["h3_index"]))
+        bounds = [min(longitudes), min(latitudes), max(longitudes), max(latitudes)]
+    fields = {column: "Number" for column in h3_df.select_dtypes("number").columns}
+    return {"tilejson": "3.0.0",
+            "tiles": [tiles_url],
+            "minzoom": min_zoom,
+            "maxzoom": max_zoom,
+            "bounds": bounds,
+            "center": [(bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2, min_zoom],
+            "vector_layers": [{"id": layer_name, "fields": fields, "minzoom": min_zoom, "maxzoom": max_zoom}]}
+
+
+def export_mbtiles(h3_df, path, min_zoom=6, max_zoom=14, workers=None):
+    """
+    Exports h3 areas, e.g. predictions, as a vector tile pyramid in an MBTiles file.
+
+    Tiles are inserted zoom level by zoom level as they are encoded. Without h3 areas, an empty tileset
+    with only the metadata is written.
+
+    Parameters:
+    - h3_df (pd.DataFrame): DataFrame with h3_index and numeric columns.
+    - path (Path): Path of the .mbtiles file, replaced if it exists.
+    - min_zoom (int): Lowest zoom level.
+    - max_zoom (int): Highest zoom level.
+    - workers (int, optional): Number of worker processes, all cores by default.
+
+    Returns:
+    - None
+    """
+    path.unlink(missing_ok=True)
+    metadata = tilejson(h3_df, min_zoom, max_zoom, "")
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        connection.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, "
+                           "tile_data BLOB)")
+        connection.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        connection.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ("name", path.stem), ("format", "pbf"), ("type", "overlay"),
+            ("minzoom", str(min_zoom)), ("maxzoom", str(max_zoom)),
+            ("bounds", ",".join(map(str, metadata["bounds"]))),
+            ("center", ",".join(map(str, metadata["center"]))),
+            ("json", json.dumps({"vector_layers": metadata["vector_layers"]}))])
+
+        # mbtiles rows are numbered from the south, as in the TMS scheme
+        connection.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", (
+            (zoom, x, 2 ** zoom - 1 - y, gzip.compress(tile))
+            for zoom, x, y, tile in tile_pyramid(h3_df, min_zoom, max_zoom, workers)))
+
+
+def export_directory(h3_df, path, min_zoom=6, max_zoom=14, workers=None, base_url="http://localhost:8000"):
+    """
+    Exports h3 areas, e.g. predictions, as a directory of {z}/{x}/{y}.pbf vector tiles with a tiles.json.
+
+    The directory can be served with any static file server, e.g. python -m http.server 8000 run in it.
+    Tiles are not compressed, so no Content-Encoding header has to be configured. Without h3 areas,
+    only tiles.json is written.
+
+    Parameters:
+    - h3_df (pd.DataFrame): DataFrame with h3_index and numeric columns.
+    - path (Path): Output directory.
+    - min_zoom (int): Lowest zoom level.
+    - max_zoom (int): Highest zoom level.
+    - workers (int, optional): Number of worker processes, all cores by default.
+    - base_url (str): URL at which the directory will be served, used in tiles.json.
+
+    Returns:
+    - None
+    """
+    Path(path).mkdir(parents=True, exist_ok=True)
+    for zoom, x, y, tile in tile_pyramid(h3_df, min_zoom, max_zoom, workers):
+        tile_path = Path(path) / str(zoom) / str(x) / f"{y}.pbf"
+        tile_path.parent.mkdir(parents=True, exist_ok=True)
+        tile_path.write_bytes(tile)
+
+    with open(Path(path) / "tiles.json", "w") as file:
+        json.dump(tilejson(h3_df, min_zoom, max_zoom, f"{base_url}/{{z}}/{{x}}/{{y}}.pbf"), file, indent=2)
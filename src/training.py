@@ -0,0 +1,230 @@
+import time
+from pathlib import Path
+import h3
+import numpy as np
+import pandas as pd
+import sklearn
+import xgboost as xgb
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_squared_error, r2_score, mean_absolute_error
+from sklearn.model_selection import GroupKFold, ParameterGrid
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVR
+import src.modelling as modelling
+import src.tables as tables
+
+# feature tables cached by the features command of run.py for each city
+feature_tables_path = Path.cwd()
+
+# h3 resolution of the cached feature table the model is trained on
+training_resolution = 7
+
+# resolution of parent h3 cells grouping neighbouring areas into the same fold
+fold_parent_resolution = 5
+
+# number of spatial folds used in cross validation
+n_folds = 5
+
+# seed of the randomised models, so a training run can be repeated with the same result
+random_seed = 0
+
+# candidate models with their hyperparameter grids, the same as evaluated in model_creation.ipynb.
+# models use a single thread, because parallelism is applied across candidates and folds
+param_grids = {
+    "rf_model": (RandomForestRegressor(n_jobs=1, random_state=random_seed), {
+        'n_estimators': [50, 100, 200],
+        'max_depth': [None, 10, 20, 30],
+        'min_samples_split': [2, 5, 10],
+        'min_samples_leaf': [1, 2, 4],
+    }),
+    "xgb_model": (xgb.XGBRegressor(n_jobs=1, random_state=random_seed), {
+        'learning_rate': [0.1, 0.01, 0.05],
+        'n_estimators': [50, 100, 200],
+        'max_depth': [None, 10, 20, 30],
+        'gamma': [0, 0.1, 0.2],
+    }),
+    "svr_model": (SVR(), {
+        'C': [0.1, 1, 10, 100],
+        'epsilon': [0.01, 0.1, 0.2, 0.5],
+        'kernel': ['linear', 'rbf'],
+    }),
+}
+
+
+def load_feature_table(table_name, resolution=training_resolution):
+    """
+    Loads a city feature table cached by the features command of run.py.
+
+    Feather tables are preferred, tables cached as CSV by earlier versions, without the resolution in
+    their name, are still read.
+
+    Parameters:
+    - table_name (str): Name of the cached table, e.g. "Amsterdam" for Amsterdam_resolution_7.feather.
+    - resolution (int): H3 resolution of the cached table.
+
+    Returns:
+    - feature_table (pd.DataFrame): Feature table with missing counts filled with 0.
+    """
+    feather_path = feature_tables_path / f"{table_name}_resolution_{resolution}.feather"
+    if feather_path.exists():
+        table = tables.read_table(feather_path)
+        feature_table = tables.to_geodataframe(table, [column for column in table.column_names
+                                                       if column != "geometry"])
+    else:
+        feature_table = pd.read_csv(feature_tables_path / f"{table_name}.csv", index_col=0)
+    feature_table.fillna(0, inplace=True)
+    return feature_table
+
+
+def spatial_folds(h3_indices, parent_resolution=fold_parent_resolution, folds=n_folds):
+    """
+    Splits H3 areas into cross validation folds, keeping areas with the same parent cell in one fold.
+
+    Random splits put neighbouring hexagons into both train and test sets, and as neighbours share
+    most of their surroundings, the test score is overestimated. Grouping by a coarser parent cell
+    keeps whole neighbourhoods on one side of the split.
+
+    Parameters:
+    - h3_indices (pd.Series): H3 indices of the areas.
+    - parent_resolution (int): H3 resolution of the parent cells forming the spatial blocks.
+    - folds (int): Number of folds.
+
+    Returns:
+    - folds (list): List of (train_positions, test_positions) tuples.
+    """
+    groups = h3_indices.apply(lambda x: h3.h3_to_parent(x, parent_resolution))
+    folds = min(folds, groups.nunique())
+    return list(GroupKFold(n_splits=folds).split(h3_indices, groups=groups))
+
+
+def fit_fold(model_name, estimator, params, x, y, train, test):
+    """
+    Fits one candidate model on one fold and scores it on the held out spatial block.
+
+    The scaler is fitted on the training part of the fold only, so no statistics of the
+    held out areas leak into the model.
+
+    Parameters:
+    - model_name (str): Name of the candidate model.
+    - estimator (estimator): Unfitted scikit-learn compatible estimator.
+    - params (dict): Hyperparameters set on the estimator.
+    - x (np.ndarray): Feature matrix.
+    - y (np.ndarray): Target values.
+    - train (np.ndarray): Positions of the training rows.
+    - test (np.ndarray): Positions of the test rows.
+
+    Returns:
+    - result (dict): Candidate description with mse, mae and r2 scored on the test rows.
+    """
+    pipeline = make_pipeline(StandardScaler(), clone(estimator).set_params(**params))
+    pipeline.fit(x[train], y[train])
+    y_pred = pipeline.predict(x[test])
+    return {"model": model_name,
+            "params": params,
+            "mse": mean_squared_error(y[test], y_pred),
+            "mae": mean_absolute_error(y[test], y_pred),
+            "r2": r2_score(y[test], y_pred)}
+
+
+def hyperparameter_search(feature_table, features=None, n_jobs=-1):
+    """
+    Runs spatially blocked cross validation for every candidate model and hyperparameter set in parallel.
+
+    Every (model, hyperparameters, fold) combination is an independent task distributed over
+    worker processes with joblib.
+
+    Parameters:
+    - feature_table (pd.DataFrame): City feature table with h3_index and bike_paths_count columns.
+    - features (list, optional): Feature columns used for training. Defaults to modelling.model_features.
+    - n_jobs (int): Number of worker processes, -1 uses all cores.
+
+    Returns:
+    - results (pd.DataFrame): Mean cross validation scores of each candidate, sorted from the lowest mse.
+    """
+    if features is None:
+        features = modelling.model_features
+
+    x = feature_table[features].to_numpy(dtype=np.float64)
+    y = feature_table["bike_paths_count"].to_numpy(dtype=np.float64)
+    folds = spatial_folds(feature_table["h3_index"])
+
+    tasks = [delayed(fit_fold)(model_name, estimator, params, x, y, train, test)
+             for model_name, (estimator, grid) in param_grids.items()
+             for params in ParameterGrid(grid)
+             for train, test in folds]
+    fold_results = pd.DataFrame(Parallel(n_jobs=n_jobs)(tasks))
+
+    # averaging fold scores of each candidate, params are compared as text as dicts are not hashable
+    fold_results["params_key"] = fold_results["params"].astype(str)
+    results = (fold_results
+               .groupby(["model", "params_key"], sort=False)
+               .agg(params=("params", "first"), mse=("mse", "mean"), mae=("mae", "mean"), r2=("r2", "mean"))
+               .reset_index()
+               .drop(columns=["params_key"])
+               .sort_values("mse", ignore_index=True))
+    return results
+
+
+def train(table_name="Amsterdam", features=None, n_jobs=-1, resolution=training_resolution):
+    """
+    Selects the best model with spatially blocked cross validation and saves it as a versioned artifact.
+
+    This function performs the following steps:
+    1. Loads the cached feature table of the chosen city.
+    2. Runs the parallel hyperparameter search for XGBoost, Random Forest and SVR.
+    3. Fits a scaler and the best candidate on the whole feature table.
+    4. Saves the model, the fitted scaler and the search results with modelling.save_model_artifact.
+
+    Parameters:
+    - table_name (str): Name of the cached feature table used for training.
+    - features (list, optional): Feature columns used for training. Defaults to modelling.model_features.
+    - n_jobs (int): Number of worker processes, -1 uses all cores.
+    - resolution (int): H3 resolution of the cached feature table.
+
+    Returns:
+    - artifact_path (Path): Directory of the saved model version.
+    """
+    if features is None:
+        features = modelling.model_features
+
+    feature_table = load_feature_table(table_name, resolution)
+
+    start = time.perf_counter()
+    results = hyperparameter_search(feature_table, features, n_jobs)
+    search_time = time.perf_counter() - start
+
+    # refitting the best candidate on all areas of the city
+    best = results.iloc[0]
+    estimator, _ = param_grids[best["model"]]
+    scaler = StandardScaler()
+    x = scaler.fit_transform(feature_table[features].to_numpy(dtype=np.float64))
+    model = clone(estimator).set_params(**best["params"])
+    model.fit(x, feature_table["bike_paths_count"].to_numpy(dtype=np.float64))
+
+    metadata = {"model": best["model"],
+                "params": best["params"],
+                "cv_mse": float(best["mse"]),
+                "cv_mae": float(best["mae"]),
+                "cv_r2": float(best["r2"]),
+                "fold_parent_resolution": fold_parent_resolution,
+                "n_folds": n_folds,
+                "random_seed": random_seed,
+                "training_table": table_name,
+                "training_resolution": resolution,
+                "search_seconds": search_time,
+                "versions": {"scikit-learn": sklearn.__version__, "xgboost": xgb.__version__},
+                "candidates": results.head(10).to_dict(orient="records")}
+
+    return modelling.save_model_artifact(model, scaler, features, metadata)
+
+
+def main():
+    artifact_path = train("Amsterdam")
+    print(f"Saved model to {artifact_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+import src.benchmark as benchmark
+
+repository_path = Path(__file__).parent.parent
+
+
+@pytest.fixture(autouse=True)
+def repository_directory(monkeypatch):
+    # the imports are measured in a fresh interpreter started in the repository
+    monkeypatch.chdir(repository_path)
+
+
+def test_import_budget():
+    assert benchmark.check_import_budget()
+
+
+def test_import_time_covers_the_whole_predict_command():
+    _, report = benchmark.predict_import_time(top=100)
+    # the model and the history are imported while the command runs, not when it starts
+    assert "src.history" in report["module"].tolist()
+    assert any(module.startswith("xgboost") for module in report["module"])
+
+
+def test_predict_imports_no_xgboost():
+    # xgboost is imported when a model is loaded, not by the modules the predict command starts with
+    statement = "import sys, run, src.modelling, src.tables; print('xgboost' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", statement], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "False"
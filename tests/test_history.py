@@ -0,0 +1,103 @@
+import h3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+import src.history as history
+
+resolution = 8
+# pool of H3 areas, of which every run has a random subset
+pool = np.array([h3.string_to_h3(x) for x in sorted(h3.k_ring(h3.geo_to_h3(50.06, 19.94, resolution), 5))],
+                dtype=np.uint64)
+drivers = np.array(["population", "buildings_count", None], dtype=object)
+
+
+def random_runs(n_runs, seed=0):
+    """
+    Creates predictions tables of consecutive runs: each run adds and removes areas, sets some values
+    missing and changes a few predictions and counts of the previous one.
+    """
+    rng = np.random.default_rng(seed)
+    cells = rng.choice(pool, 60, replace=False)
+    frame = pd.DataFrame({"bike_paths_count": pd.array(rng.integers(0, 5, 60), dtype="Int32"),
+                          "population": rng.uniform(0, 3000, 60),
+                          "prediction": rng.uniform(0, 10, 60),
+                          "dominant_driver": rng.choice(drivers, 60)}, index=cells)
+    runs = []
+    for _ in range(n_runs):
+        kept = frame.drop(rng.choice(frame.index, 3, replace=False))
+        new_cells = rng.choice(np.setdiff1d(pool, kept.index), 4, replace=False)
+        added = pd.DataFrame({"bike_paths_count": pd.array(rng.integers(0, 5, 4), dtype="Int32"),
+                              "population": rng.uniform(0, 3000, 4),
+                              "prediction": rng.uniform(0, 10, 4),
+                              "dominant_driver": rng.choice(drivers, 4)}, index=new_cells)
+        frame = pd.concat([kept, added])
+        changed = rng.choice(len(frame), 5, replace=False)
+        frame.iloc[changed, frame.columns.get_loc("prediction")] = rng.uniform(0, 10, 5)
+        frame.iloc[changed[:2], frame.columns.get_loc("bike_paths_count")] = pd.NA
+        frame.iloc[changed[2:4], frame.columns.get_loc("population")] = np.nan
+        frame.iloc[changed[4:], frame.columns.get_loc("dominant_driver")] = rng.choice(drivers[:2])
+        frame = frame.sample(frac=1, random_state=int(rng.integers(1 << 31)))
+        runs.append(pa.table({"h3_index": pa.array(frame.index.to_numpy(dtype=np.uint64)),
+                              **{column: pa.Array.from_pandas(frame[column]) for column in frame.columns}}))
+    return runs
+
+
+@pytest.fixture
+def history_path(tmp_path):
+    return tmp_path / "history"
+
+
+def test_round_trip(history_path):
+    tables = random_runs(25)
+    stored = [history.append_snapshot(history_path, table, {"command": "predict"}) for table in tables]
+
+    # every keyframe_interval-th run is a full snapshot, the others store only the changed areas
+    assert [run["run_id"] for run in stored if run["keyframe"]] == [1, 1 + history.keyframe_interval,
+                                                                      1 + 2 * history.keyframe_interval]
+    expected = [history.snapshot_frame(table) for table in tables]
+    for run, previous, current in zip(stored[1:], expected, expected[1:]):
+        if not run["keyframe"]:
+            common = previous.index.intersection(current.index)
+            changed = ~(previous.loc[common].eq(current.loc[common])
+                        | (previous.loc[common].isna() & current.loc[common].isna())).all(axis=1)
+            # changed and added areas, and removed ones
+            assert run["changed_rows"] == changed.sum() + len(current.index.difference(previous.index)) \
+                + len(previous.index.difference(current.index))
+            assert run["changed_rows"] < run["rows"]
+
+    # every run is rebuilt with its added and removed areas, missing values and all columns
+    rebuilt = history.snapshots(history_path, [run["run_id"] for run in stored])
+    for run, frame in zip(stored, expected):
+        pd.testing.assert_frame_equal(rebuilt[run["run_id"]].sort_index(), frame, check_dtype=False)
+
+    # a single column of a single run is rebuilt the same way, also after a keyframe
+    for run_id in (7, 12):
+        [column] = history.snapshots(history_path, [run_id], ["population"]).values()
+        pd.testing.assert_frame_equal(column.sort_index(), expected[run_id - 1][["population"]], check_dtype=False)
+
+
+def test_changed_cells(history_path):
+    tables = random_runs(15, seed=1)
+    for table in tables:
+        history.append_snapshot(history_path, table)
+
+    # the runs lie on both sides of a keyframe
+    for first_run, second_run in ((3, 14), (2, 5)):
+        changes = history.changed_cells(history_path, first_run, second_run, threshold=0.5)
+
+        # brute force diff of the full tables of both runs
+        first, second = (tables[run - 1].to_pandas().set_index("h3_index")["prediction"].astype(np.float32)
+                         for run in (first_run, second_run))
+        both = pd.concat([first, second], axis=1, join="inner").dropna()
+        difference = both.iloc[:, 1] - both.iloc[:, 0]
+        expected = difference[difference.abs() > 0.5]
+
+        assert len(changes) == len(expected) > 0
+        assert changes["change"].abs().is_monotonic_decreasing
+        actual = pd.Series(changes["change"].to_numpy(),
+                           index=[h3.string_to_h3(x) for x in changes["h3_index"]]).sort_index()
+        pd.testing.assert_series_equal(actual, expected.sort_index(), check_names=False, check_index_type=False,
+                                       check_dtype=False)
+        np.testing.assert_array_equal(changes[f"prediction_{second_run}"] - changes[f"prediction_{first_run}"],
+                                      changes["change"])
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost as xgb
+from sklearn.preprocessing import StandardScaler
+import src.modelling as modelling
+
+
+@pytest.fixture
+def artifact(tmp_path, monkeypatch):
+    """
+    Trains a small XGBoost model on random features and saves it as a native model version.
+    """
+    monkeypatch.setattr(modelling, "models_path", tmp_path)
+    rng = np.random.default_rng(0)
+    x = rng.gamma(2.0, 50.0, size=(300, len(modelling.model_features)))
+    y = 0.05 * x[:, 1] + 0.001 * x[:, 2] - 0.01 * x[:, 4] + rng.normal(0, 1, 300)
+    scaler = StandardScaler().fit(x)
+    model = xgb.XGBRegressor(n_estimators=20, max_depth=4, random_state=0).fit(scaler.transform(x), y)
+    version = modelling.save_model_artifact(model, scaler, modelling.model_features, {"model": "xgb_model"}).name
+    return modelling.load_model_artifact(version)
+
+
+def dataset(n_rows=200):
+    rng = np.random.default_rng(1)
+    data = pd.DataFrame(rng.gamma(2.0, 50.0, size=(n_rows, len(modelling.model_features))),
+                        columns=modelling.model_features)
+    # areas without a counted element have missing counts
+    data.loc[:10, "recreational_areas_count"] = np.nan
+    return data
+
+
+@pytest.mark.parametrize("approximate", [False, True])
+def test_contributions_sum_to_prediction(artifact, approximate):
+    predictions = modelling.krakow_prediction(dataset(), explain_predictions=True,
+                                              approximate_explanations=approximate, artifact=artifact)
+
+    contributions = predictions[[f"contribution_{feature}" for feature in modelling.model_features]].to_numpy()
+    np.testing.assert_allclose(contributions.sum(axis=1) + predictions["contribution_bias"],
+                               predictions["prediction"], rtol=1e-4, atol=1e-4)
+
+    # the dominant driver is the feature with the largest absolute contribution
+    largest = np.abs(contributions).argmax(axis=1)
+    assert (predictions["dominant_driver"] == np.asarray(modelling.model_features)[largest]).all()
+    assert predictions["dominant_driver"].nunique() > 1
+
+
+def test_pickled_model_explanations(artifact, tmp_path):
+    # a pickled estimator, as in the original model.pkl, is explained through its booster
+    model = xgb.XGBRegressor()
+    model.load_model(tmp_path / artifact["metadata"]["version"] / "model.ubj")
+    pickled = dict(artifact, model=model, native=False)
+
+    native = modelling.krakow_prediction(dataset(), explain_predictions=True, artifact=artifact)
+    predictions = modelling.krakow_prediction(dataset(), explain_predictions=True, artifact=pickled)
+    pd.testing.assert_frame_equal(predictions, native, check_dtype=False, rtol=1e-5)
@@ -0,0 +1,77 @@
+import json
+import pyarrow as pa
+import pytest
+import src.pipeline as pipeline
+
+
+def toy_stages(calls, fail=()):
+    """
+    Builds a small stage graph recording the stages it runs: "double" depends on "numbers", "labels" is
+    independent of both, "total" depends on "double" and "final" joins everything.
+    """
+    def stage(name, function):
+        def run(*arguments):
+            calls.append(name)
+            if name in fail:
+                raise RuntimeError(f"{name} failed")
+            return function(*arguments)
+        return run
+
+    return {"numbers": (stage("numbers", lambda: [1, 2, 3]), [], "json"),
+            "labels": (stage("labels", lambda: pa.table({"label": ["a", "b", "c"]})), [], "table"),
+            "double": (stage("double", lambda numbers: [2 * x for x in numbers]), ["numbers"], "json"),
+            "total": (stage("total", lambda double: sum(double)), ["double"], "json"),
+            "final": (stage("final", lambda labels, double, total: labels.append_column("value", pa.array(double))
+                            .append_column("total", pa.array([total] * 3))), ["labels", "double", "total"], "table")}
+
+
+def test_resume_after_failure(tmp_path):
+    for name in ("run", "clean"):
+        pipeline.prepare_checkpoints(tmp_path / name, {"city": "Kraków"})
+    calls = []
+    with pytest.raises(RuntimeError, match="double failed"):
+        pipeline.run_stages(toy_stages(calls, fail={"double"}), tmp_path / "run", workers=2)
+
+    # stages depending on the failed one are skipped, the independent ones still run and are saved
+    assert sorted(calls) == ["double", "labels", "numbers"]
+    assert sorted(path.name for path in (tmp_path / "run").iterdir()) == \
+        ["labels.feather", "numbers.json", "parameters.json"]
+
+    calls.clear()
+    result = pipeline.run_stages(toy_stages(calls), tmp_path / "run", workers=2)
+    # finished stages are not run again
+    assert calls == ["double", "total", "final"]
+
+    clean = pipeline.run_stages(toy_stages([]), tmp_path / "clean", workers=2)
+    assert result.equals(clean)
+    assert result.column("total").to_pylist() == [12] * 3
+
+    # a finished graph only loads the final checkpoint
+    calls.clear()
+    assert pipeline.run_stages(toy_stages(calls), tmp_path / "run").equals(clean)
+    assert calls == []
+
+
+def test_stale_checkpoints_are_discarded(tmp_path):
+    checkpoint_path = tmp_path / "run"
+    parameters = {"city": "Kraków", "resolution": 8, "layers": pipeline.layers_digest({"buildings": [[50.0, 19.9]]})}
+    pipeline.prepare_checkpoints(checkpoint_path, parameters)
+    pipeline.run_stages(toy_stages([]), checkpoint_path)
+
+    # the same parameters keep the checkpoints
+    pipeline.prepare_checkpoints(checkpoint_path, parameters)
+    assert (checkpoint_path / "final.feather").exists()
+    assert json.loads((checkpoint_path / "parameters.json").read_text()) == parameters
+
+    # changed layers, e.g. after a refresh, make every stage run again
+    changed = {**parameters, "layers": pipeline.layers_digest({"buildings": [[50.0, 19.9], [50.1, 19.9]]})}
+    assert changed != parameters
+    pipeline.prepare_checkpoints(checkpoint_path, changed)
+    assert [path.name for path in checkpoint_path.iterdir()] == ["parameters.json"]
+    calls = []
+    pipeline.run_stages(toy_stages(calls), checkpoint_path)
+    assert sorted(calls) == sorted(["numbers", "labels", "double", "total", "final"])
+
+    # restart discards the checkpoints even with the same parameters
+    pipeline.prepare_checkpoints(checkpoint_path, changed, restart=True)
+    assert [path.name for path in checkpoint_path.iterdir()] == ["parameters.json"]
@@ -0,0 +1,80 @@
+import geopandas as gpd
+import h3
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import LineString, Polygon
+import src.plots as plots
+
+# h3 areas of resolution 9 cover the frame, a few of them fall between the centers of its pixels
+cells = sorted(h3.k_ring(h3.geo_to_h3(50.06, 19.94, 9), 4))
+
+
+@pytest.fixture
+def small_grid(monkeypatch):
+    # pixels larger than the h3 areas, as in a plot of a whole city at a high resolution
+    monkeypatch.setattr(plots, "raster_size", 12)
+
+
+def pixel_boxes(grid):
+    """
+    Returns the polygon of each pixel of a grid, the vector reference of the rasterisation.
+    """
+    rows, cols = grid["shape"]
+    minx, maxx, miny, maxy = grid["extent"]
+    xs, ys = np.linspace(minx, maxx, cols + 1), np.linspace(maxy, miny, rows + 1)
+    return np.array([[shapely.box(xs[j], ys[i + 1], xs[j + 1], ys[i]) for j in range(cols)] for i in range(rows)])
+
+
+def test_rasterize_values(small_grid):
+    gdf = gpd.GeoDataFrame(geometry=[Polygon(h3.h3_to_geo_boundary(x, geo_json=True)) for x in cells], crs="EPSG:4326")
+    values = np.random.default_rng(0).uniform(0, 10, len(gdf))
+    values[:5] = np.nan
+    grid = plots.raster_grid(gdf.total_bounds, gdf.crs)
+
+    image = plots.rasterize_values(gdf, values, grid)
+
+    # each pixel is the mean of the values of the areas overlapping it, areas without a value are left out;
+    # pixels which an area only grazes at a corner or edge may go either way and are not compared
+    expected = np.full(grid["shape"], np.nan)
+    compared = np.zeros(grid["shape"], dtype=bool)
+    for index, pixel in np.ndenumerate(pixel_boxes(grid)):
+        overlap = shapely.area(shapely.intersection(gdf.geometry.to_numpy(), pixel)) / pixel.area
+        grazing = shapely.dwithin(gdf.geometry.to_numpy(), pixel, 0.01 * np.sqrt(pixel.area)) & (overlap < 0.001)
+        compared[index] = not grazing.any()
+        overlapping = (overlap > 0) & ~np.isnan(values)
+        if overlapping.any():
+            expected[index] = values[overlapping].mean()
+    assert compared.mean() > 0.9
+    np.testing.assert_allclose(image[compared], expected[compared], rtol=1e-6)
+
+    # with the pixel centers alone some areas would not be drawn at all
+    from rasterio.features import rasterize
+    centers = rasterize(zip(gdf.geometry, range(len(gdf))), out_shape=grid["shape"], transform=grid["transform"],
+                        fill=-1)
+    assert len(np.unique(centers[centers >= 0])) < len(gdf)
+
+
+def test_rasterize_counts(small_grid):
+    rng = np.random.default_rng(1)
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(rng.uniform(19.9, 20.0, 500), rng.uniform(50.0, 50.1, 500)),
+                              crs="EPSG:4326")
+    lines = gpd.GeoDataFrame(geometry=[LineString(rng.uniform((19.9, 50.0), (20.0, 50.1), (3, 2))) for _ in range(20)],
+                             crs="EPSG:4326")
+    grid = plots.figure_grid("raster", points, lines)
+    boxes = pixel_boxes(grid)
+
+    # points are counted in the pixel containing them, lines in every pixel they cross
+    for gdf in (points, lines):
+        expected = np.vectorize(lambda pixel: shapely.intersects(gdf.geometry.to_numpy(), pixel).sum())(boxes)
+        np.testing.assert_array_equal(plots.rasterize_counts(gdf, grid), expected)
+
+
+def test_figure_grid():
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy([19.9, 19.95], [50.0, 50.05]), crs="EPSG:4326")
+    lines = gpd.GeoDataFrame(geometry=[LineString([(19.92, 50.02), (20.0, 50.1)])], crs="EPSG:4326")
+
+    # the layers of a figure share one grid covering all of them
+    grid = plots.figure_grid("raster", points, lines, gpd.GeoDataFrame(geometry=[], crs="EPSG:4326"))
+    assert grid["extent"] == pytest.approx((19.9, 20.0, 50.0, 50.1))
+    assert plots.figure_grid("vector", points, lines) is None
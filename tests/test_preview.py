@@ -0,0 +1,167 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import geopandas as gpd
+import h3
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+from shapely.geometry import LineString, Polygon
+import src.modelling as modelling
+import src.osm as osm
+import src.preprocessing as preprocessing
+import src.preview as preview
+
+resolution = 7
+timestamp = "2024-05-08T10:00:00Z"
+boundary = [[19.85, 50.0], [20.05, 50.0], [20.05, 50.1], [19.85, 50.1], [19.85, 50.0]]
+polygon = Polygon(boundary)
+
+
+def random_points(rng, n):
+    # a margin around the boundary, so some nodes lie outside of the city
+    return [(lat, lon) for lat, lon in zip(rng.uniform(49.99, 50.11, n), rng.uniform(19.84, 20.06, n))]
+
+
+rng = np.random.default_rng(0)
+layer_points = {"green_areas": random_points(rng, 3000),
+                "buildings": random_points(rng, 20000),
+                "recreational_areas": random_points(rng, 1000)}
+# a selector of each layer, telling the layer of a query
+layer_markers = {"green_areas": '"leisure"="park"', "buildings": '"building"', "recreational_areas": '"shop"'}
+
+
+def inside(points):
+    return [(lat, lon) for lat, lon in points if shapely.contains_xy(polygon, lon, lat)]
+
+
+@pytest.fixture
+def overpass():
+    """
+    Serves the layers from a local Overpass stub. Full layers are held back until released,
+    samples are answered at once with every node, which the preview must filter to the boxes.
+    """
+    queries = []
+    release = threading.Event()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            query = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())["data"][0]
+            queries.append(query)
+            layer = next(layer for layer, marker in layer_markers.items() if marker in query)
+            if "[timeout:" in query:
+                points = layer_points[layer]
+            else:
+                release.wait(30)
+                points = inside(layer_points[layer])
+            body = {"osm3s": {"timestamp_osm_base": timestamp},
+                    "elements": [{"type": "node", "id": i, "lat": lat, "lon": lon} for i, (lat, lon) in enumerate(points)]}
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    previous_url = osm.overpass_url
+    osm.overpass_url = f"http://127.0.0.1:{server.server_port}/api/interpreter"
+    yield queries, release
+    release.set()
+    osm.overpass_url = previous_url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def city_data(tmp_path):
+    """
+    Writes bike paths on a grid covering the city and a population raster with random densities.
+    """
+    lines = [LineString([(lon, 49.995), (lon, 50.105)]) for lon in np.arange(19.845, 20.06, 0.005)]
+    lines += [LineString([(19.845, lat), (20.055, lat)]) for lat in np.arange(49.995, 50.11, 0.005)]
+    bike_paths_path = tmp_path / "bike_paths.parquet"
+    gpd.GeoDataFrame(geometry=lines, crs="EPSG:4326").to_parquet(bike_paths_path)
+
+    population_path = tmp_path / "population.tif"
+    values = np.random.default_rng(1).uniform(0, 50, (350, 500)).astype(np.float32)
+    with rasterio.open(population_path, "w", driver="GTiff", height=values.shape[0], width=values.shape[1],
+                       count=1, dtype="float32", crs="EPSG:4326", transform=from_origin(19.7, 50.2, 0.001, 0.001),
+                       nodata=-99999) as dst:
+        dst.write(values, 1)
+    return bike_paths_path, population_path
+
+
+def test_boxed_counts():
+    cell = h3.geo_to_h3(50.05, 19.95, resolution)
+    boxes = preview.sample_boxes([cell], resolution, 0.1)
+    south, west, north, east = boxes[cell]
+    # the box covers the fraction of the hexagon and lies at its center
+    box_area = (north - south) * (east - west)
+    assert box_area == pytest.approx(0.1 * Polygon(h3.h3_to_geo_boundary(cell, geo_json=True)).area)
+    assert Polygon(h3.h3_to_geo_boundary(cell, geo_json=True)).contains(
+        Polygon([(west, south), (east, south), (east, north), (west, north)]))
+
+    lat, lon = (south + north) / 2, (west + east) / 2
+    points = [(lat, lon)] * 3 + [(north + 0.001, lon), (lat, east + 0.001)]
+    counts = preview.boxed_counts(points, boxes, polygon, pd.Series([cell]), resolution)
+    # nodes of elements crossing the box but lying outside of it are left out
+    assert counts.tolist() == [3]
+    # outside of the city no node counts
+    outside = Polygon([(20.1, 50.2), (20.2, 50.2), (20.2, 50.3)])
+    assert np.isnan(preview.boxed_counts(points, boxes, outside, pd.Series([cell]), resolution)).all()
+
+    # children share the nodes of the box of their parent
+    children = sorted(h3.h3_to_children(cell, resolution + 1))
+    boxes = preview.sample_boxes(children, resolution + 1, 0.1)
+    assert list(boxes) == [cell]
+    counts = preview.boxed_counts(points, boxes, polygon, pd.Series(children), resolution + 1)
+    assert counts == pytest.approx([3 / 7] * 7)
+
+
+def test_preview_refines_as_layers_arrive(overpass, city_data):
+    queries, release = overpass
+    bike_paths_path, population_path = city_data
+    layers = {"boundary": boundary, "centrum": [19.95, 50.05], "buildings": layer_points["buildings"],
+              "sync": {"buildings": timestamp}}
+
+    passes = preview.preview_city("Kraków", layers, bike_paths_path, population_path, resolution, 0.05)
+    first = next(passes)
+
+    # the first pass is shown while the full green and recreational areas are still being fetched
+    assert "green_areas_count" in first["estimated_features"].iloc[0]
+    assert "recreational_areas_count" in first["estimated_features"].iloc[0]
+    assert (first["prediction_low"] <= first["prediction_high"]).all()
+    samples = [query for query in queries if "[timeout:" in query]
+    assert len(samples) == 2
+    assert all('way["leisure"="park"](' in query or 'way["shop"](' in query for query in samples)
+    assert "green_areas" not in layers
+
+    release.set()
+    rest = list(passes)
+    assert rest
+    last = rest[-1]
+    assert last["estimated_features"].iloc[0] == ""
+    assert (last["prediction_low"] == last["prediction_high"]).all()
+    assert all(h3_df["elapsed_seconds"].iloc[0] >= first["elapsed_seconds"].iloc[0] for h3_df in rest)
+
+    # fetched layers are kept for the caller, with their sync timestamps
+    assert layers["green_areas"] == inside(layer_points["green_areas"])
+    assert layers["sync"] == {layer: timestamp for layer in layer_points}
+
+    # the last pass has the features and predictions of the full data
+    city_boundaries = preprocessing.boundary_from_points(boundary, "EPSG:4326")
+    expected = preview.base_areas(bike_paths_path, city_boundaries, layers["centrum"], resolution)
+    for layer, column in preview.layer_columns.items():
+        expected[column] = preview.sampled_counts(layers[layer], 1.0, expected["h3_index"], resolution)
+    expected["population"], _ = preview.exact_population(expected, population_path)
+    expected = modelling.krakow_prediction(expected)
+    for column in [*preview.layer_columns.values(), "population", "prediction"]:
+        np.testing.assert_allclose(last[column], expected[column], rtol=1e-5)
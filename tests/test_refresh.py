@@ -0,0 +1,202 @@
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+import geopandas as gpd
+import h3
+import numpy as np
+import pytest
+from shapely.geometry import Polygon
+import src.modelling as modelling
+import src.osm as osm
+import src.refresh as refresh
+import src.tables as tables
+
+# augmented diff of the buildings layer recorded from Overpass, the other layers have no changes
+recorded_diff = (Path(__file__).parent / "data" / "buildings_adiff.xml").read_text()
+empty_diff = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="Overpass API 0.7.62.1 084b4234">
+<meta osm_base="2024-05-08T10:00:00Z"/>
+</osm>
+"""
+since = "2024-05-01T00:00:00Z"
+resolution = 7
+
+# H3 areas of the nodes in the recorded diff: nodes are created in and moved into the old town,
+# moved out of and deleted in Nowa Huta, and one node is created in Warsaw, outside of the tables
+old_town = h3.geo_to_h3(50.0617, 19.9372, resolution)
+nowa_huta = h3.geo_to_h3(50.0800, 20.0300, resolution)
+warsaw = h3.geo_to_h3(52.2297, 21.0122, resolution)
+cells = sorted(h3.k_ring(old_town, 3))
+
+
+@pytest.fixture
+def overpass():
+    """
+    Serves the recorded diffs from a local Overpass stub and collects the queries it receives.
+    """
+    queries = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            query = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())["data"][0]
+            queries.append(query)
+            # the buildings changed after the sync timestamp of the cached layers, later nothing changed
+            body = (recorded_diff if 'way["building"]' in query and f'adiff:"{since}"' in query else empty_diff).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/osm3s+xml")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    previous_url = osm.overpass_url
+    osm.overpass_url = f"http://127.0.0.1:{server.server_port}/api/interpreter"
+    yield queries
+    osm.overpass_url = previous_url
+    server.shutdown()
+    server.server_close()
+
+
+def feature_table():
+    h3_df = gpd.GeoDataFrame({"h3_index": cells,
+                              "bike_paths_count": 1.0,
+                              "green_areas_count": [np.nan] + [2.0] * (len(cells) - 1),
+                              "buildings_count": 3.0,
+                              "population": np.linspace(500, 3000, len(cells)),
+                              "recreational_areas_count": [1.0] + [np.nan] * (len(cells) - 1),
+                              "distance_to_centrum": np.linspace(0.5, 4, len(cells))},
+                             geometry=[Polygon(h3.h3_to_geo_boundary(x, geo_json=True)) for x in cells],
+                             crs="EPSG:4326")
+    return tables.to_arrow(h3_df)
+
+
+def predictions_table(table):
+    dataset = tables.to_geodataframe(table, [column for column in table.column_names if column != "geometry"])
+    return tables.append_columns(table, modelling.krakow_prediction(dataset, explain_predictions=True))
+
+
+def cached_layers():
+    boundary = [[19.8, 49.98], [20.1, 49.98], [20.1, 50.15], [19.8, 50.15], [19.8, 49.98]]
+    return {"boundary": boundary,
+            "centrum": [19.9372, 50.0617],
+            "green_areas": [],
+            "buildings": [(50.08, 20.03)] * 3 + [(50.07, 19.95)],
+            "recreational_areas": [(50.0617, 19.9372)],
+            "sync": {layer: since for layer in refresh.layer_columns}}
+
+
+def column_by_cell(table, column):
+    return dict(zip((h3.h3_to_string(x) for x in table["h3_index"].to_numpy()), table[column].to_pylist()))
+
+
+def test_parse_augmented_diff():
+    removed, added, timestamp = refresh.parse_augmented_diff(recorded_diff)
+
+    assert timestamp == "2024-05-08T10:00:00Z"
+    # the moved, retagged and deleted nodes leave Nowa Huta, ways are ignored
+    assert removed == [(50.08, 20.03)] * 3
+    # the created nodes, the moved node and the retagged node in its old place enter the layer
+    assert added == [(50.0617, 19.9372), (50.0619, 19.9375), (52.2297, 21.0122), (50.0617, 19.9372), (50.08, 20.03)]
+
+
+def test_cell_deltas():
+    removed, added, _ = refresh.parse_augmented_diff(recorded_diff)
+
+    assert refresh.cell_deltas(removed, added, resolution) == Counter({old_town: 3, nowa_huta: -2, warsaw: 1})
+    assert refresh.cell_deltas([(50.08, 20.03)], [(50.08, 20.03)], resolution) == Counter()
+
+
+def test_apply_deltas():
+    table = feature_table()
+    deltas = Counter({old_town: 3, nowa_huta: -2, warsaw: 1})
+
+    updated, positions = refresh.apply_deltas(table, "buildings_count", deltas)
+    counts = column_by_cell(updated, "buildings_count")
+
+    # the Warsaw area is not in the table and is skipped
+    assert sorted(h3.h3_to_string(x) for x in updated["h3_index"].to_numpy()[positions]) == sorted([old_town, nowa_huta])
+    assert counts[old_town] == 6
+    assert counts[nowa_huta] == 1
+    assert all(counts[x] == 3 for x in cells if x not in (old_town, nowa_huta))
+    # missing counts are treated as zero
+    updated, _ = refresh.apply_deltas(table, "green_areas_count", Counter({cells[0]: 2}))
+    assert column_by_cell(updated, "green_areas_count")[cells[0]] == 2
+    # the given table is left unchanged
+    assert column_by_cell(table, "buildings_count")[old_town] == 3
+
+
+def test_refresh_city(overpass):
+    table = feature_table()
+    predictions = predictions_table(table)
+
+    layers, refreshed, refreshed_predictions, touched = refresh.refresh_city(
+        cached_layers(), table, predictions, resolution)
+
+    # one diff is fetched for each layer since its sync timestamp
+    assert len(overpass) == len(refresh.layer_columns)
+    assert all(f'[out:xml][adiff:"{since}"]' in query for query in overpass)
+    assert layers["sync"] == {layer: "2024-05-08T10:00:00Z" for layer in refresh.layer_columns}
+    assert Counter(layers["buildings"]) == Counter([(50.08, 20.03), (50.07, 19.95), (50.0617, 19.9372),
+                                                   (50.0619, 19.9375), (52.2297, 21.0122), (50.0617, 19.9372)])
+
+    assert touched == 2
+    for result in (refreshed, refreshed_predictions):
+        counts = column_by_cell(result, "buildings_count")
+        assert counts[old_town] == 6 and counts[nowa_huta] == 1
+        assert all(counts[x] == 3 for x in cells if x not in (old_town, nowa_huta))
+
+    # touched areas get the predictions of a full run on the refreshed table, all other areas keep theirs
+    expected = predictions_table(refreshed)
+    for column in ("prediction", "contribution_buildings_count", "dominant_driver"):
+        before = column_by_cell(predictions, column)
+        after = column_by_cell(refreshed_predictions, column)
+        full_run = column_by_cell(expected, column)
+        for x in cells:
+            if x in (old_town, nowa_huta) and column == "dominant_driver":
+                assert after[x] == full_run[x]
+            elif x in (old_town, nowa_huta):
+                assert after[x] == pytest.approx(full_run[x], rel=1e-5)
+            else:
+                assert after[x] == before[x]
+
+
+def test_refresh_after_partial_write(overpass):
+    table = feature_table()
+    predictions = predictions_table(table)
+    layers, refreshed, refreshed_predictions, _ = refresh.refresh_city(cached_layers(), table, predictions, resolution)
+    assert refresh.read_sync(refreshed) == refresh.read_sync(refreshed_predictions) == layers["sync"]
+
+    # only the feature table was written before the refresh failed, the layers and predictions are old
+    overpass.clear()
+    layers_again, features_again, predictions_again, touched = refresh.refresh_city(
+        cached_layers(), refreshed, predictions, resolution)
+
+    # each layer gets the diff since the old timestamp for the layers and predictions, and since the
+    # new one for the feature table, which already has the changes
+    assert sorted(query.split('adiff:"')[1][:20] for query in overpass) == \
+        sorted([since, "2024-05-08T10:00:00Z"] * len(refresh.layer_columns))
+    assert touched == 2
+    assert features_again.equals(refreshed)
+    assert Counter(layers_again["buildings"]) == Counter(layers["buildings"])
+    for column in ("buildings_count", "prediction"):
+        assert column_by_cell(predictions_again, column) == column_by_cell(refreshed_predictions, column)
+    assert refresh.read_sync(predictions_again) == layers_again["sync"] == layers["sync"]
+
+    # a refresh of complete outputs finds nothing new
+    overpass.clear()
+    _, features_again, predictions_again, touched = refresh.refresh_city(
+        layers_again, features_again, predictions_again, resolution)
+    assert touched == 0 and len(overpass) == len(refresh.layer_columns)
+    assert features_again.equals(refreshed)
+
+
+def test_refresh_city_resolution_mismatch(overpass):
+    with pytest.raises(ValueError, match="resolution 7, not 8"):
+        refresh.refresh_city(cached_layers(), feature_table(), resolution=8)
+    assert overpass == []
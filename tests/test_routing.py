@@ -0,0 +1,90 @@
+import warnings
+import numpy as np
+import pytest
+from scipy.sparse.csgraph import dijkstra
+from shapely.geometry import LineString
+import src.routing as routing
+
+
+def street_grid(size=12, spacing=0.002, origin=(19.90, 50.03)):
+    """
+    Creates bike paths along the streets of a regular grid, with a few streets missing, so routes make detours.
+    """
+    lon0, lat0 = origin
+    rng = np.random.default_rng(1)
+    paths = []
+    for i in range(size):
+        for j in range(size - 1):
+            if rng.random() > 0.15:
+                paths.append(LineString([(lon0 + i * spacing, lat0 + j * spacing),
+                                         (lon0 + i * spacing, lat0 + (j + 1) * spacing)]))
+            if rng.random() > 0.15:
+                paths.append(LineString([(lon0 + j * spacing, lat0 + i * spacing),
+                                         (lon0 + (j + 1) * spacing, lat0 + i * spacing)]))
+    return paths
+
+
+def random_points(n, seed, size=12, spacing=0.002, origin=(19.90, 50.03)):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([origin[0] + rng.random(n) * (size - 1) * spacing,
+                            origin[1] + rng.random(n) * (size - 1) * spacing])
+
+
+@pytest.fixture
+def graph(tmp_path, monkeypatch):
+    monkeypatch.setattr(routing, "cache_path", tmp_path / "graphs")
+    return routing.get_graph(street_grid())
+
+
+def brute_force_nearest(graph, points, targets, n_nearest):
+    point_nodes, access_distances = routing.snap_points(graph, points)
+    target_nodes, egress_distances = routing.snap_points(graph, targets)
+    distances = dijkstra(graph["matrix"], directed=False, indices=point_nodes)[:, target_nodes] + egress_distances
+    return access_distances + np.sort(distances, axis=1)[:, :n_nearest].mean(axis=1)
+
+
+@pytest.mark.parametrize("n_nearest", [1, 3, 8])
+def test_nearest_matches_full_searches(graph, n_nearest):
+    points, targets = random_points(50, seed=2), random_points(20, seed=3)
+
+    distances = routing.network_distance_to_nearest(graph, points, targets, n_nearest)
+
+    np.testing.assert_allclose(distances, brute_force_nearest(graph, points, targets, n_nearest), rtol=1e-9)
+
+
+def test_bounded_search_grows_small_limits(graph, monkeypatch):
+    # a limit far too small for every point is doubled until the nearest targets are found
+    monkeypatch.setattr(routing, "min_search_limit", 1.0)
+    monkeypatch.setattr(routing, "search_detour_factor", 0.01)
+    points, targets = random_points(30, seed=4), random_points(10, seed=5)
+
+    distances = routing.network_distance_to_nearest(graph, points, targets, 3)
+
+    np.testing.assert_allclose(distances, brute_force_nearest(graph, points, targets, 3), rtol=1e-9)
+
+
+def test_more_nearest_than_targets(graph):
+    points, targets = random_points(10, seed=6), random_points(2, seed=7)
+
+    distances = routing.network_distance_to_nearest(graph, points, targets, 3)
+
+    np.testing.assert_allclose(distances, brute_force_nearest(graph, points, targets, 2), rtol=1e-9)
+
+
+def test_no_targets(graph):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        distances = routing.network_distance_to_nearest(graph, random_points(5, seed=8), [], 3)
+    assert distances.shape == (5,)
+    assert np.isnan(distances).all()
+
+
+def test_graph_cache(graph, tmp_path):
+    paths = street_grid()
+    graph_path = tmp_path / "graphs" / f"{routing.graph_hash(paths)}.npz"
+
+    # the graph is written in place of the cached file, without leaving temporary files
+    assert [path.name for path in (tmp_path / "graphs").iterdir()] == [graph_path.name]
+    cached = routing.get_graph(paths)
+    assert (cached["matrix"] != graph["matrix"]).nnz == 0
+    np.testing.assert_array_equal(cached["main_component"], graph["main_component"])
@@ -0,0 +1,169 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.request
+import pytest
+import src.service as service
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "jobs.sqlite"
+
+
+def test_submit_and_claim(db_path):
+    connection = service.connect(db_path)
+    first, created = service.submit_job(connection, "Kraków", 7)
+    assert created
+    # identical jobs in flight are de-duplicated
+    same, created = service.submit_job(connection, "Kraków", 7)
+    assert not created and same["id"] == first["id"]
+    second, _ = service.submit_job(connection, "Kraków", 8)
+
+    claimed = service.claim_job(connection)
+    assert claimed["id"] == first["id"]
+    assert service.claim_job(connection)["id"] == second["id"]
+    assert service.claim_job(connection) is None
+    statuses = [row["status"] for row in connection.execute("SELECT status FROM jobs ORDER BY id")]
+    assert statuses == ["running", "running"]
+
+
+def test_failed_claim_releases_the_queue(db_path):
+    connection = service.connect(db_path)
+    job, _ = service.submit_job(connection, "Kraków", 7)
+    connection.execute("CREATE TRIGGER fail_claim BEFORE UPDATE ON jobs BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+
+    with pytest.raises(sqlite3.IntegrityError, match="disk full"):
+        service.claim_job(connection)
+
+    # the transaction is rolled back, so the job is still queued and other workers are not blocked
+    assert not connection.in_transaction
+    other = service.connect(db_path)
+    other.execute("DROP TRIGGER fail_claim")
+    assert service.claim_job(other)["id"] == job["id"]
+
+
+def test_stale_lock_is_broken(db_path):
+    connection = service.connect(db_path)
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    connection.execute("INSERT INTO locks (name, job_id, pid) VALUES ('layers:Krakow', 1, ?)", (dead.pid,))
+
+    # the worker holding the lock died, so the lock is taken over at once
+    service.acquire_lock(connection, "layers:Krakow", 2)
+    holder = connection.execute("SELECT job_id, pid FROM locks WHERE name = 'layers:Krakow'").fetchone()
+    assert tuple(holder) == (2, os.getpid())
+
+
+@pytest.fixture
+def stubbed_run(tmp_path, monkeypatch):
+    """
+    Replaces the commands of run.py with stubs writing empty result files and recording the stage they run in.
+    """
+    import run
+
+    monkeypatch.setattr(run, "data_path", tmp_path / "DATA")
+    calls = []
+
+    def stub(name, path):
+        def command(args):
+            stage = service.connect(tmp_path / "jobs.sqlite").execute(
+                "SELECT stage FROM jobs WHERE status = 'running'").fetchone()["stage"]
+            calls.append((name, stage))
+            if path is not None:
+                path(args).parent.mkdir(parents=True, exist_ok=True)
+                path(args).write_bytes(b"")
+        return command
+
+    monkeypatch.setattr(run, "fetch_command", stub("fetch", run.layers_path))
+    monkeypatch.setattr(run, "features_command", stub("features", run.features_path))
+    monkeypatch.setattr(run, "predict_command", stub("predict", run.predictions_path))
+    monkeypatch.setattr(run, "plot_command", stub("plot", None))
+    return calls
+
+
+def test_run_job(tmp_path, stubbed_run):
+    connection = service.connect(tmp_path / "jobs.sqlite")
+    service.submit_job(connection, "Kraków", 7)
+    job = service.claim_job(connection)
+
+    service.run_job(connection, job, tmp_path / "results", "http://127.0.0.1:1/api/interpreter")
+
+    # each command runs in its own stage, in order
+    assert stubbed_run == [(stage, stage) for stage in service.job_stages]
+    row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job["id"],)).fetchone()
+    assert (row["status"], row["stage"], row["progress"]) == ("done", None, 1.0)
+    assert connection.execute("SELECT COUNT(*) FROM locks").fetchone()[0] == 0
+
+    # a job of another resolution reuses the layers, a forced one fetches and calculates everything again
+    stubbed_run.clear()
+    service.submit_job(connection, "Kraków", 8)
+    job = service.claim_job(connection)
+    service.run_job(connection, job, tmp_path / "results", "http://127.0.0.1:1/api/interpreter")
+    assert [name for name, _ in stubbed_run] == ["features", "predict", "plot"]
+    stubbed_run.clear()
+    service.submit_job(connection, "Kraków", 8, force=True)
+    job = service.claim_job(connection)
+    service.run_job(connection, job, tmp_path / "results", "http://127.0.0.1:1/api/interpreter")
+    assert [name for name, _ in stubbed_run] == service.job_stages
+
+
+@pytest.fixture
+def server(tmp_path):
+    """
+    Serves the HTTP API on a free port, without workers, so jobs stay queued until the test runs them.
+    """
+    results_root = tmp_path / "results"
+    results_root.mkdir()
+    server = service.JobServer(("127.0.0.1", 0), service.JobHandler)
+    server.db_path = results_root / "jobs.sqlite"
+    server.results_root = results_root
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, path, data=None):
+    url = f"http://127.0.0.1:{server.server_port}{path}"
+    body = None if data is None else json.dumps(data).encode()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=body)) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.read()
+
+
+def test_http_round_trip(server):
+    status, body = request(server, "/jobs", {"city": "Kraków", "resolution": 7})
+    job = json.loads(body)
+    assert status == 202 and job["status"] == "queued"
+    status, body = request(server, "/jobs", {"city": "Kraków", "resolution": 7})
+    assert status == 200 and json.loads(body)["id"] == job["id"]
+    assert request(server, "/jobs", {"resolution": 7})[0] == 400
+
+    # the job is run by hand, writing a plot into its directory
+    connection = service.connect(server.db_path)
+    service.claim_job(connection)
+    status, body = request(server, f"/jobs/{job['id']}")
+    assert status == 200 and json.loads(body)["status"] == "running"
+    directory = service.job_directory(server.results_root, "Kraków", 7)
+    (directory / "RESULTS").mkdir(parents=True)
+    (directory / "RESULTS" / "plot.png").write_bytes(b"png")
+    service.update_job(connection, job["id"], status="done", progress=1.0)
+
+    status, body = request(server, f"/jobs/{job['id']}")
+    results = json.loads(body)["results"]
+    assert status == 200 and results == ["/results/Krakow/resolution_7/RESULTS/plot.png"]
+    assert request(server, results[0]) == (200, b"png")
+    assert request(server, "/jobs/12345")[0] == 404
+
+    # files outside of the job directories are not served
+    assert request(server, "/results/jobs.sqlite")[0] == 404
+    assert request(server, "/results/Krakow/resolution_7/../../jobs.sqlite")[0] == 404
+    assert request(server, "/results/..%2Fjobs.sqlite")[0] == 404
@@ -0,0 +1,79 @@
+import geopandas as gpd
+import h3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from shapely.geometry import Polygon
+import src.tables as tables
+
+cells = sorted(h3.k_ring(h3.geo_to_h3(50.0617, 19.9372, 7), 2))
+
+
+def feature_table():
+    return gpd.GeoDataFrame({"h3_index": cells,
+                             "bike_paths_count": np.arange(len(cells), dtype=float),
+                             "green_areas_count": [np.nan] + [2.0] * (len(cells) - 1)},
+                            geometry=[Polygon(h3.h3_to_geo_boundary(x, geo_json=True)) for x in cells],
+                            crs="EPSG:4326")
+
+
+def test_round_trip(tmp_path):
+    h3_df = feature_table()
+    table = tables.to_arrow(h3_df)
+    table = tables.append_columns(table, pd.DataFrame({"dominant_driver": ["population"] * len(cells)}))
+    tables.write_table(table, tmp_path / "Krakow_resolution_7.feather")
+
+    result = tables.to_geodataframe(tables.read_table(tmp_path / "Krakow_resolution_7.feather"))
+    assert result["h3_index"].tolist() == cells
+    assert result.crs == h3_df.crs
+    assert result.geometry.geom_equals(h3_df.geometry).all()
+    assert result["green_areas_count"].isna().tolist() == h3_df["green_areas_count"].isna().tolist()
+    assert result["dominant_driver"].tolist() == ["population"] * len(cells)
+    assert tables.table_resolution(table) == 7
+
+
+@pytest.mark.skipif(int(gpd.__version__.split(".")[0]) < 1, reason="GeoArrow encodings are read by geopandas 1.0+")
+def test_read_feather_with_geopandas(tmp_path):
+    h3_df = feature_table()
+    # columns appended after the conversion keep the "geo" metadata of the table
+    table = tables.append_columns(tables.to_arrow(h3_df), pd.DataFrame({"prediction": np.ones(len(cells))}))
+    tables.write_table(table, tmp_path / "Krakow_resolution_7_predictions.feather")
+
+    result = gpd.read_feather(tmp_path / "Krakow_resolution_7_predictions.feather")
+    assert result.geometry.name == "geometry"
+    assert result.crs == h3_df.crs
+    assert result.geometry.geom_equals(h3_df.geometry).all()
+    assert result["prediction"].tolist() == [1.0] * len(cells)
+
+
+def test_column_types():
+    h3_df = feature_table()
+    h3_df["population"] = np.linspace(100, 200, len(cells))
+    table = tables.to_arrow(h3_df)
+    table = tables.append_columns(table, pd.DataFrame({"prediction": np.linspace(0, 1, len(cells)),
+                                                       "contribution_population": np.ones(len(cells))}))
+
+    types = {field.name: field.type for field in table.schema}
+    assert types["h3_index"] == pa.uint64()
+    assert types["population"] == pa.float32()
+    # counts stay integers, areas without any counted element are nulls
+    assert types["bike_paths_count"] == types["green_areas_count"] == pa.int32()
+    assert table["green_areas_count"].null_count == 1
+    assert types["prediction"] == types["contribution_population"] == pa.float64()
+    # scaled estimates of counts are not whole numbers, so they are not rounded
+    estimates = tables.to_arrow(h3_df.assign(green_areas_count=h3_df["green_areas_count"] / 3))
+    assert estimates.schema.field("green_areas_count").type == pa.float64()
+
+
+def test_join_columns():
+    table = tables.to_arrow(feature_table())
+    # the other table has its rows in another order, one area less and one area which is not in the table
+    other_cells = cells[:0:-1] + [h3.geo_to_h3(52.2297, 21.0122, 7)]
+    other = tables.to_arrow(pd.DataFrame({"h3_index": other_cells, "population": np.arange(len(other_cells))}))
+
+    joined = tables.join_columns(table, other)
+    assert joined.column_names == [*table.column_names, "population"]
+    assert joined["h3_index"].equals(table["h3_index"])
+    population = dict(zip(other_cells, range(len(other_cells))))
+    assert joined["population"].to_pylist() == [None] + [population[x] for x in cells[1:]]
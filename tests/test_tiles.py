@@ -0,0 +1,139 @@
+import gzip
+import json
+import sqlite3
+import h3
+import numpy as np
+import pandas as pd
+import pytest
+import src.tiles as tiles
+
+cell = h3.geo_to_h3(50.06, 19.94, 8)
+
+
+def read_varint(data, position):
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        value |= (byte & 0x7F) << shift
+        position += 1
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def read_fields(data):
+    """
+    Decodes a protobuf message into a list of (field number, value) pairs, with length-delimited values as bytes.
+    """
+    fields, position = [], 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 1:
+            value, position = data[position:position + 8], position + 8
+        else:
+            length, position = read_varint(data, position)
+            value, position = data[position:position + length], position + length
+        fields.append((number, value))
+    return fields
+
+
+def packed(data):
+    values, position = [], 0
+    while position < len(data):
+        value, position = read_varint(data, position)
+        values.append(value)
+    return values
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def test_encode_tile_layout():
+    # a square in tile coordinates, counterclockwise on screen, so it is reversed
+    ring = np.array([[10, 10], [10, 20], [20, 20], [20, 10]])
+    tile = tiles.encode_tile([(7, ring, np.array([2.5, np.nan, 2.5]))], ["a", "b", "c"])
+
+    [(number, layer)] = read_fields(tile)
+    assert number == 3
+    layer = read_fields(layer)
+    assert [value for number, value in layer if number == 15] == [2]
+    assert [value for number, value in layer if number == 1] == [tiles.layer_name.encode()]
+    assert [value for number, value in layer if number == 3] == [b"a", b"b", b"c"]
+    assert [value for number, value in layer if number == 5] == [tiles.tile_extent]
+    # equal values are stored once, as doubles
+    assert [read_fields(value) for number, value in layer if number == 4] == [[(3, np.float64(2.5).tobytes())]]
+
+    [feature] = [read_fields(value) for number, value in layer if number == 2]
+    feature = dict(feature)
+    assert feature[1] == 7 and feature[3] == 3
+    # missing values are left out of the tags
+    assert packed(feature[2]) == [0, 0, 2, 0]
+
+    commands = packed(feature[4])
+    assert commands[0] == (1 << 3) | 1 and commands[3] == (3 << 3) | 2 and commands[-1] == (1 << 3) | 7
+    points = np.cumsum(np.array([unzigzag(x) for x in commands[1:3] + commands[4:-1]]).reshape(-1, 2), axis=0)
+    np.testing.assert_array_equal(points, ring[::-1])
+    x, y = points[:, 0], points[:, 1]
+    # clockwise on screen, with y pointing down, is a positive shoelace sum
+    assert np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y) > 0
+
+
+def test_encode_tile_decodes():
+    mapbox_vector_tile = pytest.importorskip("mapbox_vector_tile")
+    ring = np.array([[10, 10], [10, 20], [20, 20], [20, 10]])
+    tile = tiles.encode_tile([(7, ring, np.array([2.5, np.nan, 1.0]))], ["a", "b", "c"])
+
+    layer = mapbox_vector_tile.decode(tile, default_options={"y_coord_down": True})[tiles.layer_name]
+    [feature] = layer["features"]
+    assert layer["extent"] == tiles.tile_extent
+    assert feature["id"] == 7 and feature["properties"] == {"a": 2.5, "c": 1.0}
+    assert feature["geometry"]["type"] == "Polygon"
+    assert sorted(map(tuple, feature["geometry"]["coordinates"][0][:-1])) == sorted(map(tuple, ring.tolist()))
+
+
+def test_roll_up():
+    children = sorted(h3.h3_to_children(cell, 9))
+    other = sorted(h3.h3_to_children(h3.k_ring(cell, 1).difference({cell}).pop(), 9))[:2]
+    h3_df = pd.DataFrame({"h3_index": children + other,
+                          "bike_paths_count": np.arange(9.0),
+                          "distance_to_centrum": np.arange(9.0),
+                          "dominant_driver": "population"})
+
+    parents = tiles.roll_up(h3_df, 8).set_index("h3_index")
+
+    # counts are summed and other numeric columns averaged, text columns are dropped
+    assert parents.loc[cell, "bike_paths_count"] == sum(range(7))
+    assert parents.loc[cell, "distance_to_centrum"] == 3.0
+    assert parents.drop(cell)["bike_paths_count"].tolist() == [15.0]
+    assert parents.drop(cell)["distance_to_centrum"].tolist() == [7.5]
+    assert list(parents.columns) == ["bike_paths_count", "distance_to_centrum"]
+
+
+def test_tile_pyramid_writes_each_zoom(tmp_path):
+    h3_df = pd.DataFrame({"h3_index": sorted(h3.k_ring(cell, 2)), "prediction": 1.0})
+
+    tiles.export_mbtiles(h3_df, tmp_path / "city.mbtiles", 8, 10, workers=2)
+
+    with sqlite3.connect(tmp_path / "city.mbtiles") as connection:
+        rows = connection.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles").fetchall()
+    assert sorted({zoom for zoom, *_ in rows}) == [8, 9, 10]
+    assert len(rows) == len(list(tiles.tile_pyramid(h3_df, 8, 10, workers=1)))
+    assert all(read_fields(gzip.decompress(data))[0][0] == 3 for *_, data in rows)
+
+
+def test_export_empty_table(tmp_path):
+    h3_df = pd.DataFrame({"h3_index": pd.Series([], dtype=str), "prediction": pd.Series([], dtype=float)})
+
+    assert list(tiles.tile_pyramid(h3_df, 6, 8)) == []
+    tiles.export_directory(h3_df, tmp_path / "tiles", 6, 8)
+    assert [path.name for path in (tmp_path / "tiles").iterdir()] == ["tiles.json"]
+    assert json.loads((tmp_path / "tiles" / "tiles.json").read_text())["bounds"] == [-180, -85.0511, 180, 85.0511]
+
+    tiles.export_mbtiles(h3_df, tmp_path / "city.mbtiles", 6, 8)
+    with sqlite3.connect(tmp_path / "city.mbtiles") as connection:
+        assert connection.execute("SELECT COUNT(*) FROM tiles").fetchone()[0] == 0
+        assert dict(connection.execute("SELECT name, value FROM metadata").fetchall())["minzoom"] == "6"